@@ -0,0 +1,244 @@
+import time
+from array import array
+
+from rflib.ipc.MongoClientFactory import MongoClientFactory
+
+# (seconds between samples, samples kept) of each resolution, finest first.
+# The finest resolution takes every sample it is given.
+RESOLUTIONS = ((0, 60), (60, 60), (900, 96))
+# Seconds between downsampling runs
+DOWNSAMPLE_INTERVAL = 60
+# Seconds between bulk writes of new rates
+PERSIST_INTERVAL = 30
+# Capped collection the rates are written to, and its size in bytes
+COLLECTION = "rfcounters"
+COLLECTION_SIZE = 256 * 1024 * 1024
+# Flows and ports per document, which keeps a switch with a full routing
+# table within the BSON document size limit
+MAX_DOCUMENT_KEYS = 1000
+
+# (counter, rate, scale) of each kind of counter set. Byte counters become
+# bit rates.
+FLOW_COUNTERS = (("packet_count", "pps", 1), ("byte_count", "bps", 8))
+PORT_COUNTERS = (("rx_packets", "rx_pps", 1), ("tx_packets", "tx_pps", 1),
+                 ("rx_bytes", "rx_bps", 8), ("tx_bytes", "tx_bps", 8))
+COUNTERS = {"flows": FLOW_COUNTERS, "ports": PORT_COUNTERS}
+
+
+def compute_rates(counters, t0, values0, t1, values1):
+    dt = t1 - t0
+    if dt <= 0:
+        return None
+    rates = []
+    for ((_, _, scale), a, b) in zip(counters, values0, values1):
+        # A counter that went back was reset, e.g. the flow was reinstalled
+        delta = b - a if b >= a else b
+        rates.append(delta * scale / dt)
+    return rates
+
+
+class CounterRing:
+    """The last `capacity` samples of the counters of a table, in columns.
+
+    Every flow or port of the table has a slot, and each sample holds an
+    array per counter indexed by slot, so a flow costs a few numbers per
+    sample instead of objects of its own.
+    """
+    def __init__(self, n_counters, capacity):
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity
+        self.values = [[array("d") for i in range(capacity)]
+                       for c in range(n_counters)]
+        self.next = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, slots):
+        for column in self.values:
+            for values in column:
+                values.extend([0.0] * (slots - len(values)))
+
+    def append(self, t, columns):
+        """Add a sample: an array per counter, indexed by slot."""
+        i = self.next
+        self.times[i] = t
+        for (column, values) in zip(self.values, columns):
+            column[i][:] = values
+        self.next = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def position(self, age=0):
+        """Return the position of the sample `age` samples before the last
+        one."""
+        return (self.next - 1 - age) % self.capacity
+
+    def positions(self):
+        """Return the positions of the samples, oldest first."""
+        return [self.position(age) for age in range(self.size - 1, -1, -1)]
+
+    def last(self):
+        i = self.position()
+        return (self.times[i], [column[i] for column in self.values])
+
+
+class CounterTable:
+    """Samples of the counters of the flows or ports of a switch at every
+    resolution.
+
+    Keys are given slots in the columns of each CounterRing. A slot freed by
+    a key that went away is given to the next new key; its older samples
+    are told apart by the time the slot was given (born).
+    """
+    def __init__(self, counters, resolutions=RESOLUTIONS):
+        self.counters = counters
+        self.resolutions = resolutions
+        self.rings = [CounterRing(len(counters), capacity)
+                      for (_, capacity) in resolutions]
+        self.slots = {}
+        self.keys = []
+        self.free = []
+        self.born = array("d")
+        # Time of the last sample written of each slot at each resolution
+        self.persisted = [array("d") for r in resolutions]
+
+    def add(self, t, samples):
+        """Add a sample of every key; the slots of missing keys are freed."""
+        ring = self.rings[0]
+        if len(ring) and t <= ring.last()[0]:
+            return
+        for key in [key for key in self.slots if key not in samples]:
+            slot = self.slots.pop(key)
+            self.keys[slot] = None
+            self.free.append(slot)
+        for key in samples:
+            if key not in self.slots:
+                self._assign(key, t)
+        columns = [array("d", [0.0]) * len(self.keys) for c in self.counters]
+        for (key, values) in samples.items():
+            slot = self.slots[key]
+            for (column, value) in zip(columns, values):
+                column[slot] = value
+        ring.append(t, columns)
+
+    def _assign(self, key, t):
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+            self.born[slot] = t
+        else:
+            slot = len(self.keys)
+            self.keys.append(key)
+            self.born.append(t)
+            for persisted in self.persisted:
+                persisted.append(0.0)
+            for ring in self.rings:
+                ring.grow(slot + 1)
+        for persisted in self.persisted:
+            persisted[slot] = 0.0
+        self.slots[key] = slot
+
+    def downsample(self):
+        for level in range(1, len(self.rings)):
+            source = self.rings[level - 1]
+            ring = self.rings[level]
+            if not len(source):
+                break
+            (t, columns) = source.last()
+            if not len(ring) or \
+               t - ring.last()[0] >= self.resolutions[level][0]:
+                ring.append(t, columns)
+
+    def window(self, level, slot, since=0):
+        """Return [time, rate...] of a slot for every sample after
+        `since`."""
+        ring = self.rings[level]
+        born = self.born[slot]
+        points = []
+        previous = None
+        for i in ring.positions():
+            t = ring.times[i]
+            if t < born:
+                continue
+            if previous is not None and t > since:
+                t0 = ring.times[previous]
+                values0 = [column[previous][slot] for column in ring.values]
+                values1 = [column[i][slot] for column in ring.values]
+                rates = compute_rates(self.counters, t0, values0, t, values1)
+                points.append([t] + rates)
+            previous = i
+        return points
+
+
+class CounterStore:
+    """Flow and port counter series of every switch.
+
+    Samples are taken from stats replies, downsampled to the coarser
+    resolutions by downsample() and written in bulk by persist(): documents
+    per switch and resolution holding the new rates of at most
+    MAX_DOCUMENT_KEYS of its flows and ports each.
+    """
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        # {dp_id: {kind: CounterTable}}
+        self.switches = {}
+        self.collection = None
+
+    def update(self, dp_id, kind, t, samples):
+        """Add a sample of every flow or port (`kind`) of a switch.
+
+        samples maps keys to counter values. The keys that aren't in samples
+        are dropped.
+        """
+        tables = self.switches.setdefault(dp_id, {})
+        if kind not in tables:
+            tables[kind] = CounterTable(COUNTERS[kind], self.resolutions)
+        tables[kind].add(t, samples)
+
+    def delete(self, dp_id):
+        self.switches.pop(dp_id, None)
+
+    def downsample(self):
+        for tables in self.switches.values():
+            for table in tables.values():
+                table.downsample()
+
+    def persist(self, db=None):
+        if self.collection is None:
+            if db is None:
+                db = MongoClientFactory.get("localhost").db
+            if COLLECTION not in db.collection_names():
+                db.create_collection(COLLECTION, capped=True,
+                                     size=COLLECTION_SIZE)
+            self.collection = db[COLLECTION]
+            MongoClientFactory.ensure_indexes(
+                self.collection, [("dp_id", "resolution", "time")])
+        now = time.time()
+        documents = []
+        for (dp_id, tables) in self.switches.items():
+            for (level, (resolution, _)) in enumerate(self.resolutions):
+                document = None
+                for (kind, table) in tables.items():
+                    columns = ["time"] + [rate for (_, rate, _) in
+                                          COUNTERS[kind]]
+                    persisted = table.persisted[level]
+                    for (key, slot) in table.slots.items():
+                        points = table.window(level, slot, persisted[slot])
+                        if not points:
+                            continue
+                        persisted[slot] = points[-1][0]
+                        if document is None or keys == MAX_DOCUMENT_KEYS:
+                            document = {"dp_id": dp_id,
+                                        "resolution": resolution,
+                                        "time": now, "columns": {}}
+                            documents.append(document)
+                            keys = 0
+                        if kind not in document:
+                            document["columns"][kind] = columns
+                            document[kind] = {}
+                        document[kind][key] = points
+                        keys += 1
+        if documents:
+            with MongoClientFactory.stats.timed("counters_insert"):
+                self.collection.insert(documents)
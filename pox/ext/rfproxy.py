@@ -1,14 +1,17 @@
 import struct
+import socket
 import logging
 import threading
 import time
 
 from pox.core import core
 from pox.openflow.libopenflow_01 import *
+from pox.lib.recoco import Timer
 import pymongo as mongo
 
 import rflib.ipc.IPC as IPC
-import rflib.ipc.MongoIPC as MongoIPC
+from rflib.ipc.IPCServiceFactory import IPCServiceFactory
+from rflib.ipc.MongoClientFactory import MongoClientFactory
 from rflib.ipc.RFProtocol import *
 from rflib.ipc.RFProtocolFactory import RFProtocolFactory
 from rflib.defs import *
@@ -17,93 +20,323 @@ from rfofmsg import *
 FAILURE = 0
 SUCCESS = 1
 
+# Packets are relayed without being parsed: only the ethertype is read and
+# packet-outs are packed from this template (header, no buffer, no input
+# port, a single output action) followed by the packet data
+ETHERTYPE = struct.Struct("!H")
+PACKET_OUT = struct.Struct("!BBHIIHHHHHH")
+# vm_id and vm_port in the payload of RF mapping packets
+MAP_PAYLOAD = struct.Struct("QB")
+# xid of a packed OpenFlow message
+XID = struct.Struct("!4xL")
+
+# Seconds between flushes of queued flow mods
+FLUSH_INTERVAL = 0.01
+# Flow mods queued for a datapath before it is flushed without waiting
+MAX_QUEUED_FLOW_MODS = 1024
+# Seconds between flow installation reports to RFServer
+STATUS_INTERVAL = 5
+# Seconds between the ControllerRegister heartbeats sent to RFMonitor
+HEARTBEAT_INTERVAL = 5
+
 # Association table
 class Table:
+    """Maps datapath ports to RFVS ports and back.
+
+    Both directions are nested by switch ID ({dp_id: {dp_port: (vs_id,
+    vs_port)}} and {vs_id: {vs_port: (dp_id, dp_port)}}), so the mappings
+    of a switch are removed in time proportional to its port count when it
+    goes down, and a packet from a switch that came back before RFServer
+    remapped it isn't relayed to a stale port.
+    """
     def __init__(self):
         self.dp_to_vs = {}
         self.vs_to_dp = {}
 
     def update_dp_port(self, dp_id, dp_port, vs_id, vs_port):
-        # If there was a mapping for this DP port, reset it
-        if (dp_id, dp_port) in self.dp_to_vs:
-            old_vs_port = self.dp_to_vs[(dp_id, dp_port)]
-            del self.vs_to_dp[old_vs_port]
-        self.dp_to_vs[(dp_id, dp_port)] = (vs_id, vs_port)
-        self.vs_to_dp[(vs_id, vs_port)] = (dp_id, dp_port)
+        # Reset the previous mappings of both ports
+        old_vs_port = self._pop(self.dp_to_vs, dp_id, dp_port)
+        if old_vs_port is not None:
+            self._pop(self.vs_to_dp, *old_vs_port)
+        old_dp_port = self._pop(self.vs_to_dp, vs_id, vs_port)
+        if old_dp_port is not None:
+            self._pop(self.dp_to_vs, *old_dp_port)
+        self.dp_to_vs.setdefault(dp_id, {})[dp_port] = (vs_id, vs_port)
+        self.vs_to_dp.setdefault(vs_id, {})[vs_port] = (dp_id, dp_port)
 
     def dp_port_to_vs_port(self, dp_id, dp_port):
         try:
-            return self.dp_to_vs[(dp_id, dp_port)]
+            return self.dp_to_vs[dp_id][dp_port]
         except KeyError:
             return None
 
     def vs_port_to_dp_port(self, vs_id, vs_port):
         try:
-            return self.vs_to_dp[(vs_id, vs_port)]
+            return self.vs_to_dp[vs_id][vs_port]
         except KeyError:
             return None
 
     def delete_dp(self, dp_id):
-        for (id_, port) in self.dp_to_vs.keys():
-            if id_ == dp_id:
-                del self.dp_to_vs[(id_, port)]
-
-        for key in self.vs_to_dp.keys():
-            id_, port = self.vs_to_dp[key]
-            if id_ == dp_id:
-                del self.vs_to_dp[key]
-
-    # We're not considering the case of this table becoming invalid when a
-    # datapath goes down. When the datapath comes back, the server recreates
-    # the association, forcing new map messages to be generated, overriding the
-    # previous mapping.
-    # If a packet comes and matches the invalid mapping, it can be redirected
-    # to the wrong places. We have to fix this.
+        # The ID may be a datapath's or RFVS's
+        for (vs_id, vs_port) in self.dp_to_vs.pop(dp_id, {}).values():
+            self._pop(self.vs_to_dp, vs_id, vs_port)
+        for (id_, port) in self.vs_to_dp.pop(dp_id, {}).values():
+            self._pop(self.dp_to_vs, id_, port)
+
+    def _pop(self, mapping, id_, port):
+        ports = mapping.get(id_)
+        if ports is None:
+            return None
+        value = ports.pop(port, None)
+        if not ports:
+            mapping.pop(id_, None)
+        return value
+
+# Flow mod batching
+class FlowModBatcher:
+    """Sends flow mods to each datapath in batches.
+
+    Flow mods are queued per datapath and flushed on every scheduler tick as
+    a single buffer that ends with a barrier request. Errors for a batch
+    arrive before its barrier reply, so the reply tells how many of its flow
+    mods were installed. While the send buffer of a datapath is full its
+    flow mods stay queued here.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.queues = {}
+        # Barrier xid -> (dp_id, xids of the flow mods in the batch)
+        self.barriers = {}
+        # dp_id -> xids of errors received while batches are outstanding
+        self.errors = {}
+        # dp_id -> installation counters
+        self.stats = {}
+        # Datapaths between SendBufferFull and SendBufferDrained
+        self.blocked = set()
+
+    def queue(self, dp_id, ofmsg):
+        with self.lock:
+            queue = self.queues.setdefault(dp_id, [])
+            queue.append(ofmsg)
+            full = len(queue) >= MAX_QUEUED_FLOW_MODS
+        if full:
+            self.flush(dp_id)
+
+    def flush(self, dp_id=None):
+        # Batches for a datapath must be sent in the order they were queued
+        with self.flush_lock:
+            with self.lock:
+                if dp_id is None:
+                    queues = dict((d, self.queues.pop(d))
+                                  for d in self.queues.keys()
+                                  if d not in self.blocked)
+                elif dp_id in self.blocked:
+                    queues = {}
+                else:
+                    queues = {dp_id: self.queues.pop(dp_id, [])}
+            for (dp_id, queue) in queues.items():
+                if queue:
+                    self._send_batch(dp_id, queue)
+
+    def _send_batch(self, dp_id, queue):
+        # Flow mods may be queued already packed (by ofp_flow_mod_template)
+        packed = [ofmsg if type(ofmsg) is bytes else ofmsg.pack()
+                  for ofmsg in queue]
+        barrier = ofp_barrier_request()
+        data = b"".join(packed) + barrier.pack()
+        with self.lock:
+            self.barriers[barrier.xid] = (dp_id,
+                                          [XID.unpack_from(ofmsg)[0]
+                                           for ofmsg in packed])
+            self._get_stats(dp_id)["pending"] += len(queue)
+        if send_of_msg(dp_id, data) == SUCCESS:
+            log.info("Sent %d flow mods to datapath (dp_id=%s)",
+                     len(queue), format_id(dp_id))
+        else:
+            with self.lock:
+                if self.barriers.pop(barrier.xid, None) is not None:
+                    stats = self._get_stats(dp_id)
+                    stats["pending"] -= len(queue)
+                    stats["failed"] += len(queue)
+            log.info("Error sending %d flow mods to datapath (dp_id=%s)",
+                     len(queue), format_id(dp_id))
+
+    def on_barrier_in(self, event):
+        with self.lock:
+            batch = self.barriers.pop(event.xid, None)
+            if batch is None:
+                return
+            dp_id, xids = batch
+            errors = self.errors.get(dp_id, set())
+            failed = len(errors.intersection(xids))
+            if not any(d == dp_id for (d, _) in self.barriers.values()):
+                self.errors.pop(dp_id, None)
+            stats = self._get_stats(dp_id)
+            stats["pending"] -= len(xids)
+            stats["installed"] += len(xids) - failed
+            stats["failed"] += failed
+
+    def on_send_buffer_full(self, event):
+        with self.lock:
+            self.blocked.add(event.dpid)
+        log.info("Holding flow mods for datapath (dp_id=%s)",
+                 format_id(event.dpid))
+
+    def on_send_buffer_drained(self, event):
+        with self.lock:
+            self.blocked.discard(event.dpid)
+        self.flush(event.dpid)
+
+    def on_error_in(self, event):
+        dp_id = event.connection.dpid
+        with self.lock:
+            if any(d == dp_id for (d, _) in self.barriers.values()):
+                self.errors.setdefault(dp_id, set()).add(event.xid)
+
+    def backlog(self):
+        """Return the number of flow mods queued or awaiting their barrier"""
+        with self.lock:
+            return (sum(len(queue) for queue in self.queues.values()) +
+                    sum(len(xids) for (_, xids) in self.barriers.values()))
+
+    def delete_dp(self, dp_id):
+        with self.lock:
+            self.queues.pop(dp_id, None)
+            self.blocked.discard(dp_id)
+            self.errors.pop(dp_id, None)
+            self.stats.pop(dp_id, None)
+            for (xid, (d, _)) in self.barriers.items():
+                if d == dp_id:
+                    del self.barriers[xid]
+
+    def report(self):
+        """Send the installation counters that changed to RFServer"""
+        now = time.time()
+        with self.lock:
+            changed = []
+            for (dp_id, stats) in self.stats.items():
+                state = (stats["installed"], stats["failed"],
+                         stats["pending"])
+                if state == stats["reported"]:
+                    continue
+                rate = ((stats["installed"] - stats["reported"][0]) /
+                        (now - stats["report_time"]))
+                stats["reported"] = state
+                stats["report_time"] = now
+                changed.append((dp_id, state, rate))
+        for (dp_id, (installed, failed, pending), rate) in changed:
+            msg = DatapathFlowStatus(ct_id=ID, dp_id=dp_id,
+                                     installed=installed, failed=failed,
+                                     pending=pending, install_rate=int(rate))
+            ipc.send(RFSERVER_RFPROXY_CHANNEL, RFSERVER_ID, msg)
+
+    def _get_stats(self, dp_id):
+        if dp_id not in self.stats:
+            self.stats[dp_id] = {"installed": 0, "failed": 0, "pending": 0,
+                                 "reported": (0, 0, 0),
+                                 "report_time": time.time()}
+        return self.stats[dp_id]
+
+class MasterElection:
+    """Reports this controller to RFMonitor and follows its elections.
+
+    RFMonitor splits datapaths into shards (dp_id % shards) and elects a
+    master controller for each of them. Until it has elected one, this
+    controller acts as the master of every datapath.
+    """
+    def __init__(self, role="slave", host=None):
+        self.role = role
+        # Host advertised to RFMonitor, of_01's if None
+        self.host = host
+        self.address = None
+        self.shards = 0
+        self.masters = {}
+        self.packet_ins = 0
+        self.reported = (time.time(), 0)
+
+    def is_master(self, dp_id):
+        if not self.shards:
+            return True
+        return self.masters.get(dp_id % self.shards) == self.address
+
+    def heartbeat(self):
+        """Send RFMonitor the load of this controller"""
+        if self.address is None:
+            self.address = (self.advertised_host(), core.of_01.port)
+        now = time.time()
+        (last_time, last_packet_ins) = self.reported
+        rate = (self.packet_ins - last_packet_ins) / max(now - last_time, 1e-3)
+        self.reported = (now, self.packet_ins)
+        msg = ControllerRegister(ct_addr=self.address[0],
+                                 ct_port=self.address[1], ct_role=self.role,
+                                 ct_datapaths=len(connections),
+                                 ct_backlog=batcher.backlog(),
+                                 ct_packet_in_rate=int(rate))
+        ipc.send(RFMONITOR_RFPROXY_CHANNEL, RFMONITOR_ID, msg)
+
+    def advertised_host(self):
+        host = self.host or core.of_01.address
+        if host == "0.0.0.0":
+            # Listening on every interface, which RFMonitor can't connect to
+            host = socket.gethostbyname(socket.gethostname())
+        return host
+
+    def elect(self, msg):
+        shards = max(1, msg.get_shards())
+        if shards != self.shards:
+            self.shards = shards
+            self.masters = {}
+        master = (msg.get_ct_addr(), msg.get_ct_port())
+        self.masters[msg.get_shard()] = master
+        if master == self.address:
+            self.role = "master"
+            log.info("Elected master of shard %d/%d", msg.get_shard(), shards)
+        elif self.address not in self.masters.values():
+            self.role = "slave"
 
 netmask_prefix = lambda a: sum([bin(int(x)).count("1") for x in a.split(".", 4)])
 
 # TODO: add proper support for ID
 ID = 0
-ipc = MongoIPC.MongoIPCMessageService(MONGO_ADDRESS, MONGO_DB_NAME, str(ID),
-                                      threading.Thread, time.sleep)
+ipc = IPCServiceFactory.make(proxy_id(ID), threading.Thread, time.sleep)
 table = Table()
+# Connection of each datapath, kept from ConnectionUp to ConnectionDown
+connections = {}
+batcher = FlowModBatcher()
+election = MasterElection()
 
 # Logging
 log = core.getLogger("rfproxy")
 
 # Base methods
 def send_of_msg(dp_id, ofmsg):
-    topology = core.components['topology']
-    switch = topology.getEntityByID(dp_id)
-    if switch is not None and switch.connected:
-        try:
-            switch.send(ofmsg)
-        except:
-            return FAILURE
-        return SUCCESS
-    else:
+    connection = connections.get(dp_id)
+    if connection is None:
+        # The datapath may be connected to another POX shard
+        if core.of_01.forward(dp_id, ofmsg):
+            return SUCCESS
         return FAILURE
+    try:
+        connection.send(ofmsg)
+    except:
+        return FAILURE
+    return SUCCESS
+
+def pack_packet_out(port, data):
+    return PACKET_OUT.pack(OFP_VERSION, OFPT_PACKET_OUT,
+                           PACKET_OUT.size + len(data), generate_xid(),
+                           NO_BUFFER, OFPP_NONE, 8, OFPAT_OUTPUT, 8, port,
+                           0) + data
 
 def send_packet_out(dp_id, port, data):
-    msg = ofp_packet_out()
-    msg.actions.append(ofp_action_output(port=port))
-    msg.data = data
-    msg.in_port = OFPP_NONE
-    topology = core.components['topology']
-    switch = topology.getEntityByID(dp_id)
-    if switch is not None and switch.connected:
-        try:
-            switch.send(msg)
-        except:
-            return FAILURE
-        return SUCCESS
-    else:
-        return FAILURE
+    return send_of_msg(dp_id, pack_packet_out(port, data))
 
 # Event handlers
 def on_datapath_up(event):
     topology = core.components['topology']
     dp_id = event.dpid
+    connections[dp_id] = event.connection
 
     ports = topology.getEntityByID(dp_id).ports
     for port in ports:
@@ -118,23 +351,40 @@ def on_datapath_down(event):
 
     log.info("Datapath is down (dp_id=%s)", format_id(dp_id))
 
+    # The datapath may have reconnected before the old connection went down
+    if connections.get(dp_id) is event.connection:
+        del connections[dp_id]
     table.delete_dp(dp_id)
+    batcher.delete_dp(dp_id)
 
     msg = DatapathDown(ct_id=ID, dp_id=dp_id)
     ipc.send(RFSERVER_RFPROXY_CHANNEL, RFSERVER_ID, msg)
 
 def on_packet_in(event):
-    packet = event.parsed
+    # Use the raw data: event.parsed would decode every header of the packet
+    data = event.data
     dp_id = event.dpid
     in_port = event.port
 
+    election.packet_ins += 1
+    # Packets are relayed by the master of the datapath
+    if not election.is_master(dp_id):
+        return
+    if len(data) < 14:
+        return
+    (ethertype,) = ETHERTYPE.unpack_from(data, 12)
+
     # Drop all LLDP packets
-    if packet.type == ethernet.LLDP_TYPE:
+    if ethertype == ethernet.LLDP_TYPE:
         return
 
     # If we have a mapping packet, inform RFServer through a Map message
-    if packet.type == RF_ETH_PROTO:
-        vm_id, vm_port = struct.unpack("QB", packet.raw[14:])
+    if ethertype == RF_ETH_PROTO:
+        if len(data) < 14 + MAP_PAYLOAD.size:
+            log.warning("Dropping short mapping packet (%d bytes) from "
+                        "datapath %s", len(data), format_id(dp_id))
+            return
+        vm_id, vm_port = MAP_PAYLOAD.unpack_from(data, 14)
 
         log.info("Received mapping packet (vm_id=%s, vm_port=%d, vs_id=%s, vs_port=%d)",
                  format_id(vm_id), vm_port, event.dpid, event.port)
@@ -149,7 +399,7 @@ def on_packet_in(event):
         dp_port = table.vs_port_to_dp_port(dp_id, in_port)
         if dp_port is not None:
             dp_id, dp_port = dp_port
-            send_packet_out(dp_id, dp_port, event.data)
+            send_packet_out(dp_id, dp_port, data)
         else:
             log.debug("Unmapped RFVS port (vs_id=%s, vs_port=%d)",
                       format_id(dp_id), in_port)
@@ -158,7 +408,7 @@ def on_packet_in(event):
         vs_port = table.dp_port_to_vs_port(dp_id, in_port)
         if vs_port is not None:
             vs_id, vs_port = vs_port
-            send_packet_out(vs_id, vs_port, event.data)
+            send_packet_out(vs_id, vs_port, data)
         else:
             log.debug("Unmapped datapath port (dp_id=%s, dp_port=%d)",
                       format_id(dp_id), in_port)
@@ -166,29 +416,50 @@ def on_packet_in(event):
 # IPC message Processing
 class RFProcessor(IPC.IPCMessageProcessor):
     def process(self, from_, to, channel, msg):
-        topology = core.components['topology']
         type_ = msg.get_type()
         if type_ == ROUTE_MOD:
+            if not election.is_master(msg.get_id()):
+                return True
             try:
                 ofmsg = create_flow_mod(msg)
             except Warning as e:
-                log.info("Error creating FlowMod: {}" % str(e))
-            if send_of_msg(msg.get_id(), ofmsg) == SUCCESS:
-                log.info("routemod sent to datapath (dp_id=%s)",
-                         format_id(msg.get_id()))
+                log.info("Error creating FlowMod: %s" % str(e))
+                return True
+            if core.of_01.owns(msg.get_id()):
+                batcher.queue(msg.get_id(), ofmsg)
             else:
-                log.info("Error sending routemod to datapath (dp_id=%s)",
-                         format_id(msg.get_id()))
+                # Sent before RFServer learned which shard has the datapath
+                send_of_msg(msg.get_id(), ofmsg)
         if type_ == DATA_PLANE_MAP:
             table.update_dp_port(msg.get_dp_id(), msg.get_dp_port(),
                                  msg.get_vs_id(), msg.get_vs_port())
+        if type_ == ELECT_MASTER:
+            election.elect(msg)
 
         return True
 
 # Initialization
-def launch ():
+def start_ipc ():
+    # Each shard gets the messages for its own datapaths
+    ipc.set_id(proxy_id(ID, getattr(core.of_01, "shard", None)))
+    ipc.listen(RFSERVER_RFPROXY_CHANNEL, RFProtocolFactory(), RFProcessor(), False)
+    ipc.listen(RFMONITOR_RFPROXY_CHANNEL, RFProtocolFactory(), RFProcessor(), False)
+
+def launch (role = "slave", address = None):
+    election.role = role
+    election.host = address
     core.openflow.addListenerByName("ConnectionUp", on_datapath_up)
     core.openflow.addListenerByName("ConnectionDown", on_datapath_down)
     core.openflow.addListenerByName("PacketIn", on_packet_in)
-    ipc.listen(RFSERVER_RFPROXY_CHANNEL, RFProtocolFactory(), RFProcessor(), False)
+    core.openflow.addListenerByName("BarrierIn", batcher.on_barrier_in)
+    core.openflow.addListenerByName("ErrorIn", batcher.on_error_in)
+    core.openflow.addListenerByName("SendBufferFull",
+                                    batcher.on_send_buffer_full)
+    core.openflow.addListenerByName("SendBufferDrained",
+                                    batcher.on_send_buffer_drained)
+    Timer(FLUSH_INTERVAL, batcher.flush, recurring=True)
+    Timer(STATUS_INTERVAL, batcher.report, recurring=True)
+    Timer(HEARTBEAT_INTERVAL, election.heartbeat, recurring=True)
+    core.call_when_ready(start_ipc, "of_01")
+    MongoClientFactory.start_reporter(log)
     log.info("RFProxy running.")
@@ -7,50 +7,104 @@ from pox.openflow.discovery import *
 from pox.lib.addresses import *
 from pox.topology.topology import *
 import time
+import random
 import json
 import pymongo
 
+from rflib.ipc.MongoClientFactory import MongoClientFactory
+from rfcounters import CounterStore, DOWNSAMPLE_INTERVAL, PERSIST_INTERVAL
+
 UPDATE_INTERVAL = 5
 topology_timer = None
+# Polling timer of each connected switch, see handle_connection_up()
+poll_timers = {}
 
 log = core.getLogger("rfproxy")
 
 def rf_id(id):
     return "{:#016x}".format(id)
 
+# Flow counters that change while a flow is installed but aren't compared to
+# decide whether it has to be written again
+FLOW_DURATION = ("duration_sec", "duration_nsec")
+
 class StatsDB:
     def __init__(self):
-        self.db = {}
-        self.connection = pymongo.Connection()
+        self.ids = set()
+        # Flows last written for each switch, {id_: {flow key: flow}}
+        self.flows = {}
+        self.connection = MongoClientFactory.get("localhost")
         self.collection = self.connection.db.rfstats
 
     def update(self, id_, type_, links=None, **data):
-        if id_ not in self.db:
-            if links is None:
-                links = []
-            self.db[id_] = {
-                "type": type_,
-                "links": links,
-                "data": {},}
-        else:
-            self.db[id_]["type"] = type_
-            if links is not None:
-                self.db[id_]["links"] = links
-
+        fields = {"type": type_}
+        if id_ not in self.ids and links is None:
+            links = []
+        if links is not None:
+            fields["links"] = links
         for k, v in data.items():
-            self.db[id_]["data"][k] = v
+            fields["data." + k] = v
+        self.ids.add(id_)
+        self.collection.update({"_id": id_}, {"$set": fields}, upsert=True)
+
+    def update_flows(self, id_, flows):
+        """Write the flows of a switch whose counters changed since the last
+        update, and remove the flows that are gone."""
+        old = self.flows.get(id_)
+        new = {}
+        for flow in flows:
+            new[StatsDB.flow_key(flow)] = StatsDB.create_flow_stats_dict(flow)
+        self.flows[id_] = new
+
+        if old is None:
+            # Replace whatever was stored before this switch connected
+            self.update(id_, "switch", flows=new)
+            return
+        fields = {}
+        for (key, flow) in new.items():
+            if key not in old or not StatsDB.same_flow(old[key], flow):
+                fields["data.flows." + key] = flow
+        removed = dict(("data.flows." + key, 1) for key in old
+                       if key not in new)
+        document = {}
+        if fields:
+            document["$set"] = fields
+        if removed:
+            document["$unset"] = removed
+        if document:
+            self.collection.update({"_id": id_}, document, upsert=True)
 
-        self.db[id_]["_id"] = id_
-        self.collection.update({"_id": id_}, self.db[id_], upsert=True)
+    def reset_flows(self, id_):
+        self.flows.pop(id_, None)
 
     def delete(self, id_):
         try:
-            del self.db[id_]
+            self.ids.remove(id_)
+            self.flows.pop(id_, None)
             self.collection.remove(id_)
             return True
         except:
             return False
-            
+
+    @staticmethod
+    def same_flow(a, b):
+        for k in a:
+            if k not in FLOW_DURATION and a[k] != b.get(k):
+                return False
+        return True
+
+    @staticmethod
+    def flow_key(flow):
+        # A flow is identified by its table, priority and match
+        return "%d-%d-%s" % (flow.table_id, flow.priority,
+                             flow.match.pack().encode("hex"))
+
+    @staticmethod
+    def create_value(value):
+        if isinstance(value, (int, long, basestring)):
+            return value
+        return str(value)
+
     @staticmethod
     def create_desc_stats_dict(desc):
         return {
@@ -63,50 +117,46 @@ class StatsDB:
 
     @staticmethod
     def create_match_dict(match):
-        # TODO: do this properly and not depending on POX behavior
-        match = match.show().strip("\n").split("\n")            
-        result = dict([attr.split(": ") for attr in match])
-        try:
-            w = result["wildcards"]
-            p = w[w.find("nw_dst"):]
-            s = p.find("(") + 2 # Strip (/
-            e = p.find(")")
-            netmask = int(p[s:e])
-        except:
-            netmask = 0
-        if netmask != 0 and "nw_dst" in result:
-            result["nw_dst"] = result["nw_dst"] + "/" + str(netmask)
+        result = {}
+        for field in ofp_match_data:
+            value = getattr(match, field)
+            if value is None:
+                continue
+            if field in ("nw_src", "nw_dst"):
+                addr, prefix = getattr(match, "get_" + field)()
+                value = str(addr)
+                if prefix < 32:
+                    value += "/" + str(prefix)
+            result[field] = StatsDB.create_value(value)
         return result
-        
+
     @staticmethod
     def create_actions_list(actions):
-        # TODO: do this properly and not depending on POX behavior
         actionlist = []
         for action in actions:
-            string = action.__class__.__name__ + "["
-            string += action.show().strip("\n").replace("\n", ", ") + "]"
-            actionlist.append(string)
+            result = {"action": action.__class__.__name__}
+            for (k, v) in vars(action).items():
+                if not k.startswith("_"):
+                    result[k] = StatsDB.create_value(v)
+            actionlist.append(result)
         return actionlist
 
     @staticmethod
-    def create_flow_stats_list(flows):
-        flowlist = []
-        for flow in flows:
-            flowlist.append({
-            "length": len(flow),
-            "table_id": flow.table_id,
-            "match": StatsDB.create_match_dict(flow.match),
-            "duration_sec": flow.duration_sec,
-            "duration_nsec": flow.duration_nsec,
-            "priority": flow.priority,
-            "idle_timeout": flow.idle_timeout,
-            "hard_timeout": flow.hard_timeout,
-            "cookie": flow.cookie,
-            "packet_count": flow.packet_count,
-            "byte_count": flow.byte_count,
-            "actions": StatsDB.create_actions_list(flow.actions),
-            })
-        return flowlist
+    def create_flow_stats_dict(flow):
+        return {
+        "length": len(flow),
+        "table_id": flow.table_id,
+        "match": StatsDB.create_match_dict(flow.match),
+        "duration_sec": flow.duration_sec,
+        "duration_nsec": flow.duration_nsec,
+        "priority": flow.priority,
+        "idle_timeout": flow.idle_timeout,
+        "hard_timeout": flow.hard_timeout,
+        "cookie": flow.cookie,
+        "packet_count": flow.packet_count,
+        "byte_count": flow.byte_count,
+        "actions": StatsDB.create_actions_list(flow.actions),
+        }
 
     @staticmethod
     def create_aggregate_stats_dict(aggregate):
@@ -117,23 +167,26 @@ class StatsDB:
         }
 
 db = StatsDB()
+counters = CounterStore()
 
-def timer_func():
-    topology = core.components['topology']
-    for switch in topology.getEntitiesOfType(Switch):
-        if switch.connected:
-            try:
-                # OFPST_DESC
-                req = ofp_stats_request(type=OFPST_DESC)
-                switch.send(req)
-                # OFPST_FLOW
-                req = ofp_stats_request(body=ofp_flow_stats_request())
-                switch.send(req)
-                # OFPST_AGGREGATE
-                req = ofp_stats_request(body=ofp_aggregate_stats_request())
-                switch.send(req)
-            except:
-                log.info("Failed to send stats request to switch")
+def poll_switch(connection):
+    try:
+        # OFPST_FLOW
+        req = ofp_stats_request(body=ofp_flow_stats_request())
+        connection.send(req)
+        # OFPST_AGGREGATE
+        req = ofp_stats_request(body=ofp_aggregate_stats_request())
+        connection.send(req)
+        # OFPST_PORT
+        req = ofp_stats_request(body=ofp_port_stats_request())
+        connection.send(req)
+    except:
+        log.info("Failed to send stats request to switch")
+
+def start_polling(connection):
+    poll_switch(connection)
+    poll_timers[connection.dpid] = Timer(UPDATE_INTERVAL, poll_switch,
+                                         recurring=True, args=[connection])
 
 def handle_switch_desc(event):
     dp_id = rf_id(event.connection.dpid)
@@ -141,12 +194,27 @@ def handle_switch_desc(event):
 
 def handle_flow_stats(event):
     dp_id = rf_id(event.connection.dpid)
-    db.update(dp_id, "switch", flows=StatsDB.create_flow_stats_list(event.stats))
+    db.update_flows(dp_id, event.stats)
+    counters.update(dp_id, "flows", time.time(),
+                    dict((StatsDB.flow_key(flow),
+                          (flow.packet_count, flow.byte_count))
+                         for flow in event.stats))
 
 def handle_aggregate_flow_stats(event):
     dp_id = rf_id(event.connection.dpid)
     db.update(dp_id, "switch", aggregate=StatsDB.create_aggregate_stats_dict(event.stats))
 
+def handle_port_stats(event):
+    dp_id = rf_id(event.connection.dpid)
+    counters.update(dp_id, "ports", time.time(),
+                    dict((str(port.port_no),
+                          (port.rx_packets, port.tx_packets,
+                           port.rx_bytes, port.tx_bytes))
+                         for port in event.stats))
+
+def persist_counters():
+    counters.persist(db.connection.db)
+
 def update_topology():
     topology = core.components['topology']
     rfproxy_links = ["rfserver"]
@@ -180,16 +248,39 @@ def handle_link_event(event):
     topology_timer = Timer(UPDATE_INTERVAL, update_topology, recurring=False)
 
 def handle_connection_up(event):
+    db.reset_flows(rf_id(event.dpid))
     db.update(rf_id(event.dpid), "switch", links=["rfproxy"])
+    try:
+        # OFPST_DESC doesn't change while the switch is connected
+        event.connection.send(ofp_stats_request(type=OFPST_DESC))
+    except:
+        log.info("Failed to send stats request to switch")
+    # Switches are polled at random offsets so that their replies are spread
+    # over the update interval instead of arriving in bursts
+    stop_polling(event.dpid)
+    poll_timers[event.dpid] = Timer(random.uniform(0, UPDATE_INTERVAL),
+                                    start_polling, args=[event.connection])
+
+def handle_connection_down(event):
+    stop_polling(event.dpid)
+    counters.delete(rf_id(event.dpid))
+
+def stop_polling(dpid):
+    timer = poll_timers.pop(dpid, None)
+    if timer is not None:
+        timer.cancel()
 
 def launch():
     core.openflow.addListenerByName("ConnectionUp", handle_connection_up)
+    core.openflow.addListenerByName("ConnectionDown", handle_connection_down)
     core.openflow.addListenerByName("SwitchDescReceived", handle_switch_desc)
     core.openflow.addListenerByName("FlowStatsReceived", handle_flow_stats)
     core.openflow.addListenerByName("AggregateFlowStatsReceived", handle_aggregate_flow_stats)
+    core.openflow.addListenerByName("PortStatsReceived", handle_port_stats)
     core.openflow_discovery.addListenerByName("LinkEvent", handle_link_event)
-    
-    Timer(UPDATE_INTERVAL, timer_func, recurring=True)
+
+    Timer(DOWNSAMPLE_INTERVAL, counters.downsample, recurring=True)
+    Timer(PERSIST_INTERVAL, persist_counters, recurring=True)
 
     db.update("rfserver", "rfserver", links=["rfproxy"])
     db.update("rfproxy", "rfproxy", links=["rfserver"])
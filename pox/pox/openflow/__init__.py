@@ -165,10 +165,14 @@ class PacketIn (Event):
     self.connection = connection
     self.ofp = ofp
     self.port = ofp.in_port
-    self.data = ofp.data
     self._parsed = None
     self.dpid = connection.dpid
 
+  @property
+  def data (self):
+    # Views of packet-ins only copy the data out when it's used
+    return self.ofp.data
+
   def parse (self):
     if self._parsed is None:
       self._parsed = ethernet(self.data)
@@ -234,6 +238,27 @@ class BarrierIn (Event):
     self.dpid = connection.dpid
     self.xid = ofp.xid
 
+class SendBufferFull (Event):
+  """
+  Fired when more than of_01.SEND_HIGH_WATER bytes are waiting to be sent
+  to a switch.  Whoever sends a lot to it should hold off until
+  SendBufferDrained.
+  """
+  def __init__ (self, connection):
+    Event.__init__(self)
+    self.connection = connection
+    self.dpid = connection.dpid
+
+class SendBufferDrained (Event):
+  """
+  Fired after SendBufferFull, once fewer than of_01.SEND_LOW_WATER bytes
+  are waiting to be sent to the switch.
+  """
+  def __init__ (self, connection):
+    Event.__init__(self)
+    self.connection = connection
+    self.dpid = connection.dpid
+
 class ConnectionIn (Event):
   def __init__ (self, connection):
     super(ConnectionIn,self).__init__()
@@ -314,6 +339,8 @@ class OpenFlowNexus (EventMixin):
     PortStatsReceived,
     QueueStatsReceived,
     FlowRemoved,
+    SendBufferFull,
+    SendBufferDrained,
   ])
 
   # Bytes to send to controller when a packet misses all flows
@@ -352,7 +352,8 @@ class Discovery (EventMixin):
       log.warning("Couldn't find a DPID in the LLDP packet")
       return EventHalt
 
-    if originatorDPID not in core.openflow.connections:
+    if (originatorDPID not in core.openflow.connections and
+        originatorDPID not in core.of_01.remote_switches):
       log.info('Received LLDP packet from unknown switch')
       return EventHalt
 
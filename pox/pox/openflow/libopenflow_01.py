@@ -42,6 +42,7 @@ from pox.lib.util import hexdump
 
 
 EMPTY_ETH = EthAddr(None)
+_EMPTY_ETH_RAW = EMPTY_ETH.toRaw()
 
 # ----------------------------------------------------------------------
 # XID Management
@@ -91,10 +92,15 @@ def _read (data, offset, length):
                         % (length, len(data)-offset))
   return (offset+length, data[offset:offset+length])
 
+# Formats passed to _unpack() and their compiled Structs
+_structs = {}
+
 def _unpack (fmt, data, offset):
-  size = struct.calcsize(fmt)
-  if (len(data)-offset) < size: raise UnderrunError()
-  return (offset+size, struct.unpack_from(fmt, data, offset))
+  s = _structs.get(fmt)
+  if s is None:
+    s = _structs[fmt] = struct.Struct(fmt)
+  if (len(data)-offset) < s.size: raise UnderrunError()
+  return (offset+s.size, s.unpack_from(data, offset))
 
 def _skip (data, offset, num):
   offset += num
@@ -521,6 +527,8 @@ NO_BUFFER = 4294967295
 # ----------------------------------------------------------------------
 
 #1. Openflow Header
+_header_fields = struct.Struct("!BBHL")
+
 class ofp_header (ofp_base):
   _MIN_LENGTH = 8
   def __init__ (self, **kw):
@@ -549,19 +557,18 @@ class ofp_header (ofp_base):
   def pack (self):
     assert self._assert()
 
-    packed = b""
-    packed += struct.pack("!BBHL", self.version, self.header_type,
-        len(self), self.xid)
-    return packed
+    return _header_fields.pack(self.version, self.header_type, len(self),
+                               self.xid)
 
   def unpack (self, raw, offset=0):
     offset,length = self._unpack_header(raw, offset)
     return offset,length
 
   def _unpack_header (self, raw, offset):
-    offset,(self.version, self.header_type, length, self.xid) = \
-        _unpack("!BBHL", raw, offset)
-    return offset,length
+    if (len(raw)-offset) < 8: raise UnderrunError()
+    (self.version, self.header_type, length, self.xid) = \
+        _header_fields.unpack_from(raw, offset)
+    return offset+8,length
 
   def __eq__ (self, other):
     if type(self) != type(other): return False
@@ -888,6 +895,9 @@ class ofp_queue_prop_min_rate (ofp_base):
 
 
 ##2.3 Flow Match Structures
+_match_fields = struct.Struct("!LH6s6sHBxHBB2x4s4sHH")
+_uint32 = struct.Struct("!L")
+
 class ofp_match (ofp_base):
   adjust_wildcards = True # Set to true to "fix" outgoing wildcards
 
@@ -1110,50 +1120,36 @@ class ofp_match (ofp_base):
   def pack (self, flow_mod=False):
     assert self._assert()
 
-    packed = b""
     if self.adjust_wildcards and flow_mod:
       wc = self._wire_wildcards(self.wildcards)
     else:
       wc = self.wildcards
-    packed += struct.pack("!LH", wc, self.in_port or 0)
-    if self.dl_src == None:
-      packed += EMPTY_ETH.toRaw()
-    elif type(self.dl_src) is bytes:
-      packed += self.dl_src
-    else:
-      packed += self.dl_src.toRaw()
-    if self.dl_dst == None:
-      packed += EMPTY_ETH.toRaw()
-    elif type(self.dl_dst) is bytes:
-      packed += self.dl_dst
-    else:
-      packed += self.dl_dst.toRaw()
-
-    def check_ip(val):
-      return (val or 0) if self.dl_type == 0x0800 else 0
-    def check_ip_or_arp(val):
-      return (val or 0) if self.dl_type == 0x0800 \
-                           or self.dl_type == 0x0806 else 0
-    def check_tp(val):
-      return (val or 0) if self.dl_type == 0x0800 \
-                           and self.nw_proto in (1,6,17) else 0
-
-    packed += struct.pack("!HB", self.dl_vlan or 0, self.dl_vlan_pcp or 0)
-    packed += _PAD # Hardcode padding
-    packed += struct.pack("!HBB", self.dl_type or 0,
-        check_ip(self.nw_tos), check_ip_or_arp(self.nw_proto))
-    packed += _PAD2 # Hardcode padding
-    def fix (addr):
-      if addr is None: return 0
-      if type(addr) is int: return addr & 0xffFFffFF
-      if type(addr) is long: return addr & 0xffFFffFF
-      return addr.toUnsigned()
-
-    packed += struct.pack("!LLHH", check_ip_or_arp(fix(self.nw_src)),
-        check_ip_or_arp(fix(self.nw_dst)),
-        check_tp(self.tp_src), check_tp(self.tp_dst))
 
-    return packed
+    def eth (addr):
+      if addr is None: return _EMPTY_ETH_RAW
+      if type(addr) is bytes: return addr
+      return addr.toRaw()
+    def ip (addr):
+      if addr is None: return _PAD4
+      if type(addr) is int or type(addr) is long:
+        return _uint32.pack(addr & 0xffFFffFF)
+      return addr.toRaw()
+
+    dl_type = self.dl_type
+    is_ip = dl_type == 0x0800
+    is_ip_or_arp = is_ip or dl_type == 0x0806
+    nw_proto = self.nw_proto
+    is_tp = is_ip and nw_proto in (1,6,17)
+
+    return _match_fields.pack(wc, self.in_port or 0,
+        eth(self.dl_src), eth(self.dl_dst),
+        self.dl_vlan or 0, self.dl_vlan_pcp or 0, dl_type or 0,
+        (self.nw_tos or 0) if is_ip else 0,
+        (nw_proto or 0) if is_ip_or_arp else 0,
+        ip(self.nw_src) if is_ip_or_arp else _PAD4,
+        ip(self.nw_dst) if is_ip_or_arp else _PAD4,
+        (self.tp_src or 0) if is_tp else 0,
+        (self.tp_dst or 0) if is_tp else 0)
 
   def _normalize_wildcards (self, wildcards):
     """
@@ -1236,26 +1232,21 @@ class ofp_match (ofp_base):
     return not self.is_wildcarded
 
   def unpack (self, raw, offset=0, flow_mod=False):
-    _offset = offset
-    offset,(wildcards, self._in_port) = _unpack("!LH",raw, offset)
-    offset,self._dl_src = _readether(raw, offset)
-    offset,self._dl_dst = _readether(raw, offset)
-    offset,(self._dl_vlan, self._dl_vlan_pcp) = \
-        _unpack("!HB", raw, offset)
-    offset = _skip(raw, offset, 1)
-    offset,(self._dl_type, self._nw_tos, self._nw_proto) = \
-        _unpack("!HBB", raw, offset)
-    offset = _skip(raw, offset, 2)
-    offset,self._nw_src = _readip(raw, offset)
-    offset,self._nw_dst = _readip(raw, offset)
-    offset,(self._tp_src, self._tp_dst) = _unpack("!HH", raw, offset)
+    if (len(raw)-offset) < 40: raise UnderrunError()
+    (wildcards, self._in_port, dl_src, dl_dst, self._dl_vlan,
+     self._dl_vlan_pcp, self._dl_type, self._nw_tos, self._nw_proto,
+     nw_src, nw_dst, self._tp_src, self._tp_dst) = \
+        _match_fields.unpack_from(raw, offset)
+    self._dl_src = EthAddr(dl_src)
+    self._dl_dst = EthAddr(dl_dst)
+    self._nw_src = IPAddr(nw_src, networkOrder = True)
+    self._nw_dst = IPAddr(nw_dst, networkOrder = True)
 
     # Only unwire wildcards for flow_mod
     self.wildcards = self._normalize_wildcards(
         self._unwire_wildcards(wildcards) if flow_mod else wildcards)
 
-    assert offset - _offset == len(self)
-    return offset
+    return offset + 40
 
   @staticmethod
   def __len__ ():
@@ -1434,6 +1425,8 @@ class ofp_action_generic (ofp_action_base):
     return outstr
 
 
+_action_output_fields = struct.Struct("!HHHH")
+
 @openflow_action('OFPAT_OUTPUT', 0)
 class ofp_action_output (ofp_action_base):
   def __init__ (self, **kw):
@@ -1448,10 +1441,8 @@ class ofp_action_output (ofp_action_base):
 
     assert self._assert()
 
-    packed = b""
-    packed += struct.pack("!HHHH", self.type, len(self), self.port,
-                          self.max_len)
-    return packed
+    return _action_output_fields.pack(self.type, len(self), self.port,
+                                      self.max_len)
 
   def unpack (self, raw, offset=0):
     _offset = offset
@@ -1645,6 +1636,8 @@ class ofp_action_vlan_pcp (ofp_action_base):
     return outstr
 
 
+_action_dl_addr_fields = struct.Struct("!HH6s6x")
+
 @openflow_action('OFPAT_SET_DL_DST', 5)
 @openflow_action('OFPAT_SET_DL_SRC', 4)
 class ofp_action_dl_addr (ofp_action_base):
@@ -1676,14 +1669,11 @@ class ofp_action_dl_addr (ofp_action_base):
   def pack (self):
     assert self._assert()
 
-    packed = b""
-    packed += struct.pack("!HH", self.type, len(self))
     if isinstance(self.dl_addr, EthAddr):
-      packed += self.dl_addr.toRaw()
+      dl_addr = self.dl_addr.toRaw()
     else:
-      packed += self.dl_addr
-    packed += _PAD6
-    return packed
+      dl_addr = self.dl_addr
+    return _action_dl_addr_fields.pack(self.type, len(self), dl_addr)
 
   def unpack (self, raw, offset=0):
     _offset = offset
@@ -1712,6 +1702,8 @@ class ofp_action_dl_addr (ofp_action_base):
     return outstr
 
 
+_action_nw_addr_fields = struct.Struct("!HHl")
+
 @openflow_action('OFPAT_SET_NW_DST', 7)
 @openflow_action('OFPAT_SET_NW_SRC', 6)
 class ofp_action_nw_addr (ofp_action_base):
@@ -1736,10 +1728,8 @@ class ofp_action_nw_addr (ofp_action_base):
   def pack (self):
     assert self._assert()
 
-    packed = b""
-    packed += struct.pack("!HHl", self.type, len(self),
-                          self.nw_addr.toSigned())
-    return packed
+    return _action_nw_addr_fields.pack(self.type, len(self),
+                                       self.nw_addr.toSigned())
 
   def unpack (self, raw, offset=0):
     _offset = offset
@@ -2126,6 +2116,8 @@ class ofp_set_config (ofp_header): # uses ofp_switch_config
 
 
 ##3.3 Modify State Messages
+_flow_mod_fields = struct.Struct("!QHHHHLHH")
+
 @openflow_c_message("OFPT_FLOW_MOD", 14)
 class ofp_flow_mod (ofp_header):
   _MIN_LENGTH = 72
@@ -2200,10 +2192,10 @@ class ofp_flow_mod (ofp_header):
     packed = b""
     packed += ofp_header.pack(self)
     packed += self.match.pack(flow_mod=True)
-    packed += struct.pack("!QHHHHLHH", self.cookie, self.command,
-                          self.idle_timeout, self.hard_timeout,
-                          self.priority, self._buffer_id, self.out_port,
-                          self.flags)
+    packed += _flow_mod_fields.pack(self.cookie, self.command,
+                                    self.idle_timeout, self.hard_timeout,
+                                    self.priority, self._buffer_id,
+                                    self.out_port, self.flags)
     for i in self.actions:
       packed += i.pack()
 
@@ -2266,6 +2258,122 @@ class ofp_flow_mod (ofp_header):
     return outstr
 
 
+_flow_mod_template_fields = {
+  # Field : (offset, format)
+  'cookie' : (48, struct.Struct("!Q")),
+  'command' : (56, struct.Struct("!H")),
+  'idle_timeout' : (58, struct.Struct("!H")),
+  'hard_timeout' : (60, struct.Struct("!H")),
+  'priority' : (62, struct.Struct("!H")),
+  'out_port' : (68, struct.Struct("!H")),
+  'flags' : (70, struct.Struct("!H")),
+}
+_port_fields = struct.Struct("!HH")
+
+class ofp_flow_mod_template (object):
+  """
+  A flow mod packed once, which packs copies of itself with a few fields
+  changed
+
+  The copies are made by patching the packed flow mod, without creating
+  any ofp objects.  These fields can be changed:
+   * nw_src and nw_dst of the match (an IPAddr, int or "a.b.c.d/n"
+     string, or an (address, prefix length) tuple), if the match's
+     dl_type is IP or ARP
+   * cookie, command, idle_timeout, hard_timeout, priority, out_port
+     and flags
+   * port, the port of the first output action
+   * dl_src and dl_dst, the addresses of the first set_dl_src and
+     set_dl_dst actions
+  Every copy gets a new xid unless one is given.  The template itself
+  can't be changed.
+  """
+  def __init__ (self, flow_mod):
+    assert not flow_mod.data, "flow mods with data can't be templates"
+    packed = flow_mod.pack()
+    self._packed = packed
+    self._wildcards = _uint32.unpack_from(packed, 8)[0]
+    self._is_ip = flow_mod.match.dl_type in (0x0800, 0x0806)
+    self._port = None
+    self._dl_addr = {}
+    offset = 72
+    for a in flow_mod.actions:
+      if isinstance(a, ofp_action_output):
+        if self._port is None: self._port = offset + 4
+      elif isinstance(a, ofp_action_dl_addr):
+        self._dl_addr.setdefault(a.type, offset + 4)
+      offset += len(a)
+
+  @property
+  def packed (self):
+    return self._packed
+
+  def __len__ (self):
+    return len(self._packed)
+
+  def _nw_addr (self, value):
+    if type(value) is tuple:
+      addr,bits = value
+    elif type(value) is str and '/' in value:
+      addr,bits = parse_cidr(value, infer=False)
+    else:
+      addr,bits = value,32
+    if type(addr) is int or type(addr) is long:
+      addr = _uint32.pack(addr & 0xffFFffFF)
+    else:
+      if not isinstance(addr, IPAddr): addr = IPAddr(addr)
+      addr = addr.toRaw()
+    return addr,max(0, min(32, int(bits)))
+
+  def pack (self, nw_src=None, nw_dst=None, port=None, dl_src=None,
+            dl_dst=None, xid=None, **fields):
+    """
+    Returns a packed copy of the flow mod with the given fields changed
+    """
+    packed = bytearray(self._packed)
+    _uint32.pack_into(packed, 4, generate_xid() if xid is None else xid)
+    for name,value in fields.iteritems():
+      field = _flow_mod_template_fields.get(name)
+      if field is None:
+        raise TypeError("%s can't be changed in a flow mod template"
+                        % (name,))
+      field[1].pack_into(packed, field[0], value)
+
+    if nw_src is not None or nw_dst is not None:
+      if not self._is_ip:
+        raise RuntimeError("nw_src and nw_dst need an IP or ARP match")
+      wildcards = self._wildcards
+      if nw_src is not None:
+        addr,bits = self._nw_addr(nw_src)
+        packed[36:40] = addr
+        wildcards &= ~OFPFW_NW_SRC_MASK
+        wildcards |= (32-bits) << OFPFW_NW_SRC_SHIFT
+      if nw_dst is not None:
+        addr,bits = self._nw_addr(nw_dst)
+        packed[40:44] = addr
+        wildcards &= ~OFPFW_NW_DST_MASK
+        wildcards |= (32-bits) << OFPFW_NW_DST_SHIFT
+      _uint32.pack_into(packed, 8, wildcards)
+
+    if port is not None:
+      if self._port is None:
+        raise RuntimeError("flow mod template has no output action")
+      _port_fields.pack_into(packed, self._port, port,
+                             0xffFF if port == OFPP_CONTROLLER else 0)
+
+    for (action_type, addr) in ((OFPAT_SET_DL_SRC, dl_src),
+                                (OFPAT_SET_DL_DST, dl_dst)):
+      if addr is None: continue
+      offset = self._dl_addr.get(action_type)
+      if offset is None:
+        raise RuntimeError("flow mod template has no %s action"
+                           % (ofp_action_type_map[action_type],))
+      if not isinstance(addr, EthAddr): addr = EthAddr(addr)
+      packed[offset:offset+6] = addr.toRaw()
+
+    return bytes(packed)
+
+
 @openflow_c_message("OFPT_PORT_MOD", 15)
 class ofp_port_mod (ofp_header):
   def __init__ (self, **kw):
@@ -4168,6 +4276,248 @@ class ofp_get_config_reply (ofp_header): # uses ofp_switch_config
     return outstr
 
 
+# ----------------------------------------------------------------------
+# Lazy message views
+#
+# A view is a subclass of a message class which unpacks a message by only
+# reading its header.  Its other fields are decoded from the message's
+# bytes the first time they are used, and its payload is also available
+# as a memoryview slice of them, so it needn't be copied at all.  Fields
+# can still be assigned, and pack() decodes whatever it needs.
+# ----------------------------------------------------------------------
+
+_view_classes = {}
+
+def openflow_view (cls):
+  """
+  Class decorator for views
+
+  The view replaces the fields named in its _lazy map with descriptors
+  that decode them, and is registered as the view of its message class.
+  """
+  for decode,names in cls._lazy.iteritems():
+    for name in names:
+      setattr(cls, name, _lazy_field(name, names, getattr(cls, decode)))
+  _view_classes[cls.__bases__[-1]] = cls
+  return cls
+
+def view_class (cls):
+  """
+  Returns the view class of a message class (or the class itself)
+  """
+  return _view_classes.get(cls, cls)
+
+
+class _lazy_field (object):
+  """
+  Descriptor for a field of a view
+
+  Decoding sets the field, and the others decoded along with it, in the
+  view's __dict__, where they hide their descriptors from then on.
+  Fields that were assigned in the meantime are left alone.
+  """
+  def __init__ (self, name, names, decode):
+    self.name = name
+    self.names = names
+    self.decode = decode
+
+  def __get__ (self, view, cls):
+    if view is None: return self
+    d = view.__dict__
+    for name,value in zip(self.names, self.decode(view)):
+      d.setdefault(name, value)
+    return d[self.name]
+
+
+class ofp_view_base (object):
+  """
+  Base class for views
+
+  Views are created by unpacking, which leaves raw (a str) referenced by
+  the view.  _lazy maps the names of decoding methods to the fields each
+  of them returns.
+  """
+  _lazy = {}
+
+  def __init__ (self):
+    pass
+
+  def _unpack_view (self, raw, offset, length):
+    if (len(raw)-offset) < length:
+      raise UnderrunError("wanted %s bytes but only have %s"
+                          % (length, len(raw)-offset))
+    self._raw = raw
+    self._start = offset
+    self._length = length
+    return offset + length
+
+  def _slice (self, start, end):
+    return memoryview(self._raw)[self._start+start:self._start+end]
+
+  def unpack (self, raw, offset=0):
+    offset,length = self._unpack_header(raw, offset)
+    if length < len(type(self)):
+      raise RuntimeError("%s is too short (%s bytes)"
+                         % (type(self).__name__, length))
+    return self._unpack_view(raw, offset - 8, length),length
+
+
+_packet_in_fields = struct.Struct("!8xLHHB")
+
+@openflow_view
+class ofp_packet_in_view (ofp_view_base, ofp_packet_in):
+  _lazy = {
+    '_decode_fields' : ('_buffer_id', '_total_len', 'in_port', 'reason'),
+    '_decode_data' : ('_data',),
+  }
+
+  def _decode_fields (self):
+    return _packet_in_fields.unpack_from(self._raw, self._start)
+
+  def _decode_data (self):
+    return (self.data_view.tobytes(),)
+
+  @property
+  def data_view (self):
+    """
+    The packet as a memoryview
+    """
+    if '_data' in self.__dict__:
+      return memoryview(self._data)
+    return self._slice(18, self._length)
+
+  def __len__ (self):
+    if '_data' not in self.__dict__:
+      return self._length
+    return ofp_packet_in.__len__(self)
+
+
+_flow_removed_fields = struct.Struct("!48xQHBxLLH2xQQ")
+
+@openflow_view
+class ofp_flow_removed_view (ofp_view_base, ofp_flow_removed):
+  _lazy = {
+    '_decode_fields' : ('cookie', 'priority', 'reason', 'duration_sec',
+                        'duration_nsec', 'idle_timeout', 'packet_count',
+                        'byte_count'),
+    '_decode_match' : ('match',),
+  }
+
+  def _decode_fields (self):
+    return _flow_removed_fields.unpack_from(self._raw, self._start)
+
+  def _decode_match (self):
+    match = ofp_match()
+    match.unpack(self._raw, self._start + 8)
+    return (match,)
+
+
+@openflow_view
+class ofp_port_status_view (ofp_view_base, ofp_port_status):
+  _lazy = {
+    '_decode_reason' : ('reason',),
+    '_decode_desc' : ('desc',),
+  }
+
+  def _decode_reason (self):
+    return (ord(self._raw[self._start + 8]),)
+
+  def _decode_desc (self):
+    desc = ofp_phy_port()
+    desc.unpack(self._raw, self._start + 16)
+    return (desc,)
+
+
+_flow_stats_length = struct.Struct("!H")
+_flow_stats_fields = struct.Struct("!2xB41xLLHHH6xQQQ")
+
+@openflow_view
+class ofp_flow_stats_view (ofp_view_base, ofp_flow_stats):
+  _lazy = {
+    '_decode_fields' : ('table_id', 'duration_sec', 'duration_nsec',
+                        'priority', 'idle_timeout', 'hard_timeout',
+                        'cookie', 'packet_count', 'byte_count'),
+    '_decode_match' : ('match',),
+    '_decode_actions' : ('actions',),
+  }
+
+  def unpack (self, raw, offset, avail):
+    if avail < 2: raise UnderrunError()
+    (length,) = _flow_stats_length.unpack_from(raw, offset)
+    if length < 88 or length > avail:
+      raise RuntimeError("Bad flow stats length (%s)" % (length,))
+    return self._unpack_view(raw, offset, length)
+
+  def _decode_fields (self):
+    return _flow_stats_fields.unpack_from(self._raw, self._start)
+
+  def _decode_match (self):
+    match = ofp_match()
+    match.unpack(self._raw, self._start + 4)
+    return (match,)
+
+  def _decode_actions (self):
+    return (_unpack_actions(self._raw, self._length - 88,
+                            self._start + 88)[1],)
+
+  def __len__ (self):
+    if 'actions' not in self.__dict__:
+      return self._length
+    return ofp_flow_stats.__len__(self)
+
+
+_stats_reply_fields = struct.Struct("!8xHH")
+
+@openflow_view
+class ofp_stats_reply_view (ofp_view_base, ofp_stats_reply):
+  """
+  The body is decoded into views where there are any (for flow stats)
+  """
+  _lazy = {
+    '_decode_fields' : ('type', 'flags'),
+    '_decode_body' : ('body',),
+  }
+
+  def __init__ (self):
+    self._body_data = (None, None)
+
+  def _decode_fields (self):
+    return _stats_reply_fields.unpack_from(self._raw, self._start)
+
+  def _decode_body (self):
+    raw = self._raw
+    offset = self._start + 12
+    end = self._start + self._length
+    t = _stats_type_to_class_info.get(self.type)
+    if t is None or t.reply is None:
+      return (raw[offset:end],)
+    cls = view_class(t.reply)
+    if not t.reply_is_list:
+      body = cls()
+      body.unpack(raw, offset, end - offset)
+      return (body,)
+    body = []
+    while offset < end:
+      part = cls()
+      next_offset = part.unpack(raw, offset, end - offset)
+      assert next_offset > offset
+      offset = next_offset
+      body.append(part)
+    return (body,)
+
+  @property
+  def body_view (self):
+    """
+    The undecoded body as a memoryview
+    """
+    return self._slice(12, self._length)
+
+  def __len__ (self):
+    if 'body' not in self.__dict__:
+      return self._length
+    return ofp_stats_reply.__len__(self)
+
+
 def _unpack_queue_props (b, length, offset=0):
   """
   Parses queue props from a buffer
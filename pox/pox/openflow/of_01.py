@@ -42,24 +42,30 @@ import select
 # type into a message object.
 unpackers = make_type_to_unpacker_table()
 
-try:
-  PIPE_BUF = select.PIPE_BUF
-except:
-  try:
-    # Try to get it from where PyPy (sometimes) has it
-    import IN
-    PIPE_BUF = IN.PIPE_BUF
-  except:
-    # (Hopefully) reasonable default
-    PIPE_BUF = 512
-
 import pox.openflow.libopenflow_01 as of
 
 import threading
 import os
 import sys
+import struct
 import exceptions
-from errno import EAGAIN, ECONNRESET
+from errno import EAGAIN, EWOULDBLOCK, ECONNRESET, EEXIST
+
+# Initial and largest size of the receive buffer of a connection.  The
+# buffer doubles while reads fill it and halves when they use little of it.
+RECV_BUFFER_MIN = 4096
+RECV_BUFFER_MAX = 256 * 1024
+
+# Reads from one connection in an I/O cycle before the others get a turn
+MAX_READS_PER_CYCLE = 16
+
+# Bytes queued for a switch above which SendBufferFull is raised, and
+# below which SendBufferDrained is raised after that
+SEND_HIGH_WATER = 1024 * 1024
+SEND_LOW_WATER = 256 * 1024
+
+# Version, type and length fields of the OpenFlow header
+_header = struct.Struct("!BBH")
 
 
 import traceback
@@ -272,113 +278,54 @@ statsHandlerMap = {
   of.OFPST_QUEUE : handle_OFPST_QUEUE,
 }
 
-# Deferred sending should be unusual, so don't worry too much about
-# efficiency
-class DeferredSender (threading.Thread):
+class PendingOutput (object):
   """
-  Class that handles sending when a socket write didn't complete
+  Keeps the connections that have data to send.
+
+  The OpenFlow task flushes them at the end of each I/O cycle, so all the
+  messages queued for a switch in a cycle go out with a single send().
+  Sends made while the task isn't in a cycle (from timers or other
+  threads) wake it up.
   """
   def __init__ (self):
-    # Threads, not recoco?
-    threading.Thread.__init__(self)
-    self._dataForConnection = {}
-    self._lock = threading.RLock()
-    self._waker = pox.lib.util.makePinger()
-    self.daemon = True
-    self.sending = False
-
-    self.start()
+    self._lock = threading.Lock()
+    self._connections = set()
+    self._in_cycle = False
+    self._pinged = False
+    self.pinger = None # Set by the OpenFlow task
 
-  def _sliceup (self, data):
-    """
-    Takes an array of data bytes, and slices into elements of
-    PIPE_BUF bytes each
-    """
-    out = []
-    while len(data) > PIPE_BUF:
-      out.append(data[0:PIPE_BUF])
-      data = data[PIPE_BUF:]
-    if len(data) > 0:
-      out.append(data)
-    return out
-
-  def send (self, con, data):
+  def add (self, con):
     with self._lock:
-      self.sending = True
-
-      data = self._sliceup(data)
-
-      if con not in self._dataForConnection:
-        self._dataForConnection[con] = data
-      else:
-        self._dataForConnection[con].extend(data)
-
-      self._waker.ping()
+      self._connections.add(con)
+      if self._in_cycle or self._pinged or self.pinger is None: return
+      self._pinged = True
+    self.pinger.ping()
 
-  def kill (self, con):
+  def pong (self):
     with self._lock:
-      try:
-        del self._dataForConnection[con]
-      except:
-        pass
-
-      self._waker.ping()
-
-  def run (self):
-    while core.running:
-
-      with self._lock:
-        cons = self._dataForConnection.keys()
-
-      rlist, wlist, elist = select.select([self._waker], cons, cons, 1)
-      if not core.running: break
-
-      with self._lock:
-        if len(rlist) > 0:
-          self._waker.pongAll()
+      self._pinged = False
+      self.pinger.pongAll()
 
-        for con in elist:
-          try:
-            del self._dataForConnection[con]
-          except:
-            pass
+  def begin_cycle (self):
+    with self._lock:
+      self._in_cycle = True
 
-        for con in wlist:
-          try:
-            alldata = self._dataForConnection[con]
-            while len(alldata):
-              data = alldata[0]
-              try:
-                l = con.sock.send(data)
-                if l != len(data):
-                  alldata[0] = data[l:]
-                  break
-                del alldata[0]
-              except socket.error as (errno, strerror):
-                if errno != EAGAIN:
-                  con.msg("DeferredSender/Socket error: " + strerror)
-                  con.disconnect()
-                  del self._dataForConnection[con]
-                break
-              except:
-                con.msg("Unknown error doing deferred sending")
-                break
-            if len(alldata) == 0:
-              try:
-                del self._dataForConnection[con]
-                if len(self._dataForConnection) == 0:
-                  self.sending = False
-                  break
-              except:
-                pass
-          except:
-            try:
-              del self._dataForConnection[con]
-            except:
-              pass
+  def end_cycle (self):
+    """
+    Returns the connections to flush
+    """
+    with self._lock:
+      self._in_cycle = False
+      connections = self._connections
+      self._connections = set()
+    return connections
 
 # Used by the Connection class below
-deferredSender = DeferredSender()
+pendingOutput = PendingOutput()
+
+# Totals over every connection of send() calls made, and of bytes and
+# messages sent by them
+send_counters = {"calls":0, "bytes":0, "messages":0}
 
 class DummyOFNexus (object):
   def raiseEventNoErrors (self, event, *args, **kw):
@@ -587,6 +534,8 @@ class Connection (EventMixin):
     PortStatsReceived,
     QueueStatsReceived,
     FlowRemoved,
+    SendBufferFull,
+    SendBufferDrained,
   ])
   
   # Globally unique identifier for the Connection instance
@@ -603,12 +552,34 @@ class Connection (EventMixin):
     #print str(self), m
     log.info(str(self) + " " + str(m))
 
-  def __init__ (self, sock):
+  def __init__ (self, sock, received = None):
+    """
+    received is what was already read from the socket by whoever sent our
+    HELLO for us (see pox.openflow.shard).  It's handled by the first call
+    to read().
+    """
     self._previous_stats = []
 
     self.ofnexus = _dummyOFNexus
     self.sock = sock
-    self.buf = ''
+    # Received bytes are kept in self.buf[:self.buf_len]
+    self.buf = bytearray(RECV_BUFFER_MIN)
+    self.buf_len = 0
+    # Set when read() stopped before the socket ran out of data
+    self.read_pending = False
+    # Captured sockets have to see every byte, so they're read with recv()
+    self._recv_into = not isinstance(sock, CaptureSocket)
+    # Data waiting to be sent, in the order it was queued
+    self._out = []
+    self._out_len = 0
+    self._out_messages = 0
+    self._out_lock = threading.Lock()
+    # Between SendBufferFull and SendBufferDrained
+    self.send_blocked = False
+    # send() calls made for this connection, and bytes and messages sent
+    self.send_calls = 0
+    self.sent_bytes = 0
+    self.sent_messages = 0
     Connection.ID += 1
     self.ID = Connection.ID
     # TODO: dpid and features don't belong here; they should be eventually
@@ -619,7 +590,12 @@ class Connection (EventMixin):
     self.connect_time = None
     self.idle_time = time.time()
 
-    self.send(of.ofp_hello())
+    if received is None:
+      self.send(of.ofp_hello())
+    else:
+      self.buf[:len(received)] = received
+      self.buf_len = len(received)
+    self._received = received is not None
 
     self.original_ports = PortCollection()
     self.ports = PortCollection()
@@ -656,11 +632,9 @@ class Connection (EventMixin):
       self.ofnexus.raiseEventNoErrors(ConnectionDown, self)
       self.raiseEventNoErrors(ConnectionDown, self)
 
-    try:
-      #deferredSender.kill(self)
-      pass
-    except:
-      pass
+    with self._out_lock:
+      self._out = []
+      self._out_len = 0
     try:
       self.sock.shutdown(socket.SHUT_RDWR)
     except:
@@ -677,6 +651,7 @@ class Connection (EventMixin):
 
     Data should probably either be raw bytes in OpenFlow wire format, or
     an OpenFlow controller-to-switch message object from libopenflow.
+    It's queued and sent at the end of the OpenFlow task's I/O cycle.
     """
     if self.disconnected: return
     if type(data) is not bytes:
@@ -686,63 +661,155 @@ class Connection (EventMixin):
       assert isinstance(data, of.ofp_header)
       data = data.pack()
 
-    if deferredSender.sending:
-      log.debug("deferred sender is sending!")
-      deferredSender.send(self, data)
-      return
+    with self._out_lock:
+      self._out.append(data)
+      self._out_len += len(data)
+      self._out_messages += 1
+      full = not self.send_blocked and self._out_len > SEND_HIGH_WATER
+      if full: self.send_blocked = True
+    pendingOutput.add(self)
+    if full:
+      self.msg("Send buffer full")
+      self._raise_send_event(SendBufferFull)
+
+  def flush (self):
+    """
+    Send as much queued data as the socket takes.  Generally this is just
+    called by the main OpenFlow loop below.
+
+    Returns True if nothing is left to send.
+    """
+    with self._out_lock:
+      if not self._out: return True
+      chunks = self._out
+      messages = self._out_messages
+      self._out = []
+      self._out_messages = 0
+    data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
     try:
       l = self.sock.send(data)
-      if l != len(data):
-        self.msg("Didn't send complete buffer.")
-        data = data[l:]
-        deferredSender.send(self, data)
-    except socket.error as (errno, strerror):
-      if errno == EAGAIN:
-        self.msg("Out of send buffer space.  " +
-                 "Consider increasing SO_SNDBUF.")
-        deferredSender.send(self, data)
-      else:
-        self.msg("Socket error: " + strerror)
+    except socket.error as e:
+      if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+        self.msg("Socket error: " + str(e))
         self.disconnect()
+        return True
+      l = 0
+    else:
+      self.send_calls += 1
+      self.sent_bytes += l
+      self.sent_messages += messages
+      send_counters["calls"] += 1
+      send_counters["bytes"] += l
+      send_counters["messages"] += messages
+
+    with self._out_lock:
+      if l < len(data):
+        self._out.insert(0, data[l:])
+        if l == 0: self._out_messages += messages
+      self._out_len -= l
+      drained = self.send_blocked and self._out_len < SEND_LOW_WATER
+      if drained: self.send_blocked = False
+      done = not self._out
+    if drained:
+      self.msg("Send buffer drained")
+      self._raise_send_event(SendBufferDrained)
+    return done
+
+  def _raise_send_event (self, event):
+    e = self.ofnexus.raiseEventNoErrors(event, self)
+    if e is None or e.halt != True:
+      self.raiseEventNoErrors(event, self)
 
-  def read (self):
+  def read (self, max_reads = 1):
     """
-    Read data from this connection.  Generally this is just called by the
-    main OpenFlow loop below.
+    Read data from this connection and handle the messages in it.
+    Generally this is just called by the main OpenFlow loop below.
 
-    Note: This function will block if data is not available.
+    Reads until the socket runs out of data or max_reads reads were made.
+    In the latter case read_pending is set, since an edge-triggered poller
+    won't report the connection again.  Returns False if the connection
+    was closed by the other side or sent something that isn't OpenFlow.
     """
-    d = self.sock.recv(2048)
-    if len(d) == 0:
-      return False
-    self.buf += d
-    buf_len = len(self.buf)
+    if self._received:
+      self._received = False
+      if self._unpack_messages() is False:
+        return False
+    self.read_pending = False
+    for i in xrange(max_reads):
+      free = len(self.buf) - self.buf_len
+      if free == 0:
+        self.buf.extend(bytearray(len(self.buf)))
+        free = len(self.buf) - self.buf_len
+      try:
+        if self._recv_into:
+          l = self.sock.recv_into(memoryview(self.buf)[self.buf_len:], free)
+        else:
+          d = self.sock.recv(free)
+          l = len(d)
+          self.buf[self.buf_len:self.buf_len+l] = d
+      except socket.error as e:
+        if e.args[0] in (EAGAIN, EWOULDBLOCK):
+          return True
+        raise
+      if l == 0:
+        return False
+      self.buf_len += l
+
+      if self._unpack_messages() is False:
+        return False
+
+      size = len(self.buf)
+      if l == free:
+        # Filled the buffer, so there's probably more waiting
+        if size < RECV_BUFFER_MAX:
+          self.buf.extend(bytearray(size))
+      else:
+        if self.buf_len == 0 and size > RECV_BUFFER_MIN and l < size / 4:
+          del self.buf[size/2:]
+        # A short read leaves the socket without data
+        return True
 
+    self.read_pending = True
+    return True
 
+  def _unpack_messages (self):
+    """
+    Unpack and handle every complete message in the receive buffer and
+    move what is left of it to the front.
+    """
+    buf = self.buf
+    buf_len = self.buf_len
+    view = memoryview(buf)
     offset = 0
+    msg_length = 0
     while buf_len - offset >= 8: # 8 bytes is minimum OF message size
-      # We pull the first four bytes of the OpenFlow header off by hand
-      # (using ord) to find the version/length/type so that we can
-      # correctly call libopenflow to unpack it.
-
-      ofp_type = ord(self.buf[offset+1])
+      # We pull the OpenFlow header off by hand to find the
+      # version/length/type so that we can correctly call libopenflow
+      # to unpack it.
+      version, ofp_type, msg_length = _header.unpack_from(buf, offset)
 
-      if ord(self.buf[offset]) != of.OFP_VERSION:
+      if version != of.OFP_VERSION:
         if ofp_type == of.OFPT_HELLO:
           # We let this through and hope the other side switches down.
           pass
         else:
           log.warning("Bad OpenFlow version (0x%02x) on connection %s"
-                      % (ord(self.buf[offset]), self))
+                      % (version, self))
           return False # Throw connection away
 
-      msg_length = ord(self.buf[offset+2]) << 8 | ord(self.buf[offset+3])
+      if msg_length < 8:
+        log.warning("Bad OpenFlow message length (%i) on connection %s"
+                    % (msg_length, self))
+        return False
 
       if buf_len - offset < msg_length: break
 
-      new_offset,msg = unpackers[ofp_type](self.buf, offset)
-      assert new_offset - offset == msg_length
-      offset = new_offset
+      # Only the message itself is copied out of the buffer
+      data = view[offset:offset+msg_length].tobytes()
+      offset += msg_length
+      new_offset,msg = unpackers[ofp_type](data, 0)
+      assert new_offset == msg_length
 
       try:
         h = handlers[ofp_type]
@@ -752,10 +819,15 @@ class Connection (EventMixin):
                       "%s %s", self,self,
                       ("\n" + str(self) + " ").join(str(msg).split('\n')))
         continue
+    del view
 
     if offset != 0:
-      self.buf = self.buf[offset:]
-
+      remaining = buf_len - offset
+      buf[:remaining] = buf[offset:buf_len]
+      self.buf_len = remaining
+    if msg_length > len(buf):
+      # Make room for a message larger than the buffer
+      buf.extend(bytearray(msg_length - len(buf)))
     return True
 
   def _incoming_stats_reply (self, ofp):
@@ -817,102 +889,301 @@ def wrap_socket (new_sock):
   return new_sock
 
 
+# What a poller reports about an item
+POLL_IN = 1
+POLL_OUT = 2
+POLL_ERR = 4
+
+class SelectPoller (object):
+  """
+  Reports readable, writable and failed sockets with select(), which is
+  done by the recoco scheduler.
+  """
+  edge_triggered = False
+
+  def __init__ (self):
+    self.items = []
+    self.writers = []
+
+  def register (self, item):
+    self.items.append(item)
+
+  def unregister (self, item):
+    for l in (self.items, self.writers):
+      try:
+        l.remove(item)
+      except ValueError:
+        pass
+
+  def want_write (self, item, want = True):
+    """
+    Whether to report the item when it's writable
+    """
+    if want:
+      self.writers.append(item)
+    else:
+      self.writers.remove(item)
+
+  def select_args (self):
+    """
+    Returns the lists to select on
+    """
+    return (self.items, self.writers, self.items)
+
+  def poll (self, rlist, wlist, xlist):
+    """
+    Returns (item, POLL_xxx flags) tuples for the result of the select
+    """
+    r = {}
+    for i in rlist: r[i] = POLL_IN
+    for i in wlist: r[i] = r.get(i, 0) | POLL_OUT
+    for i in xlist: r[i] = POLL_ERR
+    return r.items()
+
+
+class EpollPoller (object):
+  """
+  Keeps sockets registered with an edge-triggered epoll object.
+
+  The recoco scheduler selects on the epoll object itself, so each I/O
+  cycle only costs as much as the number of sockets with new data.  Since
+  a socket is only reported when new data arrives, whoever polls has to
+  read it until it runs out.
+  """
+  edge_triggered = True
+
+  _mask = (select.EPOLLIN | select.EPOLLPRI | select.EPOLLET |
+           getattr(select, "EPOLLRDHUP", 0x2000))
+  _in = select.EPOLLIN | select.EPOLLPRI | getattr(select, "EPOLLRDHUP", 0x2000)
+
+  def __init__ (self):
+    self.epoll = select.epoll()
+    self._items = {} # fd -> item
+    self._fds = {} # item -> fd
+
+  def fileno (self):
+    return self.epoll.fileno()
+
+  def register (self, item):
+    fd = item.fileno()
+    old = self._items.get(fd)
+    if old is not None:
+      # The descriptor was closed without unregistering and reused
+      del self._fds[old]
+    self._items[fd] = item
+    self._fds[item] = fd
+    try:
+      self.epoll.register(fd, self._mask)
+    except IOError as e:
+      if e.errno != EEXIST: raise
+      self.epoll.modify(fd, self._mask)
+
+  def unregister (self, item):
+    fd = self._fds.pop(item, None)
+    if fd is None: return
+    del self._items[fd]
+    try:
+      self.epoll.unregister(fd)
+    except (IOError, ValueError):
+      pass
+
+  def want_write (self, item, want = True):
+    fd = self._fds.get(item)
+    if fd is None: return
+    self.epoll.modify(fd, self._mask | (select.EPOLLOUT if want else 0))
+
+  def select_args (self):
+    return ([self], [], [])
+
+  def poll (self, rlist, wlist, xlist):
+    r = []
+    for fd,event in self.epoll.poll(0):
+      item = self._items.get(fd)
+      if item is None: continue
+      flags = 0
+      if event & self._in: flags |= POLL_IN
+      if event & select.EPOLLOUT: flags |= POLL_OUT
+      if event & select.EPOLLERR and not flags & POLL_IN: flags = POLL_ERR
+      r.append((item, flags))
+    return r
+
+  def close (self):
+    self.epoll.close()
+
+
 from pox.lib.recoco.recoco import *
 
 class OpenFlow_01_Task (Task):
   """
   The main recoco thread for listening to openflow messages
   """
-  def __init__ (self, port = 6633, address = '0.0.0.0'):
+  # Switches connected to other controller processes (see
+  # pox.openflow.shard), DPID -> shard
+  remote_switches = {}
+
+  def __init__ (self, port = 6633, address = '0.0.0.0', use_epoll = True):
     Task.__init__(self)
     self.port = int(port)
     self.address = address
+    self.use_epoll = use_epoll and hasattr(select, "epoll")
+    self.poller = None
+    # Connections that still had data when we stopped reading them
+    self.pending = set()
 
     core.addListener(pox.core.GoingUpEvent, self._handle_GoingUpEvent)
 
   def _handle_GoingUpEvent (self, event):
     self.start()
 
-  def run (self):
-    # List of open sockets/connections to select on
-    sockets = []
+  def owns (self, dpid):
+    """
+    Whether the switch is ours to program, whether or not it's connected
+    """
+    return True
 
-    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    listener.bind((self.address, self.port))
-    listener.listen(16)
-    sockets.append(listener)
+  def forward (self, dpid, data):
+    """
+    Send data to a switch connected to another controller process.
+    Returns whether it was sent.
+    """
+    return False
 
-    log.debug("Listening on %s:%s" %
-              (self.address, self.port))
+  def run (self):
+    if self.use_epoll:
+      self.poller = poller = EpollPoller()
+      max_reads = MAX_READS_PER_CYCLE
+    else:
+      self.poller = poller = SelectPoller()
+      max_reads = 1
+    listeners = self._listen()
+    for listener in listeners:
+      poller.register(listener)
+    pinger = pox.lib.util.makePinger()
+    poller.register(pinger)
+    pendingOutput.pinger = pinger
+    # Connections waiting for their sockets to take more data
+    writing = set()
 
-    con = None
     while core.running:
       try:
-        while True:
-          con = None
-          rlist, wlist, elist = yield Select(sockets, [], sockets, 5)
-          if len(rlist) == 0 and len(wlist) == 0 and len(elist) == 0:
-            if not core.running: break
-
-          for con in elist:
-            if con is listener:
+        rlist, wlist, xlist = poller.select_args()
+        rlist, wlist, xlist = yield Select(rlist, wlist, xlist,
+                                           0 if self.pending else 5)
+        pendingOutput.begin_cycle()
+        ready = poller.poll(rlist, wlist, xlist)
+
+        timestamp = time.time()
+        readable = self.pending
+        self.pending = set()
+        writable = set()
+        for con,flags in ready:
+          if con is pinger:
+            pendingOutput.pong()
+          elif con in listeners:
+            if flags & POLL_ERR:
               raise RuntimeError("Error on listener socket")
-            else:
-              try:
-                con.close()
-              except:
-                pass
-              try:
-                sockets.remove(con)
-              except:
-                pass
-
-          timestamp = time.time()
-          for con in rlist:
-            if con is listener:
-              new_sock = listener.accept()[0]
-              if pox.openflow.debug.pcap_traces:
-                new_sock = wrap_socket(new_sock)
-              new_sock.setblocking(0)
-              # Note that instantiating a Connection object fires a
-              # ConnectionUp event (after negotation has completed)
-              newcon = Connection(new_sock)
-              sockets.append( newcon )
-              #print str(newcon) + " connected"
-            else:
-              con.idle_time = timestamp
-              if con.read() is False:
-                con.close()
-                sockets.remove(con)
+            if flags & POLL_IN: self._accept(con)
+            # Listeners that also send (see pox.openflow.shard)
+            if flags & POLL_OUT: writable.add(con)
+          elif flags & POLL_ERR:
+            self._close(con)
+            readable.discard(con)
+            writing.discard(con)
+          else:
+            if flags & POLL_IN: readable.add(con)
+            if flags & POLL_OUT: writable.add(con)
+
+        for con in readable:
+          con.idle_time = timestamp
+          try:
+            alive = con.read(max_reads)
+          except Exception:
+            self._read_failed(con)
+            alive = False
+          if alive is False:
+            self._close(con)
+            writing.discard(con)
+          elif con.read_pending:
+            self.pending.add(con)
+
+        # Send what was queued during the cycle (or woke us up), and more
+        # to the sockets that can take it now
+        flush = pendingOutput.end_cycle()
+        flush.update(writable.intersection(writing))
+        for con in flush:
+          if con.flush():
+            if con in writing:
+              writing.discard(con)
+              if not con.disconnected: poller.want_write(con, False)
+          elif con not in writing:
+            writing.add(con)
+            poller.want_write(con, True)
       except exceptions.KeyboardInterrupt:
         break
       except:
-        doTraceback = True
-        if sys.exc_info()[0] is socket.error:
-          if sys.exc_info()[1][0] == ECONNRESET:
-            con.info("Connection reset")
-            doTraceback = False
-
-        if doTraceback:
-          log.exception("Exception reading connection " + str(con))
-
-        if con is listener:
-          log.error("Exception on OpenFlow listener.  Aborting.")
-          break
-        try:
-          con.close()
-        except:
-          pass
-        try:
-          sockets.remove(con)
-        except:
-          pass
+        log.exception("Exception on OpenFlow listener.  Aborting.")
+        break
 
+    pendingOutput.pinger = None
     log.debug("No longer listening for connections")
 
     #pox.core.quit()
 
+  def _listen (self):
+    """
+    Returns the listening sockets to accept connections from
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((self.address, self.port))
+    listener.listen(16)
+    listener.setblocking(0)
+
+    log.debug("Listening on %s:%s (%s)" %
+              (self.address, self.port,
+               "epoll" if self.use_epoll else "select"))
+    return [listener]
+
+  def _accept (self, listener):
+    # An edge-triggered listener has to be drained
+    while True:
+      try:
+        new_sock = listener.accept()[0]
+      except socket.error as e:
+        if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+          log.warning("Couldn't accept connection: %s" % (e,))
+        return
+      new_sock.setblocking(0)
+      con = self._create_connection(listener, new_sock)
+      if con is not None:
+        self.poller.register(con)
+      if not self.poller.edge_triggered: return
+
+  def _create_connection (self, listener, new_sock):
+    if pox.openflow.debug.pcap_traces:
+      new_sock = wrap_socket(new_sock)
+    # Note that instantiating a Connection object fires a
+    # ConnectionUp event (after negotation has completed)
+    return Connection(new_sock)
+
+  def _close (self, con):
+    # Unregister first, since epoll needs the descriptor to be open
+    self.poller.unregister(con)
+    try:
+      con.close()
+    except:
+      pass
+
+  def _read_failed (self, con):
+    doTraceback = True
+    if sys.exc_info()[0] is socket.error:
+      if sys.exc_info()[1][0] == ECONNRESET:
+        con.info("Connection reset")
+        doTraceback = False
+
+    if doTraceback:
+      log.exception("Exception reading connection " + str(con))
+
 
 def _set_handlers ():
   handlers.extend([None] * (1 + sorted(handlerMap.keys(),reverse=True)[0]))
@@ -922,10 +1193,36 @@ def _set_handlers ():
 _set_handlers()
 
 
-def launch (port = 6633, address = "0.0.0.0"):
+def launch (port = 6633, address = "0.0.0.0", no_epoll = False,
+            shards = None, shard = None, shard_socket = None,
+            lazy_unpack = False):
+  """
+  With --shards=N this process accepts switches and hands each of them to
+  one of N controller processes started with --shards=N --shard=<0..N-1>.
+
+  With --lazy_unpack, messages that have a view class in libopenflow_01
+  (packet-ins, flow-removeds, port status and stats replies) are unpacked
+  into views, which decode their fields only when they are used.
+  """
   if core.hasComponent('of_01'):
     return None
-  l = OpenFlow_01_Task(port = int(port), address = address)
+  if lazy_unpack:
+    for ofp_type in range(len(unpackers)):
+      cls = of._message_type_to_class.get(ofp_type)
+      if cls in of._view_classes:
+        unpackers[ofp_type] = of._view_classes[cls].unpack_new
+  if shards is None:
+    l = OpenFlow_01_Task(port = int(port), address = address,
+                         use_epoll = not no_epoll)
+  else:
+    from pox.openflow import shard as of_shard
+    if shard_socket is None: shard_socket = of_shard.SHARD_SOCKET
+    if shard is None:
+      l = of_shard.ShardFront(int(shards), shard_socket, port = int(port),
+                              address = address, use_epoll = not no_epoll)
+    else:
+      l = of_shard.ShardWorker(int(shards), int(shard), shard_socket,
+                               use_epoll = not no_epoll)
   core.register("of_01", l)
   return l
 
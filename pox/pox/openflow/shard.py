@@ -0,0 +1,555 @@
+# Copyright 2011,2012 James McCauley
+#
+# This file is part of POX.
+#
+# POX is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# POX is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with POX.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Spreads OpenFlow switches over several POX processes.
+
+A front process accepts switch connections, does the HELLO and FEATURES
+exchange to learn each switch's DPID and hands the socket (and whatever
+it read past the HELLO) to the worker process of the switch's shard.
+Workers run the usual components, each with the switches of its shard:
+
+  ./pox.py openflow.of_01 --shards=4
+  ./pox.py openflow.of_01 --shards=4 --shard=0 openflow.discovery rfproxy
+  ...
+  ./pox.py openflow.of_01 --shards=4 --shard=3 openflow.discovery rfproxy
+
+The front also relays a small message bus between the workers, over the
+same Unix socket that carries the handed-off switches:
+ - Switch joins and leaves and links found by openflow.discovery are
+   replicated to every worker.  Replicated LinkEvents are raised on
+   core.openflow_discovery with a .shard attribute.
+ - OpenFlow messages for a switch of another shard are forwarded to it
+   (see OpenFlow_01_Task.forward()).
+"""
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+from pox.openflow.of_01 import OpenFlow_01_Task, Connection
+from pox.openflow.of_01 import MAX_READS_PER_CYCLE, _header, pendingOutput
+from pox.lib.recoco.recoco import Sleep
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str
+
+import os
+import json
+import time
+import struct
+import socket
+import threading
+import _multiprocessing
+from collections import deque
+from errno import EAGAIN, EWOULDBLOCK
+
+log = core.getLogger()
+
+# Unix socket the front listens on for workers
+SHARD_SOCKET = "/tmp/pox-shard.sock"
+
+# Seconds a switch has to send its FEATURES_REPLY to the front
+HANDSHAKE_TIMEOUT = 10
+
+# Seconds between attempts of a worker to reach the front
+CONNECT_INTERVAL = 1
+
+# Records on the shard socket are a (kind, shard, dpid) header followed by
+# a payload, at most MAX_RECORD bytes in all
+_record = struct.Struct("!BiQ")
+MAX_RECORD = 256 * 1024
+
+# Records queued for a shard socket above which more are dropped
+MAX_QUEUED_RECORDS = 4096
+
+# Worker to front: shard is the worker's
+RECORD_REGISTER = 0
+# Front to worker: the payload is what the switch sent after its HELLO,
+# and the next record carries the socket
+RECORD_HANDOFF = 1
+# Worker to front to the other workers: shard is the sender's (or -1 for
+# the front) and the payload is a JSON object
+RECORD_EVENT = 2
+# Worker to front to the worker of the switch: the payload is OpenFlow
+# messages for switch dpid
+RECORD_OF_MSG = 3
+
+_features_reply = struct.Struct("!Q")
+
+
+def shard_of (dpid, shards):
+  """
+  The shard a switch belongs to
+  """
+  return dpid % shards
+
+
+class ShardChannel (object):
+  """
+  One end of the shard socket, polled like a Connection
+
+  Like a Connection's, sends are queued and flushed by the OpenFlow task
+  without ever blocking, so two processes sending to each other can't
+  wait on each other.
+  """
+  def __init__ (self, sock):
+    self.sock = sock
+    self.read_pending = False
+    self.shard = None
+    self.disconnected = False
+    # Records, and descriptors to pass (as ints), in the order queued
+    self._out = deque()
+    self._out_lock = threading.Lock()
+
+  def fileno (self):
+    return self.sock.fileno()
+
+  def send_record (self, kind, shard, dpid, payload = ''):
+    """
+    Queue a record.  Returns False if it was dropped.
+    """
+    if _record.size + len(payload) > MAX_RECORD:
+      log.warning("Dropping %i byte record", _record.size + len(payload))
+      return False
+    return self._queue([_record.pack(kind, shard, dpid) + payload])
+
+  def _queue (self, items):
+    with self._out_lock:
+      full = len(self._out) + len(items) > MAX_QUEUED_RECORDS
+      if not full and not self.disconnected:
+        self._out.extend(items)
+        queued = True
+      else:
+        queued = False
+    if full:
+      log.warning("Dropping record for shard %s: too many queued", self.shard)
+    if queued:
+      pendingOutput.add(self)
+    return queued
+
+  def flush (self):
+    """
+    Send as many queued records as the socket takes.
+
+    Returns True if nothing is left to send.
+    """
+    while True:
+      with self._out_lock:
+        if not self._out: return True
+        item = self._out[0]
+      try:
+        if type(item) is int:
+          _multiprocessing.sendfd(self.sock.fileno(), item)
+        else:
+          self.sock.send(item, socket.MSG_DONTWAIT)
+      except (socket.error, OSError) as e:
+        if e.args[0] in (EAGAIN, EWOULDBLOCK):
+          return False
+        log.warning("Couldn't send to shard %s: %s", self.shard, e)
+        self._drop_output()
+        return True
+      with self._out_lock:
+        self._out.popleft()
+      if type(item) is int:
+        os.close(item)
+
+  def send_event (self, shard, event):
+    return self.send_record(RECORD_EVENT, shard, 0, json.dumps(event))
+
+  def read (self, max_reads = 1):
+    self.read_pending = False
+    for i in xrange(max_reads):
+      try:
+        d = self.sock.recv(MAX_RECORD, socket.MSG_DONTWAIT)
+      except socket.error as e:
+        if e.args[0] in (EAGAIN, EWOULDBLOCK):
+          return True
+        raise
+      if len(d) == 0:
+        return False
+      kind, shard, dpid = _record.unpack_from(d)
+      if self.handle(kind, shard, dpid, d[_record.size:]) is False:
+        return False
+    self.read_pending = True
+    return True
+
+  def handle (self, kind, shard, dpid, payload):
+    pass
+
+  def _drop_output (self):
+    with self._out_lock:
+      self.disconnected = True
+      items = self._out
+      self._out = deque()
+    for item in items:
+      if type(item) is int:
+        os.close(item)
+
+  def close (self):
+    self._drop_output()
+    self.sock.close()
+
+  def __str__ (self):
+    return "[shard %s]" % (self.shard,)
+
+
+class Handshake (object):
+  """
+  A switch the front process is learning the DPID of
+  """
+  def __init__ (self, sock, front):
+    self.sock = sock
+    self.front = front
+    self.buf = ''
+    self.read_pending = False
+    self.start_time = time.time()
+    sock.send(of.ofp_hello().pack() + of.ofp_features_request().pack())
+
+  def fileno (self):
+    return self.sock.fileno()
+
+  def read (self, max_reads = 1):
+    """
+    Returns False once the switch was handed off or has to be dropped
+    """
+    self.read_pending = False
+    for i in xrange(max_reads):
+      try:
+        d = self.sock.recv(4096)
+      except socket.error as e:
+        if e.args[0] in (EAGAIN, EWOULDBLOCK):
+          return True
+        raise
+      if len(d) == 0:
+        return False
+      self.buf += d
+      if self._unpack_messages() is False:
+        return False
+    self.read_pending = True
+    return True
+
+  def _unpack_messages (self):
+    offset = 0
+    while len(self.buf) - offset >= 8:
+      version, ofp_type, msg_length = _header.unpack_from(self.buf, offset)
+      if version != of.OFP_VERSION and ofp_type != of.OFPT_HELLO:
+        log.warning("Bad OpenFlow version (0x%02x) from %s", version, self)
+        return False
+      if msg_length < 8:
+        return False
+      if len(self.buf) - offset < msg_length: break
+
+      if ofp_type == of.OFPT_FEATURES_REPLY:
+        dpid = _features_reply.unpack_from(self.buf, offset + 8)[0]
+        self.front.hand_off(self, dpid, self.buf[offset:])
+        return False
+      if ofp_type == of.OFPT_ECHO_REQUEST:
+        reply = self.buf[offset:offset+msg_length]
+        self.sock.send(reply[0] + chr(of.OFPT_ECHO_REPLY) + reply[2:])
+      offset += msg_length
+    self.buf = self.buf[offset:]
+    return True
+
+  def close (self):
+    # Not shut down: the worker has its own descriptor of the socket
+    self.sock.close()
+
+  def __str__ (self):
+    try:
+      return "[handshake %s:%i]" % self.sock.getpeername()
+    except socket.error:
+      return "[handshake]"
+
+
+class FrontChannel (ShardChannel):
+  """
+  The front's end of the shard socket of a worker
+  """
+  def __init__ (self, sock, front):
+    ShardChannel.__init__(self, sock)
+    self.front = front
+
+  def send_switch (self, dpid, data, fd):
+    """
+    Queue the hand off of a switch: a record with the data it sent, and a
+    copy of its socket right after.  Returns False if it was dropped.
+    """
+    if _record.size + len(data) > MAX_RECORD:
+      log.warning("Dropping %i byte record", _record.size + len(data))
+      return False
+    fd = os.dup(fd)
+    if not self._queue([_record.pack(RECORD_HANDOFF, self.shard, dpid) + data,
+                        fd]):
+      os.close(fd)
+      return False
+    return True
+
+  def handle (self, kind, shard, dpid, payload):
+    if kind == RECORD_REGISTER:
+      self.front.register_worker(self, shard)
+    elif self.shard is None:
+      log.warning("Record from unregistered worker")
+      return False
+    elif kind == RECORD_EVENT:
+      self.front.broadcast(self.shard, payload)
+    elif kind == RECORD_OF_MSG:
+      worker = self.front.workers.get(shard_of(dpid, self.front.shards))
+      if worker is None:
+        log.debug("No worker for switch %s", dpid_to_str(dpid))
+      else:
+        worker.send_record(RECORD_OF_MSG, self.shard, dpid, payload)
+
+
+class WorkerChannel (ShardChannel):
+  """
+  A worker's end of the shard socket
+  """
+  def __init__ (self, sock, worker):
+    ShardChannel.__init__(self, sock)
+    self.worker = worker
+    self.shard = worker.shard
+
+  def handle (self, kind, shard, dpid, payload):
+    if kind == RECORD_HANDOFF:
+      # The socket follows in a record of its own
+      fd = _multiprocessing.recvfd(self.sock.fileno())
+      try:
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+      finally:
+        os.close(fd)
+      self.worker.add_switch(sock, payload)
+    elif kind == RECORD_OF_MSG:
+      con = core.openflow.getConnection(dpid)
+      if con is None:
+        log.debug("Forwarded message for unknown switch %s",
+                  dpid_to_str(dpid))
+      else:
+        con.send(payload)
+    elif kind == RECORD_EVENT:
+      self.worker.handle_event(shard, json.loads(payload))
+
+
+class ShardFront (OpenFlow_01_Task):
+  """
+  Accepts switches and hands them to the workers of their shards
+  """
+  def __init__ (self, shards, path = SHARD_SOCKET, **kw):
+    OpenFlow_01_Task.__init__(self, **kw)
+    self.shards = shards
+    self.path = path
+    self.workers = {} # shard -> FrontChannel
+    self.handshakes = set()
+    self.handed_off = 0
+
+  def _listen (self):
+    listeners = OpenFlow_01_Task._listen(self)
+    if os.path.exists(self.path):
+      os.unlink(self.path)
+    self.shard_listener = socket.socket(socket.AF_UNIX,
+                                        socket.SOCK_SEQPACKET)
+    self.shard_listener.bind(self.path)
+    self.shard_listener.listen(self.shards)
+    self.shard_listener.setblocking(0)
+    Timer(HANDSHAKE_TIMEOUT, self._expire_handshakes, recurring = True)
+    log.info("Handing switches to %i shards through %s",
+             self.shards, self.path)
+    return listeners + [self.shard_listener]
+
+  def _create_connection (self, listener, new_sock):
+    if listener is self.shard_listener:
+      return FrontChannel(new_sock, self)
+    handshake = Handshake(new_sock, self)
+    self.handshakes.add(handshake)
+    return handshake
+
+  def _close (self, con):
+    OpenFlow_01_Task._close(self, con)
+    self.handshakes.discard(con)
+    if isinstance(con, FrontChannel) and self.workers.get(con.shard) is con:
+      log.warning("Lost worker of shard %i", con.shard)
+      del self.workers[con.shard]
+      self.broadcast(-1, json.dumps({"shard_down":con.shard}))
+
+  def _expire_handshakes (self):
+    timeout = time.time() - HANDSHAKE_TIMEOUT
+    for handshake in [h for h in self.handshakes if h.start_time < timeout]:
+      log.info("%s didn't send its features", handshake)
+      self._close(handshake)
+
+  def register_worker (self, channel, shard):
+    if shard < 0 or shard >= self.shards:
+      log.error("Worker registered for shard %i of %i", shard, self.shards)
+      return
+    if shard in self.workers:
+      log.warning("Replacing worker of shard %i", shard)
+    channel.shard = shard
+    self.workers[shard] = channel
+    log.info("Worker of shard %i registered", shard)
+    # Have the others tell the new worker what they know
+    self.broadcast(shard, json.dumps({"sync":True}))
+
+  def broadcast (self, source, payload):
+    for shard,worker in self.workers.items():
+      if shard != source:
+        worker.send_record(RECORD_EVENT, source, 0, payload)
+
+  def hand_off (self, handshake, dpid, data):
+    shard = shard_of(dpid, self.shards)
+    worker = self.workers.get(shard)
+    if worker is None:
+      log.warning("No worker for shard %i; dropping switch %s",
+                  shard, dpid_to_str(dpid))
+      return
+    if not worker.send_switch(dpid, data, handshake.sock.fileno()):
+      return
+    self.handed_off += 1
+    log.debug("Handed switch %s to shard %i", dpid_to_str(dpid), shard)
+
+
+class ShardWorker (OpenFlow_01_Task):
+  """
+  Handles the switches of one shard, which the front hands to it
+  """
+  def __init__ (self, shards, shard, path = SHARD_SOCKET, **kw):
+    OpenFlow_01_Task.__init__(self, **kw)
+    self.shards = shards
+    self.shard = shard
+    self.path = path
+    self.channel = None
+    self.remote_switches = {} # DPID -> shard
+    self.remote_links = {} # Link -> shard
+
+  def _handle_GoingUpEvent (self, event):
+    core.openflow.addListenerByName("ConnectionUp",
+                                    self._handle_ConnectionUp)
+    core.openflow.addListenerByName("ConnectionDown",
+                                    self._handle_ConnectionDown)
+    if core.hasComponent("openflow_discovery"):
+      core.openflow_discovery.addListenerByName("LinkEvent",
+                                                self._handle_LinkEvent)
+    OpenFlow_01_Task._handle_GoingUpEvent(self, event)
+
+  def owns (self, dpid):
+    return shard_of(dpid, self.shards) == self.shard
+
+  def forward (self, dpid, data):
+    if self.channel is None or self.owns(dpid):
+      return False
+    if type(data) is not bytes:
+      data = data.pack()
+    return self.channel.send_record(RECORD_OF_MSG, self.shard, dpid, data)
+
+  def run (self):
+    # Wait for the front before running the usual loop
+    while core.running:
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+      try:
+        sock.connect(self.path)
+        break
+      except socket.error as e:
+        sock.close()
+        log.debug("Waiting for the front at %s: %s", self.path, e)
+        yield Sleep(CONNECT_INTERVAL)
+    else:
+      return
+    # Left blocking for recvfd(), which waits for the socket following a
+    # RECORD_HANDOFF; other reads and sends don't wait
+    self.channel = WorkerChannel(sock, self)
+    self.channel.send_record(RECORD_REGISTER, self.shard, 0)
+    # The loop below would only flush it after its first select() times out
+    self.channel.flush()
+    log.info("Shard %i of %i", self.shard, self.shards)
+
+    loop = OpenFlow_01_Task.run(self)
+    rv = None
+    while True:
+      try:
+        op = loop.send(rv)
+      except StopIteration:
+        break
+      rv = yield op
+
+  def _listen (self):
+    return [self.channel]
+
+  def _accept (self, channel):
+    try:
+      alive = channel.read(MAX_READS_PER_CYCLE)
+    except Exception:
+      log.exception("Exception reading shard socket")
+      alive = False
+    if alive is False:
+      raise RuntimeError("Lost the front")
+    if channel.read_pending:
+      # Poll it again in the next cycle
+      self.pending.add(channel)
+
+  def add_switch (self, sock, received):
+    sock.setblocking(0)
+    con = Connection(sock, received)
+    self.poller.register(con)
+    # Handle the FEATURES_REPLY the front read for us
+    self.pending.add(con)
+
+  def handle_event (self, source, event):
+    if "sync" in event:
+      for con in core.openflow.connections.values():
+        self._send_event({"switch":con.dpid, "up":True})
+      if core.hasComponent("openflow_discovery"):
+        for link in core.openflow_discovery.adjacency:
+          self._send_event({"link":list(link), "added":True})
+    elif "shard_down" in event:
+      shard = event["shard_down"]
+      for dpid,s in self.remote_switches.items():
+        if s == shard:
+          del self.remote_switches[dpid]
+      for link,s in self.remote_links.items():
+        if s == shard:
+          self._raise_link(shard, link, False)
+    elif "switch" in event:
+      if event["up"]:
+        self.remote_switches[event["switch"]] = source
+      else:
+        self.remote_switches.pop(event["switch"], None)
+    elif "link" in event:
+      from pox.openflow.discovery import Discovery
+      self._raise_link(source, Discovery.Link(*event["link"]),
+                       event["added"])
+
+  def _raise_link (self, source, link, added):
+    if added:
+      if link in self.remote_links: return
+      self.remote_links[link] = source
+    else:
+      if self.remote_links.pop(link, None) is None: return
+    if core.hasComponent("openflow_discovery"):
+      from pox.openflow.discovery import LinkEvent
+      event = LinkEvent(added, link)
+      event.shard = source
+      core.openflow_discovery.raiseEventNoErrors(event)
+
+  def _send_event (self, event):
+    if self.channel is not None:
+      self.channel.send_event(self.shard, event)
+
+  def _handle_ConnectionUp (self, event):
+    self._send_event({"switch":event.dpid, "up":True})
+
+  def _handle_ConnectionDown (self, event):
+    self._send_event({"switch":event.dpid, "up":False})
+
+  def _handle_LinkEvent (self, event):
+    if getattr(event, "shard", None) is not None: return
+    self._send_event({"link":list(event.link), "added":event.added})
@@ -340,5 +340,104 @@ class ofp_action_test(unittest.TestCase):
 #    c(ofp_action_mpls_tc, OFPAT_SET_MPLS_TC, {'mpls_tc': 0xac}, 8)
 #    c(ofp_action_mpls_ttl, OFPAT_SET_MPLS_TTL, {'mpls_ttl': 0xaf}, 8)
 
+class ofp_flow_mod_template_test(unittest.TestCase):
+  def flow_mod(self, nw_dst, port, dl_dst, **kw):
+    return ofp_flow_mod(match=ofp_match(dl_type=0x800, nw_dst=nw_dst),
+                        actions=[ofp_action_dl_addr.set_dst(dl_dst),
+                                 ofp_action_output(port=port)], **kw)
+
+  def test_pack(self):
+    template = ofp_flow_mod_template(self.flow_mod("10.0.0.0/8", 1,
+        EthAddr("00:00:00:00:00:01")))
+    expected = self.flow_mod("192.168.1.0/24", 5,
+                             EthAddr("00:00:00:00:00:02"), xid=9,
+                             priority=24, command=OFPFC_MODIFY)
+    self.assertEqual(template.pack(xid=9, nw_dst="192.168.1.0/24", port=5,
+                                   dl_dst="00:00:00:00:00:02", priority=24,
+                                   command=OFPFC_MODIFY),
+                     expected.pack())
+    self.assertEqual(template.pack(xid=9, nw_dst=(IPAddr("192.168.1.0"), 24),
+                                   port=5, dl_dst="00:00:00:00:00:02",
+                                   priority=24, command=OFPFC_MODIFY),
+                     expected.pack())
+
+  def test_xid(self):
+    template = ofp_flow_mod_template(self.flow_mod("10.0.0.0/8", 1,
+        EthAddr("00:00:00:00:00:01")))
+    a = ofp_flow_mod.unpack_new(template.pack())[1]
+    b = ofp_flow_mod.unpack_new(template.pack())[1]
+    self.assertNotEqual(a.xid, b.xid)
+
+  def test_errors(self):
+    template = ofp_flow_mod_template(ofp_flow_mod())
+    self.assertRaises(RuntimeError, template.pack, nw_dst="10.0.0.1")
+    self.assertRaises(RuntimeError, template.pack, port=1)
+    self.assertRaises(RuntimeError, template.pack, dl_src="00:00:00:00:00:01")
+    self.assertRaises(TypeError, template.pack, actions=[])
+
+class ofp_view_test(unittest.TestCase):
+  def unpack(self, msg):
+    raw = msg.pack()
+    offset, view = view_class(type(msg)).unpack_new(raw)
+    self.assertEqual(offset, len(raw))
+    self.assertTrue(isinstance(view, type(msg)))
+    return raw, view
+
+  def test_packet_in(self):
+    raw, view = self.unpack(ofp_packet_in(xid=5, in_port=3, buffer_id=7,
+                                          data="x" * 100))
+    self.assertEqual(view.xid, 5)
+    self.assertFalse('in_port' in view.__dict__)
+    self.assertEqual((view.in_port, view.buffer_id, view.total_len),
+                     (3, 7, 100))
+    self.assertEqual(view.data_view.tobytes(), "x" * 100)
+    self.assertFalse('_data' in view.__dict__)
+    self.assertEqual(len(view), len(raw))
+    self.assertEqual(view.data, "x" * 100)
+    self.assertEqual(view.pack(), raw)
+
+  def test_assign(self):
+    raw, view = self.unpack(ofp_packet_in(in_port=3, reason=1, data="x"))
+    view.in_port = 4
+    view.data = "yy"
+    self.assertEqual((view.in_port, view.reason), (4, 1))
+    self.assertEqual(len(view), len(raw) + 1)
+    self.assertEqual(view.data_view.tobytes(), "yy")
+
+  def test_stats_reply(self):
+    body = [ofp_flow_stats(match=ofp_match(dl_type=0x800,
+                                           nw_dst="10.0.0.%d" % i),
+                           packet_count=i,
+                           actions=[ofp_action_output(port=i)])
+            for i in range(1, 4)]
+    raw, view = self.unpack(ofp_stats_reply(type=OFPST_FLOW, body=body))
+    self.assertTrue(view.is_last_reply)
+    self.assertEqual(len(view), len(raw))
+    self.assertEqual([s.packet_count for s in view.body], [1, 2, 3])
+    self.assertFalse('actions' in view.body[0].__dict__)
+    self.assertEqual(view.body[2].match.nw_dst, IPAddr("10.0.0.3"))
+    self.assertEqual(view.body[1].actions[0].port, 2)
+    self.assertEqual(view.pack(), raw)
+
+  def test_flow_removed(self):
+    raw, view = self.unpack(ofp_flow_removed(match=ofp_match(in_port=2),
+                                             cookie=5, byte_count=99))
+    self.assertEqual((view.cookie, view.byte_count), (5, 99))
+    self.assertEqual(view.match.in_port, 2)
+    self.assertEqual(view.pack(), raw)
+
+  def test_port_status(self):
+    desc = ofp_phy_port(port_no=4, name="eth1",
+                        hw_addr=EthAddr("00:11:22:33:44:55"))
+    raw, view = self.unpack(ofp_port_status(reason=2, desc=desc))
+    self.assertEqual((view.reason, view.desc.name), (2, "eth1"))
+    self.assertEqual(view.desc, desc)
+    self.assertEqual(view.pack(), raw)
+
+  def test_underrun(self):
+    raw = ofp_packet_in(data="x" * 10).pack()
+    self.assertRaises(UnderrunError, ofp_packet_in_view.unpack_new, raw[:20])
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import unittest
+import sys
+import os.path
+import socket
+import select
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+import pox.openflow.libopenflow_01 as of
+import pox.openflow.of_01 as of_01
+from pox.openflow import SendBufferFull, SendBufferDrained
+from pox.openflow.of_01 import Connection, EpollPoller, SelectPoller
+from pox.openflow.of_01 import POLL_IN, POLL_OUT
+
+class ConnectionReadTest(unittest.TestCase):
+  def setUp(self):
+    self.switch, sock = socket.socketpair()
+    sock.setblocking(0)
+    self.con = Connection(sock)
+    self.assertTrue(isinstance(self.received()[0], of.ofp_hello))
+
+  def tearDown(self):
+    self.switch.close()
+    self.con.close()
+
+  def received(self):
+    """ messages the connection sent to the switch """
+    self.con.flush()
+    data = self.switch.recv(65536)
+    msgs = []
+    offset = 0
+    while offset < len(data):
+      offset, msg = of_01.unpackers[ord(data[offset+1])](data, offset)
+      msgs.append(msg)
+    return msgs
+
+  def test_split_message(self):
+    data = of.ofp_echo_request(xid=1, body="x" * 100).pack()
+    data += of.ofp_echo_request(xid=2).pack()
+    self.switch.send(data[:5])
+    self.assertTrue(self.con.read())
+    self.switch.send(data[5:110])
+    self.assertTrue(self.con.read())
+    self.assertEqual([m.xid for m in self.received()], [1])
+    self.switch.send(data[110:])
+    self.assertTrue(self.con.read())
+    self.assertEqual([m.xid for m in self.received()], [2])
+    self.assertEqual(self.con.buf_len, 0)
+
+  def test_large_message(self):
+    body = "x" * (of_01.RECV_BUFFER_MIN * 3)
+    self.switch.sendall(of.ofp_echo_request(xid=3, body=body).pack())
+    while not self.con._out:
+      self.assertTrue(self.con.read(of_01.MAX_READS_PER_CYCLE))
+    reply = self.received()[0]
+    self.assertEqual((reply.xid, reply.body), (3, body))
+    self.assertTrue(len(self.con.buf) > of_01.RECV_BUFFER_MIN)
+
+  def test_read_pending(self):
+    msg = of.ofp_echo_request(body="x" * 1000).pack()
+    self.switch.sendall(msg * (of_01.RECV_BUFFER_MIN * 4 / len(msg)))
+    self.assertTrue(self.con.read(1))
+    self.assertTrue(self.con.read_pending)
+    while self.con.read_pending:
+      self.assertTrue(self.con.read(of_01.MAX_READS_PER_CYCLE))
+    self.assertEqual(self.con.buf_len, 0)
+
+  def test_closed(self):
+    self.switch.shutdown(socket.SHUT_WR)
+    self.assertFalse(self.con.read())
+
+  def test_bad_version(self):
+    self.switch.send("\x05" + of.ofp_echo_request().pack()[1:])
+    self.assertFalse(self.con.read())
+
+class ConnectionSendTest(unittest.TestCase):
+  def setUp(self):
+    self.switch, sock = socket.socketpair()
+    sock.setblocking(0)
+    self.con = Connection(sock)
+    self.events = []
+    self.con.addListener(SendBufferFull, self.events.append)
+    self.con.addListener(SendBufferDrained, self.events.append)
+
+  def tearDown(self):
+    self.switch.close()
+    self.con.close()
+
+  def test_coalesce(self):
+    for i in range(3):
+      self.con.send(of.ofp_echo_request(xid=i))
+    self.assertTrue(self.con.flush())
+    self.assertEqual((self.con.send_calls, self.con.sent_messages,
+                      self.con.sent_bytes), (1, 4, 32))
+    self.assertEqual(len(self.switch.recv(1024)), 32)
+    self.assertTrue(self.con.flush())
+    self.assertEqual(self.con.send_calls, 1)
+
+  def test_watermarks(self):
+    msg = of.ofp_echo_request(body="x" * 60000).pack()
+    while not self.events:
+      self.con.send(msg)
+    self.assertTrue(isinstance(self.events[0], SendBufferFull))
+    self.assertTrue(self.con.send_blocked)
+
+    while self.con._out_len > 0:
+      self.con.flush()
+      self.switch.recv(65536)
+    self.assertTrue(isinstance(self.events[-1], SendBufferDrained))
+    self.assertFalse(self.con.send_blocked)
+    self.assertEqual(len(self.events), 2)
+
+class PollerTest(unittest.TestCase):
+  def setUp(self):
+    self.pairs = [socket.socketpair() for i in range(3)]
+
+  def tearDown(self):
+    for a, b in self.pairs:
+      a.close()
+      b.close()
+
+  def test_select(self):
+    poller = SelectPoller()
+    for a, b in self.pairs:
+      poller.register(a)
+    poller.unregister(self.pairs[2][0])
+    poller.want_write(self.pairs[0][0])
+    rl, wl, xl = poller.select_args()
+    self.assertEqual(rl, [self.pairs[0][0], self.pairs[1][0]])
+    self.assertEqual(wl, [self.pairs[0][0]])
+    self.assertEqual(poller.poll([self.pairs[1][0]], [], []),
+                     [(self.pairs[1][0], POLL_IN)])
+
+  @unittest.skipUnless(hasattr(select, "epoll"), "requires epoll")
+  def test_epoll(self):
+    poller = EpollPoller()
+    for a, b in self.pairs:
+      poller.register(a)
+    self.assertEqual(poller.select_args(), ([poller], [], []))
+    self.assertEqual(poller.poll([poller], [], []), [])
+
+    self.pairs[1][1].send("x")
+    self.assertEqual(poller.poll([poller], [], []),
+                     [(self.pairs[1][0], POLL_IN)])
+    # Edge-triggered: unread data isn't reported again
+    self.assertEqual(poller.poll([poller], [], []), [])
+
+    poller.want_write(self.pairs[0][0])
+    self.assertEqual(poller.poll([poller], [], []),
+                     [(self.pairs[0][0], POLL_OUT)])
+
+    poller.unregister(self.pairs[2][0])
+    self.pairs[2][1].send("x")
+    self.assertEqual(poller.poll([poller], [], []), [])
+    poller.close()
+
+if __name__ == '__main__':
+  unittest.main()
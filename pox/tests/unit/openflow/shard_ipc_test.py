@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import unittest
+import sys
+import os.path
+import tempfile
+import shutil
+import threading
+import time
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+sys.path.append(os.path.dirname(__file__) + "/../../../..")
+
+from pox.openflow.shard import shard_of
+from rflib.defs import *
+from rflib.ipc.RFProtocol import *
+from rflib.ipc.RFProtocolFactory import RFProtocolFactory
+from rflib.ipc.SocketIPC import SocketIPCMessageService
+
+SHARDS = 2
+DPIDS = range(1, 7)
+
+def daemon_thread(target, args):
+  t = threading.Thread(target=target, args=args)
+  t.daemon = True
+  return t
+
+class Recorder(object):
+  def __init__(self):
+    self.messages = []
+
+  def process(self, from_, to, channel, msg):
+    self.messages.append((from_, msg))
+
+def wait_for(condition, timeout=5):
+  end = time.time() + timeout
+  while not condition() and time.time() < end:
+    time.sleep(0.01)
+  return condition()
+
+class ShardIPCTest(unittest.TestCase):
+  """
+  The RFProxy shards of a controller listen on one channel, each with the
+  IPC id of its shard, and RFServer addresses messages for a datapath to
+  the id its DatapathPortRegister came from.
+  """
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    address = os.path.join(self.dir, "ipc.sock")
+    make = lambda id_: SocketIPCMessageService(address,
+                                               [RFSERVER_RFPROXY_CHANNEL],
+                                               id_, daemon_thread,
+                                               time.sleep)
+    self.server = make(RFSERVER_ID)
+    self.server_got = Recorder()
+    self.server.listen(RFSERVER_RFPROXY_CHANNEL, RFProtocolFactory(),
+                       self.server_got, False)
+    self.shards = [make(proxy_id(0, shard)) for shard in range(SHARDS)]
+    self.shards_got = [Recorder() for shard in range(SHARDS)]
+    for shard,got in zip(self.shards, self.shards_got):
+      shard.listen(RFSERVER_RFPROXY_CHANNEL, RFProtocolFactory(), got, False)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_route_mods(self):
+    for dpid in DPIDS:
+      shard = self.shards[shard_of(dpid, SHARDS)]
+      shard.send(RFSERVER_RFPROXY_CHANNEL, RFSERVER_ID,
+                 DatapathPortRegister(ct_id=0, dp_id=dpid, dp_port=1))
+    self.assertTrue(wait_for(lambda: len(self.server_got.messages) ==
+                                     len(DPIDS)))
+    proxies = dict((msg.get_dp_id(), from_)
+                   for from_,msg in self.server_got.messages)
+    self.assertEqual(proxies, dict((dpid, proxy_id(0, shard_of(dpid, SHARDS)))
+                                   for dpid in DPIDS))
+
+    for dpid in DPIDS:
+      self.server.send(RFSERVER_RFPROXY_CHANNEL, proxies[dpid],
+                       RouteMod(RMT_ADD, dpid))
+    # A mapping goes to the shards of both the datapath and the RFVS
+    mapping = DataPlaneMap(ct_id=0, dp_id=1, dp_port=1, vs_id=2, vs_port=3)
+    self.server.send_many(RFSERVER_RFPROXY_CHANNEL,
+                          [(proxies[1], mapping), (proxies[2], mapping)])
+
+    expected = len(DPIDS) + SHARDS
+    self.assertTrue(wait_for(lambda: sum(len(got.messages) for got in
+                                         self.shards_got) == expected))
+    time.sleep(0.1)
+    for shard,got in enumerate(self.shards_got):
+      route_mods = sorted(msg.get_id() for from_,msg in got.messages
+                          if msg.get_type() == ROUTE_MOD)
+      self.assertEqual(route_mods, [dpid for dpid in DPIDS
+                                    if shard_of(dpid, SHARDS) == shard])
+      self.assertEqual([msg.get_type() for from_,msg in got.messages
+                        if msg.get_type() != ROUTE_MOD], [DATA_PLANE_MAP])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import unittest
+import sys
+import os.path
+import socket
+import json
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+
+import pox.openflow.libopenflow_01 as of
+from pox.openflow.shard import *
+
+class MockFront(object):
+  def __init__(self):
+    self.handed_off = []
+
+  def hand_off(self, handshake, dpid, data):
+    self.handed_off.append((dpid, data))
+
+class MockWorker(object):
+  shard = 1
+
+  def __init__(self):
+    self.switches = []
+    self.events = []
+
+  def add_switch(self, sock, received):
+    self.switches.append((sock, received))
+
+  def handle_event(self, source, event):
+    self.events.append((source, event))
+
+def features_reply(dpid):
+  return of.ofp_features_reply(datapath_id=dpid).pack()
+
+class HandshakeTest(unittest.TestCase):
+  def setUp(self):
+    self.switch, sock = socket.socketpair()
+    sock.setblocking(0)
+    self.front = MockFront()
+    self.handshake = Handshake(sock, self.front)
+
+  def tearDown(self):
+    self.switch.close()
+    self.handshake.close()
+
+  def test_hand_off(self):
+    data = self.switch.recv(1024)
+    self.assertEqual(ord(data[1]), of.OFPT_HELLO)
+    self.assertEqual(ord(data[9]), of.OFPT_FEATURES_REQUEST)
+
+    self.switch.send(of.ofp_hello().pack() + of.ofp_echo_request(xid=7).pack())
+    self.assertTrue(self.handshake.read())
+    reply = of.ofp_echo_reply()
+    reply.unpack(self.switch.recv(1024))
+    self.assertEqual(reply.xid, 7)
+
+    rest = features_reply(0x1234) + of.ofp_echo_request().pack()
+    self.switch.send(rest[:10])
+    self.assertTrue(self.handshake.read())
+    self.switch.send(rest[10:])
+    self.assertFalse(self.handshake.read())
+    self.assertEqual(self.front.handed_off, [(0x1234, rest)])
+
+  def test_bad_version(self):
+    self.switch.send("\x04" + of.ofp_echo_request().pack()[1:])
+    self.assertFalse(self.handshake.read())
+    self.assertEqual(self.front.handed_off, [])
+
+class ChannelTest(unittest.TestCase):
+  def setUp(self):
+    self.front_end, self.worker_end = socket.socketpair(socket.AF_UNIX,
+        socket.SOCK_SEQPACKET)
+    self.front = ShardFront(2, "/nonexistent")
+    self.front.workers[1] = FrontChannel(self.front_end, self.front)
+    self.front.workers[1].shard = 1
+    self.worker = MockWorker()
+    self.channel = WorkerChannel(self.worker_end, self.worker)
+
+  def tearDown(self):
+    self.front_end.close()
+    self.worker_end.close()
+
+  def test_shard_of(self):
+    self.assertEqual([shard_of(dpid, 4) for dpid in range(1, 6)],
+                     [1, 2, 3, 0, 1])
+
+  def test_hand_off(self):
+    switch, sock = socket.socketpair()
+    handshake = Handshake(sock, self.front)
+    switch.recv(1024)
+    data = features_reply(3)
+    switch.send(of.ofp_hello().pack() + data)
+    self.assertFalse(handshake.read())
+    handshake.close()
+    self.assertEqual(self.front.handed_off, 1)
+
+    self.assertTrue(self.front.workers[1].flush())
+    self.assertTrue(self.channel.read())
+    self.assertEqual(len(self.worker.switches), 1)
+    sock, received = self.worker.switches[0]
+    self.assertEqual(received, data)
+    # The worker's copy of the socket still reaches the switch
+    sock.send("hi")
+    self.assertEqual(switch.recv(2), "hi")
+    sock.close()
+    switch.close()
+
+  def test_no_worker(self):
+    switch, sock = socket.socketpair()
+    handshake = Handshake(sock, self.front)
+    switch.send(features_reply(2))
+    self.assertFalse(handshake.read())
+    self.assertEqual(self.front.handed_off, 0)
+    switch.close()
+    sock.close()
+
+  def test_event(self):
+    other = FrontChannel(None, self.front)
+    other.shard = 0
+    other.handle(RECORD_EVENT, 0, 0, json.dumps({"switch":5, "up":True}))
+    self.assertTrue(self.front.workers[1].flush())
+    self.assertTrue(self.channel.read())
+    self.assertEqual(self.worker.events, [(0, {"switch":5, "up":True})])
+
+  def test_full_socket(self):
+    # Sends never wait for the other end to read
+    front = self.front.workers[1]
+    padding = "x" * 32000
+    for n in range(100):
+      self.assertTrue(front.send_event(-1, {"n":n, "padding":padding}))
+    self.assertFalse(front.flush())
+    while not front.flush():
+      self.assertTrue(self.channel.read(100))
+    self.assertTrue(self.channel.read(100))
+    self.assertEqual([event["n"] for source,event in self.worker.events],
+                     range(100))
+
+  def test_queue_limit(self):
+    front = self.front.workers[1]
+    for n in range(MAX_QUEUED_RECORDS):
+      self.assertTrue(front.send_record(RECORD_EVENT, -1, 0, "{}"))
+    self.assertFalse(front.send_record(RECORD_EVENT, -1, 0, "{}"))
+    front.close()
+    self.assertFalse(front.send_record(RECORD_EVENT, -1, 0, "{}"))
+
+class WorkerTest(unittest.TestCase):
+  def test_events(self):
+    worker = ShardWorker(2, 0, "/nonexistent")
+    self.assertTrue(worker.owns(4))
+    self.assertFalse(worker.owns(5))
+    self.assertFalse(worker.forward(5, "data"))
+
+    worker.handle_event(1, {"switch":5, "up":True})
+    worker.handle_event(1, {"link":[5, 1, 4, 2], "added":True})
+    self.assertEqual(worker.remote_switches, {5:1})
+    self.assertEqual(worker.remote_links.values(), [1])
+
+    worker.handle_event(-1, {"shard_down":1})
+    self.assertEqual(worker.remote_switches, {})
+    self.assertEqual(worker.remote_links, {})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,9 +1,39 @@
 MONGO_ADDRESS = "192.168.10.1:27017"
 MONGO_DB_NAME = "db"
+# Settings of the MongoDB client shared by the components of a process
+MONGO_POOL_SIZE = 32
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_READ_PREFERENCE = "PRIMARY"   # A pymongo ReadPreference name
+# Write concerns: IPC messages are fire-and-forget, table writes acknowledged.
+# Marking messages read is acknowledged too: the pooled client may run the
+# next query for unread messages on another socket, which could otherwise
+# see them unread again.
+MONGO_IPC_WRITE_CONCERN = {"w": 0}
+MONGO_IPC_MARK_READ_CONCERN = {"w": 1}
+MONGO_TABLE_WRITE_CONCERN = {"w": 1}
+# Seconds between reports of MongoDB operation latencies in the log
+MONGO_REPORT_INTERVAL = 60
+
+# IPC backends
+IPC_MONGO_POLL = "mongo-poll"   # Poll channels for unread messages
+IPC_MONGO_TAIL = "mongo-tail"   # Follow channels with tailable cursors
+IPC_SOCKET = "socket"           # Relay local channels through sockets
+IPC_BACKEND = IPC_MONGO_TAIL
+
+# Socket IPC: a Unix domain socket path or a "host:port" TCP address
+SOCKET_IPC_ADDRESS = "/tmp/routeflow-ipc.sock"
+# Copy socket IPC traffic to MongoDB so it can still be inspected (by rfweb)
+SOCKET_IPC_MIRROR = True
 
 RFCLIENT_RFSERVER_CHANNEL = "rfclient<->rfserver"
 RFSERVER_RFPROXY_CHANNEL = "rfserver<->rfproxy"
 RFMONITOR_RFPROXY_CHANNEL = "rfmonitor<->rfproxy"
+# Channels between components running on the same host. RFClient only speaks
+# MongoDB, so its channel always goes through it.
+SOCKET_IPC_CHANNELS = [RFSERVER_RFPROXY_CHANNEL, RFMONITOR_RFPROXY_CHANNEL]
+# Channels whose messages use the compact (native BSON types) codec. Only
+# Python peers understand it: leave out channels used by a C++ rfproxy.
+COMPACT_CODEC_CHANNELS = [RFSERVER_RFPROXY_CHANNEL, RFMONITOR_RFPROXY_CHANNEL]
 
 RFTABLE_NAME = "rftable"
 RFCONFIG_NAME = "rfconfig"
@@ -13,6 +43,10 @@ RFISLCONF_NAME = "rfislconf"
 RFSERVER_ID = "rfserver"
 RFPROXY_ID = "rfproxy"
 RFMONITOR_ID = "rfmonitor"
+# IPC id of the RFProxy of a controller, or of one of its shards when its
+# switches are split over several POX processes (see pox.openflow.shard)
+proxy_id = lambda ct_id, shard=None: \
+    str(ct_id) if shard is None else "%d.%d" % (ct_id, shard)
 
 DEFAULT_RFCLIENT_INTERFACE = "eth0"
 
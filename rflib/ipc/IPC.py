@@ -1,4 +1,6 @@
-class IPCMessage:
+class IPCMessage(object):
+    __slots__ = ()
+
     def get_type(self):
         raise NotImplementedError
     
@@ -34,3 +36,9 @@ class IPCMessageService:
         
     def send(channel_id, to, msg):
         raise NotImplementedError
+
+    def send_many(self, channel_id, messages):
+        """Send a list of (to, msg) pairs through a channel."""
+        for (to, msg) in messages:
+            self.send(channel_id, to, msg)
+        return True
@@ -0,0 +1,39 @@
+import rflib.ipc.MongoIPC as MongoIPC
+import rflib.ipc.SocketIPC as SocketIPC
+from rflib.defs import *
+
+class IPCServiceFactory:
+    @staticmethod
+    def make(id_, thread_constructor, sleep_function, backend=IPC_BACKEND):
+        """Build the IPCMessageService for the configured backend.
+
+        Args:
+            id_: identifier of the component the service belongs to.
+            thread_constructor: see MongoIPCMessageService.
+            sleep_function: see MongoIPCMessageService.
+            backend: one of the IPC_* backend names in rflib.defs.
+        """
+        if backend == IPC_MONGO_POLL:
+            return MongoIPC.MongoIPCMessageService(MONGO_ADDRESS,
+                                                   MONGO_DB_NAME, id_,
+                                                   thread_constructor,
+                                                   sleep_function,
+                                                   COMPACT_CODEC_CHANNELS)
+        elif backend == IPC_MONGO_TAIL:
+            return MongoIPC.MongoTailIPCMessageService(MONGO_ADDRESS,
+                                                       MONGO_DB_NAME, id_,
+                                                       thread_constructor,
+                                                       sleep_function,
+                                                       COMPACT_CODEC_CHANNELS)
+        elif backend == IPC_SOCKET:
+            fallback = IPCServiceFactory.make(id_, thread_constructor,
+                                              sleep_function, IPC_MONGO_TAIL)
+            mirror = fallback if SOCKET_IPC_MIRROR else None
+            return SocketIPC.SocketIPCMessageService(SOCKET_IPC_ADDRESS,
+                                                     SOCKET_IPC_CHANNELS, id_,
+                                                     thread_constructor,
+                                                     sleep_function,
+                                                     fallback, mirror,
+                                                     COMPACT_CODEC_CHANNELS)
+        else:
+            raise ValueError("Invalid IPC backend: " + str(backend))
@@ -0,0 +1,141 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import pymongo as mongo
+from pymongo.read_preferences import ReadPreference
+
+from rflib.defs import *
+
+def format_address(address):
+    try:
+        tmp = address.split(":")
+        if len(tmp) == 2:
+            return (tmp[0], int(tmp[1]))
+        elif len(tmp) == 1:
+            return (tmp[0],)
+    except:
+        raise ValueError, "Invalid address: " + str(address)
+
+
+class OperationStats:
+    """Counts and times MongoDB operations by name."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        except:
+            self.record(name, time.time() - start, True)
+            raise
+        self.record(name, time.time() - start)
+
+    def record(self, name, elapsed, failed=False):
+        with self._lock:
+            counters = self._counters.get(name)
+            if counters is None:
+                counters = self._counters[name] = {
+                    "count": 0,         # Operations
+                    "errors": 0,        # Operations that raised
+                    "total_ms": 0.0,    # Time spent in operations
+                    "max_ms": 0.0,      # Slowest operation
+                }
+            elapsed *= 1000
+            counters["count"] += 1
+            counters["total_ms"] += elapsed
+            counters["max_ms"] = max(counters["max_ms"], elapsed)
+            if failed:
+                counters["errors"] += 1
+
+    def snapshot(self):
+        """Return a copy of the counters of every operation."""
+        with self._lock:
+            return dict((name, dict(counters))
+                        for (name, counters) in self._counters.items())
+
+    def format(self):
+        result = []
+        for (name, c) in sorted(self.snapshot().items()):
+            result.append("%s: count=%d, errors=%d, mean=%.2fms, max=%.2fms" %
+                          (name, c["count"], c["errors"],
+                           c["total_ms"] / c["count"], c["max_ms"]))
+        return "; ".join(result)
+
+
+class MongoClientFactory:
+    """Hands out one pooled MongoDB client per address to a whole process.
+
+    Every table and IPC service of a process shares the client, and with it
+    the connection pool configured in rflib.defs. Connection and operation
+    latencies are counted in MongoClientFactory.stats.
+    """
+    _clients = {}
+    _lock = threading.Lock()
+    _reporter = None
+    stats = OperationStats()
+
+    @staticmethod
+    def get(address=MONGO_ADDRESS):
+        """Return the client for a "host[:port]" address."""
+        address = format_address(address)
+        with MongoClientFactory._lock:
+            client = MongoClientFactory._clients.get(address)
+            if client is None:
+                read_preference = getattr(ReadPreference,
+                                          MONGO_READ_PREFERENCE)
+                with MongoClientFactory.stats.timed("connect"):
+                    client = mongo.MongoClient(
+                        *address, max_pool_size=MONGO_POOL_SIZE,
+                        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                        read_preference=read_preference,
+                        **MONGO_TABLE_WRITE_CONCERN)
+                MongoClientFactory._clients[address] = client
+            return client
+
+    @staticmethod
+    def ensure_indexes(collection, indexes, log=None, **kwargs):
+        """Create the indexes a collection is queried by, if missing.
+
+        Args:
+            collection: the pymongo Collection.
+            indexes: field name tuples, each an ascending compound index.
+            log: logger told about every index created.
+            kwargs: index options, such as unique=True.
+        """
+        with MongoClientFactory.stats.timed("index"):
+            existing = set(tuple(info["key"]) for info
+                           in collection.index_information().values())
+            for fields in indexes:
+                key = [(f, mongo.ASCENDING) for f in fields]
+                if tuple(key) in existing:
+                    continue
+                collection.create_index(key, **kwargs)
+                if log is not None:
+                    log.info("Created index on %s (%s)" %
+                             (collection.name, ", ".join(fields)))
+
+    @staticmethod
+    def start_reporter(log, interval=MONGO_REPORT_INTERVAL):
+        """Log MongoClientFactory.stats every `interval` seconds."""
+        with MongoClientFactory._lock:
+            if MongoClientFactory._reporter is not None:
+                return
+            MongoClientFactory._reporter = threading.Thread(
+                target=MongoClientFactory._report, args=(log, interval))
+            MongoClientFactory._reporter.daemon = True
+            MongoClientFactory._reporter.start()
+
+    @staticmethod
+    def _report(log, interval):
+        reported = None
+        while True:
+            time.sleep(interval)
+            stats = MongoClientFactory.stats.snapshot()
+            if stats and stats != reported:
+                reported = stats
+                log.info("MongoDB operations: %s" %
+                         MongoClientFactory.stats.format())
@@ -2,17 +2,28 @@ import pymongo as mongo
 import bson
 
 import rflib.ipc.IPC as IPC
+from rflib.ipc.MongoClientFactory import MongoClientFactory, format_address
+from rflib.defs import MONGO_IPC_WRITE_CONCERN, MONGO_IPC_MARK_READ_CONCERN
 
 FROM_FIELD = "from"
 TO_FIELD = "to"
 TYPE_FIELD = "type"
 READ_FIELD = "read"
 CONTENT_FIELD = "content"
+CODEC_FIELD = "codec"
+
+# Content encodings
+CODEC_STRING = 0    # Every scalar as a string, as the C++ IPC expects
+CODEC_COMPACT = 1   # Native BSON types
 
 # 1 MB for the capped collection
 CC_SIZE = 1048576
+# Maximum number of envelopes marked as read in a single update
+READ_BATCH_SIZE = 256
+# Seconds between queries of a tailed channel while it has no unread messages
+TAIL_RETRY_INTERVAL = 0.05
 
-def put_in_envelope(from_, to, msg):
+def put_in_envelope(from_, to, msg, compact=False):
     envelope = {}
 
     envelope[FROM_FIELD] = from_
@@ -20,6 +31,11 @@ def put_in_envelope(from_, to, msg):
     envelope[READ_FIELD] = False
     envelope[TYPE_FIELD] = msg.get_type()
 
+    if compact:
+        envelope[CODEC_FIELD] = CODEC_COMPACT
+        envelope[CONTENT_FIELD] = msg.to_compact()
+        return envelope
+
     envelope[CONTENT_FIELD] = {}
     for (k, v) in msg.to_dict().items():
         envelope[CONTENT_FIELD][k] = v
@@ -28,21 +44,15 @@ def put_in_envelope(from_, to, msg):
 
 def take_from_envelope(envelope, factory):
     msg = factory.build_for_type(envelope[TYPE_FIELD]);
-    msg.from_dict(envelope[CONTENT_FIELD]);
+    if envelope.get(CODEC_FIELD) == CODEC_COMPACT:
+        msg.from_compact(envelope[CONTENT_FIELD])
+    else:
+        msg.from_dict(envelope[CONTENT_FIELD]);
     return msg;
 
-def format_address(address):
-    try:
-        tmp = address.split(":")
-        if len(tmp) == 2:
-            return (tmp[0], int(tmp[1]))
-        elif len(tmp) == 1:
-            return (tmp[0],)
-    except:
-        raise ValueError, "Invalid address: " + str(address)
-            
 class MongoIPCMessageService(IPC.IPCMessageService):
-    def __init__(self, address, db, id_, thread_constructor, sleep_function):
+    def __init__(self, address, db, id_, thread_constructor, sleep_function,
+                 compact_channels=()):
         """Construct an IPCMessageService
 
         Args:
@@ -55,13 +65,17 @@ class MongoIPCMessageService(IPC.IPCMessageService):
                 return an object that has start() and join() functions.
             sleep_function: function that takes a float and delays processing
                 for the specified period.
+            compact_channels: channels whose messages are sent with the
+                compact codec. Only use it for channels without C++ peers.
         """
         self._db = db
         self.address = format_address(address)
         self._id = id_
-        self._producer_connection = mongo.Connection(*self.address)
+        self._connection = MongoClientFactory.get(address)
         self._threading = thread_constructor
         self._sleep = sleep_function
+        self._channels = set()
+        self._compact_channels = set(compact_channels)
         
     def listen(self, channel_id, factory, processor, block=True):
         worker = self._threading(target=self._listen_worker,
@@ -71,38 +85,112 @@ class MongoIPCMessageService(IPC.IPCMessageService):
             worker.join()
         
     def send(self, channel_id, to, msg):
-        self._create_channel(self._producer_connection, channel_id)
-        collection = self._producer_connection[self._db][channel_id]
-        collection.insert(put_in_envelope(self.get_id(), to, msg))
+        return self.insert_envelopes(channel_id,
+                                     [put_in_envelope(self.get_id(), to, msg,
+                                                      channel_id in self._compact_channels)])
+
+    def send_many(self, channel_id, messages):
+        compact = channel_id in self._compact_channels
+        return self.insert_envelopes(channel_id,
+                                     [put_in_envelope(self.get_id(), to, msg,
+                                                      compact)
+                                      for (to, msg) in messages])
+
+    def insert_envelopes(self, channel_id, envelopes):
+        """Store already built envelopes in a channel with a single insert."""
+        if not envelopes:
+            return True
+        self._create_channel(self._connection, channel_id)
+        collection = self._connection[self._db][channel_id]
+        with MongoClientFactory.stats.timed("ipc_insert"):
+            collection.insert(envelopes, **MONGO_IPC_WRITE_CONCERN)
         return True
 
     def _listen_worker(self, channel_id, factory, processor):
-        connection = mongo.Connection(*self.address)
+        connection = self._connection
         self._create_channel(connection, channel_id)
         
         collection = connection[self._db][channel_id]
-        cursor = collection.find({TO_FIELD: self.get_id(), READ_FIELD: False}, sort=[("_id", mongo.ASCENDING)])
-
         while True:
-            for envelope in cursor:
+            with MongoClientFactory.stats.timed("ipc_poll"):
+                envelopes = list(collection.find({TO_FIELD: self.get_id(), READ_FIELD: False}, sort=[("_id", mongo.ASCENDING)]))
+            for envelope in envelopes:
                 msg = take_from_envelope(envelope, factory)
                 processor.process(envelope[FROM_FIELD], envelope[TO_FIELD], channel_id, msg);
-                collection.update({"_id": envelope["_id"]}, {"$set": {READ_FIELD: True}})
+                with MongoClientFactory.stats.timed("ipc_mark_read"):
+                    collection.update({"_id": envelope["_id"]}, {"$set": {READ_FIELD: True}},
+                                      **MONGO_IPC_MARK_READ_CONCERN)
             self._sleep(0.05)
-            cursor = collection.find({TO_FIELD: self.get_id(), READ_FIELD: False}, sort=[("_id", mongo.ASCENDING)])
                 
     def _create_channel(self, connection, name):
+        # Channels only need to be created and indexed once
+        if name in self._channels:
+            return
         db = connection[self._db]
         try:
             collection = mongo.collection.Collection(db, name, None, True, capped=True, size=CC_SIZE)
-            collection.ensure_index([("_id", mongo.ASCENDING)])
-            collection.ensure_index([(TO_FIELD, mongo.ASCENDING)])
         # TODO: improve this catch. It should be more specific, but pymongo
         # behavior doesn't match its documentation, so we are being dirty.
         except:
-            pass
+            collection = db[name]
+        # Unread messages are looked up by recipient
+        MongoClientFactory.ensure_indexes(collection, [("_id",), (TO_FIELD,),
+                                                       (TO_FIELD, READ_FIELD)])
+        # Only once that succeeded, so a failure is retried on the next call
+        self._channels.add(name)
+
+class MongoTailIPCMessageService(MongoIPCMessageService):
+    """An IPCMessageService that is notified of new messages by MongoDB.
+
+    Instead of polling for unread messages, each listener follows the capped
+    channel collection with a tailable, await-data cursor, so messages are
+    delivered as soon as they are inserted. Envelopes are still marked as
+    read, but with a single update per burst of messages instead of one per
+    message.
+
+    A tailable cursor dies when its query matches nothing, so an idle
+    listener queries again every TAIL_RETRY_INTERVAL, like the polling
+    service does; it only waits on the cursor once messages arrived.
+    """
+    def _listen_worker(self, channel_id, factory, processor):
+        connection = self._connection
+        self._create_channel(connection, channel_id)
+
+        collection = connection[self._db][channel_id]
+        # _ids are made by each sender, so they don't follow insertion order
+        # and can't tell where to resume: read marks do
+        query = {TO_FIELD: self.get_id(), READ_FIELD: False}
+
+        while True:
+            cursor = collection.find(query, tailable=True, await_data=True,
+                                     sort=[("$natural", mongo.ASCENDING)])
+            read = []
+            while cursor.alive:
+                for envelope in cursor:
+                    msg = take_from_envelope(envelope, factory)
+                    processor.process(envelope[FROM_FIELD], envelope[TO_FIELD], channel_id, msg);
+                    read.append(envelope["_id"])
+                    if len(read) >= READ_BATCH_SIZE:
+                        self._mark_read(collection, read)
+                        read = []
+                # The cursor has no more data for now. Marks are acknowledged,
+                # so the next query won't see these envelopes again.
+                self._mark_read(collection, read)
+                read = []
+            # The cursor died: its query matched nothing, the collection is
+            # empty or the capped collection wrapped over its position
+            self._sleep(TAIL_RETRY_INTERVAL)
+
+    def _mark_read(self, collection, ids):
+        if ids:
+            with MongoClientFactory.stats.timed("ipc_mark_read"):
+                collection.update({"_id": {"$in": ids}},
+                                  {"$set": {READ_FIELD: True}}, multi=True,
+                                  **MONGO_IPC_MARK_READ_CONCERN)
 
 class MongoIPCMessage(dict, IPC.IPCMessage):
+    __slots__ = ("_type",)
+
     def __init__(self, type_, **kwargs):
         dict.__init__(self)
         self.from_dict(kwargs)
@@ -539,12 +539,18 @@ ControllerRegister::ControllerRegister() {
     set_ct_addr(IPAddress(IPV4));
     set_ct_port(0);
     set_ct_role("");
+    set_ct_datapaths(0);
+    set_ct_backlog(0);
+    set_ct_packet_in_rate(0);
 }
 
-ControllerRegister::ControllerRegister(IPAddress ct_addr, uint32_t ct_port, string ct_role) {
+ControllerRegister::ControllerRegister(IPAddress ct_addr, uint32_t ct_port, string ct_role, uint32_t ct_datapaths, uint32_t ct_backlog, uint32_t ct_packet_in_rate) {
     set_ct_addr(ct_addr);
     set_ct_port(ct_port);
     set_ct_role(ct_role);
+    set_ct_datapaths(ct_datapaths);
+    set_ct_backlog(ct_backlog);
+    set_ct_packet_in_rate(ct_packet_in_rate);
 }
 
 int ControllerRegister::get_type() {
@@ -575,11 +581,38 @@ void ControllerRegister::set_ct_role(string ct_role) {
     this->ct_role = ct_role;
 }
 
+uint32_t ControllerRegister::get_ct_datapaths() {
+    return this->ct_datapaths;
+}
+
+void ControllerRegister::set_ct_datapaths(uint32_t ct_datapaths) {
+    this->ct_datapaths = ct_datapaths;
+}
+
+uint32_t ControllerRegister::get_ct_backlog() {
+    return this->ct_backlog;
+}
+
+void ControllerRegister::set_ct_backlog(uint32_t ct_backlog) {
+    this->ct_backlog = ct_backlog;
+}
+
+uint32_t ControllerRegister::get_ct_packet_in_rate() {
+    return this->ct_packet_in_rate;
+}
+
+void ControllerRegister::set_ct_packet_in_rate(uint32_t ct_packet_in_rate) {
+    this->ct_packet_in_rate = ct_packet_in_rate;
+}
+
 void ControllerRegister::from_BSON(const char* data) {
     mongo::BSONObj obj(data);
     set_ct_addr(IPAddress(IPV4, obj["ct_addr"].String()));
     set_ct_port(string_to<uint32_t>(obj["ct_port"].String()));
     set_ct_role(obj["ct_role"].String());
+    set_ct_datapaths(obj.hasField("ct_datapaths") ? string_to<uint32_t>(obj["ct_datapaths"].String()) : 0);
+    set_ct_backlog(obj.hasField("ct_backlog") ? string_to<uint32_t>(obj["ct_backlog"].String()) : 0);
+    set_ct_packet_in_rate(obj.hasField("ct_packet_in_rate") ? string_to<uint32_t>(obj["ct_packet_in_rate"].String()) : 0);
 }
 
 const char* ControllerRegister::to_BSON() {
@@ -587,6 +620,9 @@ const char* ControllerRegister::to_BSON() {
     _b.append("ct_addr", get_ct_addr().toString());
     _b.append("ct_port", to_string<uint32_t>(get_ct_port()));
     _b.append("ct_role", get_ct_role());
+    _b.append("ct_datapaths", to_string<uint32_t>(get_ct_datapaths()));
+    _b.append("ct_backlog", to_string<uint32_t>(get_ct_backlog()));
+    _b.append("ct_packet_in_rate", to_string<uint32_t>(get_ct_packet_in_rate()));
     mongo::BSONObj o = _b.obj();
     char* data = new char[o.objsize()];
     memcpy(data, o.objdata(), o.objsize());
@@ -599,17 +635,24 @@ string ControllerRegister::str() {
     ss << "  ct_addr: " << get_ct_addr().toString() << endl;
     ss << "  ct_port: " << to_string<uint32_t>(get_ct_port()) << endl;
     ss << "  ct_role: " << get_ct_role() << endl;
+    ss << "  ct_datapaths: " << to_string<uint32_t>(get_ct_datapaths()) << endl;
+    ss << "  ct_backlog: " << to_string<uint32_t>(get_ct_backlog()) << endl;
+    ss << "  ct_packet_in_rate: " << to_string<uint32_t>(get_ct_packet_in_rate()) << endl;
     return ss.str();
 }
 
 ElectMaster::ElectMaster() {
     set_ct_addr(IPAddress(IPV4));
     set_ct_port(0);
+    set_shard(0);
+    set_shards(0);
 }
 
-ElectMaster::ElectMaster(IPAddress ct_addr, uint32_t ct_port) {
+ElectMaster::ElectMaster(IPAddress ct_addr, uint32_t ct_port, uint32_t shard, uint32_t shards) {
     set_ct_addr(ct_addr);
     set_ct_port(ct_port);
+    set_shard(shard);
+    set_shards(shards);
 }
 
 int ElectMaster::get_type() {
@@ -632,16 +675,36 @@ void ElectMaster::set_ct_port(uint32_t ct_port) {
     this->ct_port = ct_port;
 }
 
+uint32_t ElectMaster::get_shard() {
+    return this->shard;
+}
+
+void ElectMaster::set_shard(uint32_t shard) {
+    this->shard = shard;
+}
+
+uint32_t ElectMaster::get_shards() {
+    return this->shards;
+}
+
+void ElectMaster::set_shards(uint32_t shards) {
+    this->shards = shards;
+}
+
 void ElectMaster::from_BSON(const char* data) {
     mongo::BSONObj obj(data);
     set_ct_addr(IPAddress(IPV4, obj["ct_addr"].String()));
     set_ct_port(string_to<uint32_t>(obj["ct_port"].String()));
+    set_shard(obj.hasField("shard") ? string_to<uint32_t>(obj["shard"].String()) : 0);
+    set_shards(obj.hasField("shards") ? string_to<uint32_t>(obj["shards"].String()) : 0);
 }
 
 const char* ElectMaster::to_BSON() {
     mongo::BSONObjBuilder _b;
     _b.append("ct_addr", get_ct_addr().toString());
     _b.append("ct_port", to_string<uint32_t>(get_ct_port()));
+    _b.append("shard", to_string<uint32_t>(get_shard()));
+    _b.append("shards", to_string<uint32_t>(get_shards()));
     mongo::BSONObj o = _b.obj();
     char* data = new char[o.objsize()];
     memcpy(data, o.objdata(), o.objsize());
@@ -653,5 +716,113 @@ string ElectMaster::str() {
     ss << "ElectMaster" << endl;
     ss << "  ct_addr: " << get_ct_addr().toString() << endl;
     ss << "  ct_port: " << to_string<uint32_t>(get_ct_port()) << endl;
+    ss << "  shard: " << to_string<uint32_t>(get_shard()) << endl;
+    ss << "  shards: " << to_string<uint32_t>(get_shards()) << endl;
+    return ss.str();
+}
+
+DatapathFlowStatus::DatapathFlowStatus() {
+    set_ct_id(0);
+    set_dp_id(0);
+    set_installed(0);
+    set_failed(0);
+    set_pending(0);
+    set_install_rate(0);
+}
+
+DatapathFlowStatus::DatapathFlowStatus(uint64_t ct_id, uint64_t dp_id, uint32_t installed, uint32_t failed, uint32_t pending, uint32_t install_rate) {
+    set_ct_id(ct_id);
+    set_dp_id(dp_id);
+    set_installed(installed);
+    set_failed(failed);
+    set_pending(pending);
+    set_install_rate(install_rate);
+}
+
+int DatapathFlowStatus::get_type() {
+    return DATAPATH_FLOW_STATUS;
+}
+
+uint64_t DatapathFlowStatus::get_ct_id() {
+    return this->ct_id;
+}
+
+void DatapathFlowStatus::set_ct_id(uint64_t ct_id) {
+    this->ct_id = ct_id;
+}
+
+uint64_t DatapathFlowStatus::get_dp_id() {
+    return this->dp_id;
+}
+
+void DatapathFlowStatus::set_dp_id(uint64_t dp_id) {
+    this->dp_id = dp_id;
+}
+
+uint32_t DatapathFlowStatus::get_installed() {
+    return this->installed;
+}
+
+void DatapathFlowStatus::set_installed(uint32_t installed) {
+    this->installed = installed;
+}
+
+uint32_t DatapathFlowStatus::get_failed() {
+    return this->failed;
+}
+
+void DatapathFlowStatus::set_failed(uint32_t failed) {
+    this->failed = failed;
+}
+
+uint32_t DatapathFlowStatus::get_pending() {
+    return this->pending;
+}
+
+void DatapathFlowStatus::set_pending(uint32_t pending) {
+    this->pending = pending;
+}
+
+uint32_t DatapathFlowStatus::get_install_rate() {
+    return this->install_rate;
+}
+
+void DatapathFlowStatus::set_install_rate(uint32_t install_rate) {
+    this->install_rate = install_rate;
+}
+
+void DatapathFlowStatus::from_BSON(const char* data) {
+    mongo::BSONObj obj(data);
+    set_ct_id(string_to<uint64_t>(obj["ct_id"].String()));
+    set_dp_id(string_to<uint64_t>(obj["dp_id"].String()));
+    set_installed(string_to<uint32_t>(obj["installed"].String()));
+    set_failed(string_to<uint32_t>(obj["failed"].String()));
+    set_pending(string_to<uint32_t>(obj["pending"].String()));
+    set_install_rate(string_to<uint32_t>(obj["install_rate"].String()));
+}
+
+const char* DatapathFlowStatus::to_BSON() {
+    mongo::BSONObjBuilder _b;
+    _b.append("ct_id", to_string<uint64_t>(get_ct_id()));
+    _b.append("dp_id", to_string<uint64_t>(get_dp_id()));
+    _b.append("installed", to_string<uint32_t>(get_installed()));
+    _b.append("failed", to_string<uint32_t>(get_failed()));
+    _b.append("pending", to_string<uint32_t>(get_pending()));
+    _b.append("install_rate", to_string<uint32_t>(get_install_rate()));
+    mongo::BSONObj o = _b.obj();
+    char* data = new char[o.objsize()];
+    memcpy(data, o.objdata(), o.objsize());
+    return data;
+}
+
+string DatapathFlowStatus::str() {
+    stringstream ss;
+    ss << "DatapathFlowStatus" << endl;
+    ss << "  ct_id: " << to_string<uint64_t>(get_ct_id()) << endl;
+    ss << "  dp_id: " << to_string<uint64_t>(get_dp_id()) << endl;
+    ss << "  installed: " << to_string<uint32_t>(get_installed()) << endl;
+    ss << "  failed: " << to_string<uint32_t>(get_failed()) << endl;
+    ss << "  pending: " << to_string<uint32_t>(get_pending()) << endl;
+    ss << "  install_rate: " << to_string<uint32_t>(get_install_rate()) << endl;
     return ss.str();
 }
@@ -20,7 +20,8 @@ enum {
 	DATA_PLANE_MAP,
 	ROUTE_MOD,
 	CONTROLLER_REGISTER,
-	ELECT_MASTER
+	ELECT_MASTER,
+	DATAPATH_FLOW_STATUS
 };
 
 class PortRegister : public IPCMessage {
@@ -220,7 +221,7 @@ class RouteMod : public IPCMessage {
 class ControllerRegister : public IPCMessage {
     public:
         ControllerRegister();
-        ControllerRegister(IPAddress ct_addr, uint32_t ct_port, string ct_role);
+        ControllerRegister(IPAddress ct_addr, uint32_t ct_port, string ct_role, uint32_t ct_datapaths, uint32_t ct_backlog, uint32_t ct_packet_in_rate);
 
         IPAddress get_ct_addr();
         void set_ct_addr(IPAddress ct_addr);
@@ -231,6 +232,15 @@ class ControllerRegister : public IPCMessage {
         string get_ct_role();
         void set_ct_role(string ct_role);
 
+        uint32_t get_ct_datapaths();
+        void set_ct_datapaths(uint32_t ct_datapaths);
+
+        uint32_t get_ct_backlog();
+        void set_ct_backlog(uint32_t ct_backlog);
+
+        uint32_t get_ct_packet_in_rate();
+        void set_ct_packet_in_rate(uint32_t ct_packet_in_rate);
+
         virtual int get_type();
         virtual void from_BSON(const char* data);
         virtual const char* to_BSON();
@@ -240,12 +250,15 @@ class ControllerRegister : public IPCMessage {
         IPAddress ct_addr;
         uint32_t ct_port;
         string ct_role;
+        uint32_t ct_datapaths;
+        uint32_t ct_backlog;
+        uint32_t ct_packet_in_rate;
 };
 
 class ElectMaster : public IPCMessage {
     public:
         ElectMaster();
-        ElectMaster(IPAddress ct_addr, uint32_t ct_port);
+        ElectMaster(IPAddress ct_addr, uint32_t ct_port, uint32_t shard, uint32_t shards);
 
         IPAddress get_ct_addr();
         void set_ct_addr(IPAddress ct_addr);
@@ -253,6 +266,12 @@ class ElectMaster : public IPCMessage {
         uint32_t get_ct_port();
         void set_ct_port(uint32_t ct_port);
 
+        uint32_t get_shard();
+        void set_shard(uint32_t shard);
+
+        uint32_t get_shards();
+        void set_shards(uint32_t shards);
+
         virtual int get_type();
         virtual void from_BSON(const char* data);
         virtual const char* to_BSON();
@@ -261,6 +280,45 @@ class ElectMaster : public IPCMessage {
     private:
         IPAddress ct_addr;
         uint32_t ct_port;
+        uint32_t shard;
+        uint32_t shards;
+};
+
+class DatapathFlowStatus : public IPCMessage {
+    public:
+        DatapathFlowStatus();
+        DatapathFlowStatus(uint64_t ct_id, uint64_t dp_id, uint32_t installed, uint32_t failed, uint32_t pending, uint32_t install_rate);
+
+        uint64_t get_ct_id();
+        void set_ct_id(uint64_t ct_id);
+
+        uint64_t get_dp_id();
+        void set_dp_id(uint64_t dp_id);
+
+        uint32_t get_installed();
+        void set_installed(uint32_t installed);
+
+        uint32_t get_failed();
+        void set_failed(uint32_t failed);
+
+        uint32_t get_pending();
+        void set_pending(uint32_t pending);
+
+        uint32_t get_install_rate();
+        void set_install_rate(uint32_t install_rate);
+
+        virtual int get_type();
+        virtual void from_BSON(const char* data);
+        virtual const char* to_BSON();
+        virtual string str();
+
+    private:
+        uint64_t ct_id;
+        uint64_t dp_id;
+        uint32_t installed;
+        uint32_t failed;
+        uint32_t pending;
+        uint32_t install_rate;
 };
 
 #endif /* __RFPROTOCOL_H__ */
\ No newline at end of file
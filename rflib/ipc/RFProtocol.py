@@ -6,6 +6,7 @@ from rflib.types.Option import Option
 from MongoIPC import MongoIPCMessage
 
 format_id = lambda dp_id: hex(dp_id).rstrip('L')
+to_int64 = lambda v: v - (1 << 64) if v >> 63 else v
 
 PORT_REGISTER = 0
 PORT_CONFIG = 1
@@ -16,9 +17,12 @@ DATA_PLANE_MAP = 5
 ROUTE_MOD = 6
 CONTROLLER_REGISTER = 7
 ELECT_MASTER = 8
+DATAPATH_FLOW_STATUS = 9
 
 
 class PortRegister(MongoIPCMessage):
+    __slots__ = ("vm_id", "vm_port", "hwaddress",)
+
     def __init__(self, vm_id=None, vm_port=None, hwaddress=None):
         self.set_vm_id(vm_id)
         self.set_vm_port(vm_port)
@@ -69,6 +73,18 @@ class PortRegister(MongoIPCMessage):
         data["hwaddress"] = str(self.get_hwaddress())
         return data
 
+    def from_compact(self, data):
+        self.vm_id = data["vm_id"] & 0xFFFFFFFFFFFFFFFF
+        self.vm_port = data["vm_port"]
+        self.hwaddress = str(data["hwaddress"])
+
+    def to_compact(self):
+        return {
+            "vm_id": to_int64(self.vm_id),
+            "vm_port": self.vm_port,
+            "hwaddress": self.hwaddress,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -85,6 +101,8 @@ class PortRegister(MongoIPCMessage):
 
 
 class PortConfig(MongoIPCMessage):
+    __slots__ = ("vm_id", "vm_port", "operation_id",)
+
     def __init__(self, vm_id=None, vm_port=None, operation_id=None):
         self.set_vm_id(vm_id)
         self.set_vm_port(vm_port)
@@ -135,6 +153,18 @@ class PortConfig(MongoIPCMessage):
         data["operation_id"] = str(self.get_operation_id())
         return data
 
+    def from_compact(self, data):
+        self.vm_id = data["vm_id"] & 0xFFFFFFFFFFFFFFFF
+        self.vm_port = data["vm_port"]
+        self.operation_id = data["operation_id"]
+
+    def to_compact(self):
+        return {
+            "vm_id": to_int64(self.vm_id),
+            "vm_port": self.vm_port,
+            "operation_id": self.operation_id,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -151,6 +181,8 @@ class PortConfig(MongoIPCMessage):
 
 
 class DatapathPortRegister(MongoIPCMessage):
+    __slots__ = ("ct_id", "dp_id", "dp_port",)
+
     def __init__(self, ct_id=None, dp_id=None, dp_port=None):
         self.set_ct_id(ct_id)
         self.set_dp_id(dp_id)
@@ -201,6 +233,18 @@ class DatapathPortRegister(MongoIPCMessage):
         data["dp_port"] = str(self.get_dp_port())
         return data
 
+    def from_compact(self, data):
+        self.ct_id = data["ct_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_id = data["dp_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_port = data["dp_port"]
+
+    def to_compact(self):
+        return {
+            "ct_id": to_int64(self.ct_id),
+            "dp_id": to_int64(self.dp_id),
+            "dp_port": self.dp_port,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -217,6 +261,8 @@ class DatapathPortRegister(MongoIPCMessage):
 
 
 class DatapathDown(MongoIPCMessage):
+    __slots__ = ("ct_id", "dp_id",)
+
     def __init__(self, ct_id=None, dp_id=None):
         self.set_ct_id(ct_id)
         self.set_dp_id(dp_id)
@@ -254,6 +300,16 @@ class DatapathDown(MongoIPCMessage):
         data["dp_id"] = str(self.get_dp_id())
         return data
 
+    def from_compact(self, data):
+        self.ct_id = data["ct_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_id = data["dp_id"] & 0xFFFFFFFFFFFFFFFF
+
+    def to_compact(self):
+        return {
+            "ct_id": to_int64(self.ct_id),
+            "dp_id": to_int64(self.dp_id),
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -269,6 +325,8 @@ class DatapathDown(MongoIPCMessage):
 
 
 class VirtualPlaneMap(MongoIPCMessage):
+    __slots__ = ("vm_id", "vm_port", "vs_id", "vs_port",)
+
     def __init__(self, vm_id=None, vm_port=None, vs_id=None, vs_port=None):
         self.set_vm_id(vm_id)
         self.set_vm_port(vm_port)
@@ -332,6 +390,20 @@ class VirtualPlaneMap(MongoIPCMessage):
         data["vs_port"] = str(self.get_vs_port())
         return data
 
+    def from_compact(self, data):
+        self.vm_id = data["vm_id"] & 0xFFFFFFFFFFFFFFFF
+        self.vm_port = data["vm_port"]
+        self.vs_id = data["vs_id"] & 0xFFFFFFFFFFFFFFFF
+        self.vs_port = data["vs_port"]
+
+    def to_compact(self):
+        return {
+            "vm_id": to_int64(self.vm_id),
+            "vm_port": self.vm_port,
+            "vs_id": to_int64(self.vs_id),
+            "vs_port": self.vs_port,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -349,6 +421,8 @@ class VirtualPlaneMap(MongoIPCMessage):
 
 
 class DataPlaneMap(MongoIPCMessage):
+    __slots__ = ("ct_id", "dp_id", "dp_port", "vs_id", "vs_port",)
+
     def __init__(self, ct_id=None, dp_id=None, dp_port=None, vs_id=None, vs_port=None):
         self.set_ct_id(ct_id)
         self.set_dp_id(dp_id)
@@ -425,6 +499,22 @@ class DataPlaneMap(MongoIPCMessage):
         data["vs_port"] = str(self.get_vs_port())
         return data
 
+    def from_compact(self, data):
+        self.ct_id = data["ct_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_id = data["dp_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_port = data["dp_port"]
+        self.vs_id = data["vs_id"] & 0xFFFFFFFFFFFFFFFF
+        self.vs_port = data["vs_port"]
+
+    def to_compact(self):
+        return {
+            "ct_id": to_int64(self.ct_id),
+            "dp_id": to_int64(self.dp_id),
+            "dp_port": self.dp_port,
+            "vs_id": to_int64(self.vs_id),
+            "vs_port": self.vs_port,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -443,6 +533,8 @@ class DataPlaneMap(MongoIPCMessage):
 
 
 class RouteMod(MongoIPCMessage):
+    __slots__ = ("mod", "id", "matches", "actions", "options",)
+
     def __init__(self, mod=None, id=None, matches=None, actions=None, options=None):
         self.set_mod(mod)
         self.set_id(id)
@@ -528,6 +620,22 @@ class RouteMod(MongoIPCMessage):
         data["options"] = self.get_options()
         return data
 
+    def from_compact(self, data):
+        self.mod = data["mod"]
+        self.id = data["id"] & 0xFFFFFFFFFFFFFFFF
+        self.matches = data["matches"]
+        self.actions = data["actions"]
+        self.options = data["options"]
+
+    def to_compact(self):
+        return {
+            "mod": self.mod,
+            "id": to_int64(self.id),
+            "matches": self.matches,
+            "actions": self.actions,
+            "options": self.options,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -552,10 +660,15 @@ class RouteMod(MongoIPCMessage):
 
 
 class ControllerRegister(MongoIPCMessage):
-    def __init__(self, ct_addr=None, ct_port=None, ct_role=None):
+    __slots__ = ("ct_addr", "ct_port", "ct_role", "ct_datapaths", "ct_backlog", "ct_packet_in_rate",)
+
+    def __init__(self, ct_addr=None, ct_port=None, ct_role=None, ct_datapaths=None, ct_backlog=None, ct_packet_in_rate=None):
         self.set_ct_addr(ct_addr)
         self.set_ct_port(ct_port)
         self.set_ct_role(ct_role)
+        self.set_ct_datapaths(ct_datapaths)
+        self.set_ct_backlog(ct_backlog)
+        self.set_ct_packet_in_rate(ct_packet_in_rate)
 
     def get_type(self):
         return CONTROLLER_REGISTER
@@ -590,18 +703,72 @@ class ControllerRegister(MongoIPCMessage):
         except:
             self.ct_role = ""
 
+    def get_ct_datapaths(self):
+        return self.ct_datapaths
+
+    def set_ct_datapaths(self, ct_datapaths):
+        ct_datapaths = 0 if ct_datapaths is None else ct_datapaths
+        try:
+            self.ct_datapaths = int(ct_datapaths)
+        except:
+            self.ct_datapaths = 0
+
+    def get_ct_backlog(self):
+        return self.ct_backlog
+
+    def set_ct_backlog(self, ct_backlog):
+        ct_backlog = 0 if ct_backlog is None else ct_backlog
+        try:
+            self.ct_backlog = int(ct_backlog)
+        except:
+            self.ct_backlog = 0
+
+    def get_ct_packet_in_rate(self):
+        return self.ct_packet_in_rate
+
+    def set_ct_packet_in_rate(self, ct_packet_in_rate):
+        ct_packet_in_rate = 0 if ct_packet_in_rate is None else ct_packet_in_rate
+        try:
+            self.ct_packet_in_rate = int(ct_packet_in_rate)
+        except:
+            self.ct_packet_in_rate = 0
+
     def from_dict(self, data):
         self.set_ct_addr(data["ct_addr"])
         self.set_ct_port(data["ct_port"])
         self.set_ct_role(data["ct_role"])
+        self.set_ct_datapaths(data.get("ct_datapaths"))
+        self.set_ct_backlog(data.get("ct_backlog"))
+        self.set_ct_packet_in_rate(data.get("ct_packet_in_rate"))
 
     def to_dict(self):
         data = {}
         data["ct_addr"] = str(self.get_ct_addr())
         data["ct_port"] = str(self.get_ct_port())
         data["ct_role"] = self.get_ct_role()
+        data["ct_datapaths"] = str(self.get_ct_datapaths())
+        data["ct_backlog"] = str(self.get_ct_backlog())
+        data["ct_packet_in_rate"] = str(self.get_ct_packet_in_rate())
         return data
 
+    def from_compact(self, data):
+        self.ct_addr = str(data["ct_addr"])
+        self.ct_port = data["ct_port"]
+        self.ct_role = str(data["ct_role"])
+        self.ct_datapaths = data.get("ct_datapaths", 0)
+        self.ct_backlog = data.get("ct_backlog", 0)
+        self.ct_packet_in_rate = data.get("ct_packet_in_rate", 0)
+
+    def to_compact(self):
+        return {
+            "ct_addr": self.ct_addr,
+            "ct_port": self.ct_port,
+            "ct_role": self.ct_role,
+            "ct_datapaths": self.ct_datapaths,
+            "ct_backlog": self.ct_backlog,
+            "ct_packet_in_rate": self.ct_packet_in_rate,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -614,13 +781,20 @@ class ControllerRegister(MongoIPCMessage):
         s += "  ct_addr: " + str(self.get_ct_addr()) + "\n"
         s += "  ct_port: " + str(self.get_ct_port()) + "\n"
         s += "  ct_role: " + str(self.get_ct_role()) + "\n"
+        s += "  ct_datapaths: " + str(self.get_ct_datapaths()) + "\n"
+        s += "  ct_backlog: " + str(self.get_ct_backlog()) + "\n"
+        s += "  ct_packet_in_rate: " + str(self.get_ct_packet_in_rate()) + "\n"
         return s
 
 
 class ElectMaster(MongoIPCMessage):
-    def __init__(self, ct_addr=None, ct_port=None):
+    __slots__ = ("ct_addr", "ct_port", "shard", "shards",)
+
+    def __init__(self, ct_addr=None, ct_port=None, shard=None, shards=None):
         self.set_ct_addr(ct_addr)
         self.set_ct_port(ct_port)
+        self.set_shard(shard)
+        self.set_shards(shards)
 
     def get_type(self):
         return ELECT_MASTER
@@ -645,16 +819,54 @@ class ElectMaster(MongoIPCMessage):
         except:
             self.ct_port = 0
 
+    def get_shard(self):
+        return self.shard
+
+    def set_shard(self, shard):
+        shard = 0 if shard is None else shard
+        try:
+            self.shard = int(shard)
+        except:
+            self.shard = 0
+
+    def get_shards(self):
+        return self.shards
+
+    def set_shards(self, shards):
+        shards = 0 if shards is None else shards
+        try:
+            self.shards = int(shards)
+        except:
+            self.shards = 0
+
     def from_dict(self, data):
         self.set_ct_addr(data["ct_addr"])
         self.set_ct_port(data["ct_port"])
+        self.set_shard(data.get("shard"))
+        self.set_shards(data.get("shards"))
 
     def to_dict(self):
         data = {}
         data["ct_addr"] = str(self.get_ct_addr())
         data["ct_port"] = str(self.get_ct_port())
+        data["shard"] = str(self.get_shard())
+        data["shards"] = str(self.get_shards())
         return data
 
+    def from_compact(self, data):
+        self.ct_addr = str(data["ct_addr"])
+        self.ct_port = data["ct_port"]
+        self.shard = data.get("shard", 0)
+        self.shards = data.get("shards", 0)
+
+    def to_compact(self):
+        return {
+            "ct_addr": self.ct_addr,
+            "ct_port": self.ct_port,
+            "shard": self.shard,
+            "shards": self.shards,
+        }
+
     def from_bson(self, data):
         data = bson.BSON.decode(data)
         self.from_dict(data)
@@ -666,4 +878,134 @@ class ElectMaster(MongoIPCMessage):
         s = "ElectMaster\n"
         s += "  ct_addr: " + str(self.get_ct_addr()) + "\n"
         s += "  ct_port: " + str(self.get_ct_port()) + "\n"
+        s += "  shard: " + str(self.get_shard()) + "\n"
+        s += "  shards: " + str(self.get_shards()) + "\n"
+        return s
+
+
+class DatapathFlowStatus(MongoIPCMessage):
+    __slots__ = ("ct_id", "dp_id", "installed", "failed", "pending", "install_rate",)
+
+    def __init__(self, ct_id=None, dp_id=None, installed=None, failed=None, pending=None, install_rate=None):
+        self.set_ct_id(ct_id)
+        self.set_dp_id(dp_id)
+        self.set_installed(installed)
+        self.set_failed(failed)
+        self.set_pending(pending)
+        self.set_install_rate(install_rate)
+
+    def get_type(self):
+        return DATAPATH_FLOW_STATUS
+
+    def get_ct_id(self):
+        return self.ct_id
+
+    def set_ct_id(self, ct_id):
+        ct_id = 0 if ct_id is None else ct_id
+        try:
+            self.ct_id = int(ct_id)
+        except:
+            self.ct_id = 0
+
+    def get_dp_id(self):
+        return self.dp_id
+
+    def set_dp_id(self, dp_id):
+        dp_id = 0 if dp_id is None else dp_id
+        try:
+            self.dp_id = int(dp_id)
+        except:
+            self.dp_id = 0
+
+    def get_installed(self):
+        return self.installed
+
+    def set_installed(self, installed):
+        installed = 0 if installed is None else installed
+        try:
+            self.installed = int(installed)
+        except:
+            self.installed = 0
+
+    def get_failed(self):
+        return self.failed
+
+    def set_failed(self, failed):
+        failed = 0 if failed is None else failed
+        try:
+            self.failed = int(failed)
+        except:
+            self.failed = 0
+
+    def get_pending(self):
+        return self.pending
+
+    def set_pending(self, pending):
+        pending = 0 if pending is None else pending
+        try:
+            self.pending = int(pending)
+        except:
+            self.pending = 0
+
+    def get_install_rate(self):
+        return self.install_rate
+
+    def set_install_rate(self, install_rate):
+        install_rate = 0 if install_rate is None else install_rate
+        try:
+            self.install_rate = int(install_rate)
+        except:
+            self.install_rate = 0
+
+    def from_dict(self, data):
+        self.set_ct_id(data["ct_id"])
+        self.set_dp_id(data["dp_id"])
+        self.set_installed(data["installed"])
+        self.set_failed(data["failed"])
+        self.set_pending(data["pending"])
+        self.set_install_rate(data["install_rate"])
+
+    def to_dict(self):
+        data = {}
+        data["ct_id"] = str(self.get_ct_id())
+        data["dp_id"] = str(self.get_dp_id())
+        data["installed"] = str(self.get_installed())
+        data["failed"] = str(self.get_failed())
+        data["pending"] = str(self.get_pending())
+        data["install_rate"] = str(self.get_install_rate())
+        return data
+
+    def from_compact(self, data):
+        self.ct_id = data["ct_id"] & 0xFFFFFFFFFFFFFFFF
+        self.dp_id = data["dp_id"] & 0xFFFFFFFFFFFFFFFF
+        self.installed = data["installed"]
+        self.failed = data["failed"]
+        self.pending = data["pending"]
+        self.install_rate = data["install_rate"]
+
+    def to_compact(self):
+        return {
+            "ct_id": to_int64(self.ct_id),
+            "dp_id": to_int64(self.dp_id),
+            "installed": self.installed,
+            "failed": self.failed,
+            "pending": self.pending,
+            "install_rate": self.install_rate,
+        }
+
+    def from_bson(self, data):
+        data = bson.BSON.decode(data)
+        self.from_dict(data)
+
+    def to_bson(self):
+        return bson.BSON.encode(self.get_dict())
+
+    def __str__(self):
+        s = "DatapathFlowStatus\n"
+        s += "  ct_id: " + format_id(self.get_ct_id()) + "\n"
+        s += "  dp_id: " + format_id(self.get_dp_id()) + "\n"
+        s += "  installed: " + str(self.get_installed()) + "\n"
+        s += "  failed: " + str(self.get_failed()) + "\n"
+        s += "  pending: " + str(self.get_pending()) + "\n"
+        s += "  install_rate: " + str(self.get_install_rate()) + "\n"
         return s
@@ -20,6 +20,8 @@ IPCMessage* RFProtocolFactory::buildForType(int type) {
             return new ControllerRegister();
         case ELECT_MASTER:
             return new ElectMaster();
+        case DATAPATH_FLOW_STATUS:
+            return new DatapathFlowStatus();
         default:
             return NULL;
     }
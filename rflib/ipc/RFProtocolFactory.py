@@ -21,3 +21,5 @@ class RFProtocolFactory(IPC.IPCMessageFactory):
             return ControllerRegister()
         if type_ == ELECT_MASTER:
             return ElectMaster()
+        if type_ == DATAPATH_FLOW_STATUS:
+            return DatapathFlowStatus()
@@ -0,0 +1,372 @@
+import os
+import errno
+import fcntl
+import socket
+import struct
+import threading
+import Queue
+import logging
+from collections import deque
+
+import bson
+
+import rflib.ipc.IPC as IPC
+from rflib.ipc.MongoIPC import FROM_FIELD, TO_FIELD, READ_FIELD, \
+                               put_in_envelope, take_from_envelope, \
+                               format_address
+
+CHANNEL_FIELD = "channel"
+OP_FIELD = "op"
+
+OP_SEND = 0
+OP_LISTEN = 1
+
+# Seconds to wait before trying to reach the hub again
+RECONNECT_INTERVAL = 0.5
+# Envelopes kept by the hub for each recipient that isn't listening yet
+HUB_BACKLOG = 4096
+
+log = logging.getLogger("socketipc")
+
+def parse_socket_address(address):
+    """Return the socket family and address for a "host:port" or a path."""
+    if "/" in address:
+        return (socket.AF_UNIX, address)
+    host, port = format_address(address)
+    return (socket.AF_INET, (host, port))
+
+def connect_socket(address):
+    family, addr = parse_socket_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(addr)
+    except:
+        sock.close()
+        raise
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+def lock_socket_path(path):
+    """Take the lock file that guards a Unix domain socket path.
+
+    Returns the open lock file, which must stay open while the path is
+    served. Raises socket.error (EADDRINUSE) if another process holds it.
+    """
+    lock = open(path + ".lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        lock.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            raise socket.error(errno.EADDRINUSE, "%s is being served" % path)
+        raise
+    return lock
+
+def bind_socket(address):
+    """Return a listening socket and, for Unix paths, its lock file."""
+    family, addr = parse_socket_address(address)
+    lock = None
+    if family == socket.AF_UNIX:
+        lock = lock_socket_path(addr)
+        # Only the lock holder serves the path, so a socket file left is stale
+        try:
+            os.unlink(addr)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                lock.close()
+                raise
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(addr)
+        sock.listen(128)
+    except:
+        sock.close()
+        if lock is not None:
+            lock.close()
+        raise
+    return (sock, lock)
+
+def read_frame(stream):
+    """Read a BSON document from a stream, using its length prefix.
+
+    Returns the raw document, or None if the stream was closed.
+    """
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack("<i", header)
+    body = stream.read(length - 4)
+    if len(body) < length - 4:
+        return None
+    return header + body
+
+
+class SocketIPCHub:
+    """Relays envelopes between SocketIPCMessageService instances.
+
+    Every listener subscribes to a (channel, id) pair and receives every
+    envelope sent to that id through that channel. Envelopes sent to an id
+    nobody is listening to are kept (up to HUB_BACKLOG) until a listener
+    subscribes.
+    """
+    def __init__(self, listener, thread_constructor, path_lock=None):
+        self._listener = listener
+        self._path_lock = path_lock
+        self._threading = thread_constructor
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._backlog = {}
+
+    def start(self):
+        self._threading(target=self._accept_worker, args=()).start()
+
+    def _accept_worker(self):
+        while True:
+            sock, _ = self._listener.accept()
+            self._threading(target=self._connection_worker,
+                            args=(sock,)).start()
+
+    def _connection_worker(self, sock):
+        peer = _HubPeer(sock)
+        subscriptions = []
+        stream = sock.makefile("rb")
+        try:
+            while True:
+                frame = read_frame(stream)
+                if frame is None:
+                    break
+                doc = bson.BSON(frame).decode()
+                key = (doc[CHANNEL_FIELD], doc[TO_FIELD])
+                if doc[OP_FIELD] == OP_LISTEN:
+                    subscriptions.append(key)
+                    self._subscribe(key, peer)
+                else:
+                    self._deliver(key, frame)
+        except socket.error:
+            pass
+        finally:
+            with self._lock:
+                for key in subscriptions:
+                    self._subscribers[key].remove(peer)
+                    if not self._subscribers[key]:
+                        del self._subscribers[key]
+            stream.close()
+            sock.close()
+
+    def _subscribe(self, key, peer):
+        with self._lock:
+            self._subscribers.setdefault(key, []).append(peer)
+            backlog = self._backlog.pop(key, ())
+            # Frames delivered from now on wait until the backlog is sent
+            peer.lock.acquire()
+        try:
+            if backlog:
+                peer.send_locked("".join(backlog))
+        finally:
+            peer.lock.release()
+
+    def _deliver(self, key, frame):
+        with self._lock:
+            peers = list(self._subscribers.get(key, ()))
+            if not peers:
+                backlog = self._backlog.setdefault(key,
+                                                   deque(maxlen=HUB_BACKLOG))
+                backlog.append(frame)
+                return
+        for peer in peers:
+            peer.send(frame)
+
+
+class _HubPeer:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.send_locked(data)
+
+    def send_locked(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            # The connection worker will notice and clean up
+            pass
+
+
+class SocketIPCMessageService(IPC.IPCMessageService):
+    def __init__(self, address, channels, id_, thread_constructor,
+                 sleep_function, fallback=None, mirror=None,
+                 compact_channels=()):
+        """Construct an IPCMessageService that uses sockets.
+
+        Envelopes are BSON documents (which carry their own length prefix)
+        relayed by a SocketIPCHub. The first service that can't reach the hub
+        at `address` starts one in its own process.
+
+        Args:
+            address: a "host:port" TCP address or a Unix domain socket path.
+            channels: channels carried over sockets. Other channels are
+                handled by `fallback`.
+            id_: is an identifier to allow messages to be directed to the
+                appropriate recipient.
+            thread_constructor: function that takes 'target' and 'args'
+                parameters for the function to run and arguments to pass, and
+                return an object that has start() and join() functions.
+            sleep_function: function that takes a float and delays processing
+                for the specified period.
+            fallback: IPCMessageService for channels not in `channels`.
+            mirror: optional MongoIPCMessageService to which sent envelopes
+                are copied in the background, so they can still be inspected
+                in MongoDB. Mirrored envelopes are stored as already read.
+            compact_channels: channels whose messages are sent with the
+                compact codec.
+        """
+        self.address = address
+        self._channels = set(channels)
+        self._compact_channels = set(compact_channels)
+        self._threading = thread_constructor
+        self._sleep = sleep_function
+        self._fallback = fallback
+        self._mirror = mirror
+        self._hub = None
+        self._hub_lock = threading.Lock()
+        self.set_id(id_)
+
+        self._outgoing = Queue.Queue()
+        self._threading(target=self._send_worker, args=()).start()
+        if mirror is not None:
+            self._mirrored = Queue.Queue()
+            self._threading(target=self._mirror_worker, args=()).start()
+
+    def set_id(self, id_):
+        IPC.IPCMessageService.set_id(self, id_)
+        if self._fallback is not None:
+            self._fallback.set_id(id_)
+
+    def listen(self, channel_id, factory, processor, block=True):
+        if channel_id not in self._channels:
+            return self._fallback.listen(channel_id, factory, processor,
+                                         block)
+        worker = self._threading(target=self._listen_worker,
+                                 args=(channel_id, factory, processor))
+        worker.start()
+        if block:
+            worker.join()
+
+    def send(self, channel_id, to, msg):
+        return self.send_many(channel_id, [(to, msg)])
+
+    def send_many(self, channel_id, messages):
+        if channel_id not in self._channels:
+            return self._fallback.send_many(channel_id, messages)
+        if not messages:
+            return True
+        compact = channel_id in self._compact_channels
+        envelopes = [put_in_envelope(self.get_id(), to, msg, compact)
+                     for (to, msg) in messages]
+        frames = []
+        for envelope in envelopes:
+            frame = dict(envelope)
+            frame[CHANNEL_FIELD] = channel_id
+            frame[OP_FIELD] = OP_SEND
+            frames.append(bson.BSON.encode(frame))
+        self._outgoing.put("".join(frames))
+        if self._mirror is not None:
+            for envelope in envelopes:
+                envelope[READ_FIELD] = True
+            self._mirrored.put((channel_id, envelopes))
+        return True
+
+    def _listen_worker(self, channel_id, factory, processor):
+        subscription = bson.BSON.encode({OP_FIELD: OP_LISTEN,
+                                         CHANNEL_FIELD: channel_id,
+                                         TO_FIELD: self.get_id()})
+        while True:
+            sock = None
+            try:
+                sock = self._connect()
+                sock.sendall(subscription)
+                stream = sock.makefile("rb")
+                while True:
+                    frame = read_frame(stream)
+                    if frame is None:
+                        break
+                    envelope = bson.BSON(frame).decode()
+                    msg = take_from_envelope(envelope, factory)
+                    processor.process(envelope[FROM_FIELD], envelope[TO_FIELD], channel_id, msg);
+                stream.close()
+            except socket.error:
+                pass
+            if sock is not None:
+                sock.close()
+            self._sleep(RECONNECT_INTERVAL)
+
+    def _send_worker(self):
+        sock = None
+        data = None
+        while True:
+            if data is None:
+                # Write everything queued so far with as few calls as possible
+                chunks = [self._outgoing.get()]
+                try:
+                    while True:
+                        chunks.append(self._outgoing.get_nowait())
+                except Queue.Empty:
+                    pass
+                data = "".join(chunks)
+            try:
+                if sock is None:
+                    sock = self._connect()
+                sock.sendall(data)
+                data = None
+            except socket.error:
+                # Keep the data and retry once the hub can be reached
+                if sock is not None:
+                    sock.close()
+                    sock = None
+                self._sleep(RECONNECT_INTERVAL)
+
+    def _mirror_worker(self):
+        while True:
+            batch = [self._mirrored.get()]
+            try:
+                while True:
+                    batch.append(self._mirrored.get_nowait())
+            except Queue.Empty:
+                pass
+            channels = {}
+            for (channel_id, envelopes) in batch:
+                channels.setdefault(channel_id, []).extend(envelopes)
+            for (channel_id, envelopes) in channels.items():
+                try:
+                    self._mirror.insert_envelopes(channel_id, envelopes)
+                except Exception as e:
+                    log.warning("Failed to mirror %d envelopes to %s: %s",
+                                len(envelopes), channel_id, str(e))
+
+    def _connect(self):
+        try:
+            return connect_socket(self.address)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                # The hub may only be busy, so the caller retries later
+                raise
+            # Nobody is serving the address, so host the hub here
+            self._host_hub()
+            return connect_socket(self.address)
+
+    def _host_hub(self):
+        with self._hub_lock:
+            if self._hub is not None:
+                return
+            try:
+                (listener, path_lock) = bind_socket(self.address)
+            except socket.error:
+                # Another service got there first
+                return
+            self._hub = SocketIPCHub(listener, self._threading, path_lock)
+            self._hub.start()
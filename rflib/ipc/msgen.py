@@ -1,6 +1,8 @@
 import sys
 
 messages = []
+# Fields of each message that older peers may leave out
+optionalFields = {}
 
 # C++
 typesMap = {
@@ -105,6 +107,34 @@ pyImportType = {
 "option[]": "list({0})",
 }
 
+# Compact codec: native BSON types, for peers that aren't the C++ rfclient.
+# BSON has no unsigned 64-bit integer, so i64 values travel as signed.
+pyCompactExportType = {
+"i8": "{0}",
+"i32": "{0}",
+"i64": "to_int64({0})",
+"bool": "{0}",
+"ip": "{0}",
+"mac": "{0}",
+"string": "{0}",
+"match[]": "{0}",
+"action[]": "{0}",
+"option[]": "{0}",
+}
+
+pyCompactImportType = {
+"i8": "{0}",
+"i32": "{0}",
+"i64": "{0} & 0xFFFFFFFFFFFFFFFF",
+"bool": "{0}",
+"ip": "str({0})",
+"mac": "str({0})",
+"string": "str({0})",
+"match[]": "{0}",
+"action[]": "{0}",
+"option[]": "{0}",
+}
+
 def convmsgtype(string):
     result = ""
     i = 0
@@ -264,8 +294,10 @@ def genCPP(messages, fname):
         g.increaseIndent();
         g.addLine("mongo::BSONObj obj(data);")
         for t, f in msg:
-            value = "obj[\"{0}\"]".format(f)
-            g.addLine("set_{0}({1});".format(f, importType[t].format(value)))
+            value = importType[t].format("obj[\"{0}\"]".format(f))
+            if f in optionalFields.get(name, ()):
+                value = "obj.hasField(\"{0}\") ? {1} : {2}".format(f, value, defaultValues[t])
+            g.addLine("set_{0}({1});".format(f, value))
         g.decreaseIndent()
         g.addLine("}")
         g.blankLine();
@@ -359,11 +391,13 @@ def genPy(messages, fname):
     g = CodeGenerator()
 
     g.addLine("import bson")    
+    g.blankLine()
     for tlv in ["Match","Action","Option"]:
         g.addLine("from rflib.types.{0} import {0}".format(tlv))
     g.addLine("from MongoIPC import MongoIPCMessage")
     g.blankLine()
     g.addLine("format_id = lambda dp_id: hex(dp_id).rstrip('L')")
+    g.addLine("to_int64 = lambda v: v - (1 << 64) if v >> 63 else v")
     g.blankLine()
     
     v = 0
@@ -375,6 +409,8 @@ def genPy(messages, fname):
         g.blankLine()
         g.addLine("class {0}(MongoIPCMessage):".format(name))
         g.increaseIndent()
+        g.addLine("__slots__ = ({0},)".format(", ".join(["\"{0}\"".format(f) for t, f in msg])))
+        g.blankLine()
         g.addLine("def __init__(self, {0}):".format(", ".join([f + "=None" for t, f in msg])))
         g.increaseIndent()
         for t, f in msg:
@@ -420,7 +456,10 @@ def genPy(messages, fname):
         g.addLine("def from_dict(self, data):")
         g.increaseIndent();
         for t, f in msg:
-            g.addLine("self.set_{0}(data[\"{0}\"])".format(f))
+            if f in optionalFields.get(name, ()):
+                g.addLine("self.set_{0}(data.get(\"{0}\"))".format(f))
+            else:
+                g.addLine("self.set_{0}(data[\"{0}\"])".format(f))
         g.decreaseIndent()
         g.blankLine();
         
@@ -434,6 +473,29 @@ def genPy(messages, fname):
         g.decreaseIndent()
         g.blankLine();
         
+        g.addLine("def from_compact(self, data):")
+        g.increaseIndent();
+        for t, f in msg:
+            if f in optionalFields.get(name, ()):
+                value = "data.get(\"{0}\", {1})".format(f, pyDefaultValues[t])
+            else:
+                value = "data[\"{0}\"]".format(f)
+            g.addLine("self.{0} = {1}".format(f, pyCompactImportType[t].format(value)))
+        g.decreaseIndent()
+        g.blankLine();
+
+        g.addLine("def to_compact(self):")
+        g.increaseIndent();
+        g.addLine("return {")
+        g.increaseIndent();
+        for t, f in msg:
+            value = pyCompactExportType[t].format("self.{0}".format(f))
+            g.addLine("\"{0}\": {1},".format(f, value))
+        g.decreaseIndent()
+        g.addLine("}")
+        g.decreaseIndent()
+        g.blankLine();
+
         g.addLine("def from_bson(self, data):")
         g.increaseIndent()
         g.addLine("data = bson.BSON.decode(data)")
@@ -510,6 +572,11 @@ for line in lines:
         if currentMessage is None:
             print "Error: message not declared"
         messages[-1][1].append((parts[0], parts[1]))
+    elif len(parts) == 3 and parts[2] == "optional":
+        if currentMessage is None:
+            print "Error: message not declared"
+        messages[-1][1].append((parts[0], parts[1]))
+        optionalFields.setdefault(currentMessage, set()).add(parts[1])
     else:
         print "Error: invalid line"
 
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from rflib.types.Match import RFMT_IPV4, RFMT_IPV6
+
+# Seconds RouteMods for the same route are held to be coalesced
+COALESCE_WINDOW = 0.2
+# Maximum number of routes held at once
+MAX_PENDING = 65536
+# Maximum number of routes whose last forwarded RouteMod is remembered
+MAX_REMEMBERED = 262144
+# Seconds between counter reports in the log
+REPORT_INTERVAL = 60
+
+log = logging.getLogger("rfserver")
+
+def route_key(rm):
+    """Return the (vm_id, prefix, mask) a RouteMod refers to, if any."""
+    for match in rm.get_matches():
+        if match["type"] in (RFMT_IPV4, RFMT_IPV6):
+            return (rm.get_id(), match["type"], str(match["value"]))
+    return None
+
+def signature(rm):
+    return (rm.get_mod(),
+            tuple((m["type"], str(m["value"])) for m in rm.get_matches()),
+            tuple((a["type"], str(a["value"])) for a in rm.get_actions()),
+            tuple((o["type"], str(o["value"])) for o in rm.get_options()))
+
+
+class RouteModCoalescer:
+    """Collapses bursts of RouteMods for the same route.
+
+    RouteMods for a route are held for `window` seconds after the first one
+    arrives, and only the last one is forwarded: a flap (add, delete, add)
+    becomes a single add. The last RouteMod forwarded for each route is
+    remembered (up to `max_remembered` routes), so a net change that would
+    reinstall exactly the same flow (such as a withdraw and re-announce
+    during a BGP session reset) is not forwarded at all.
+
+    RouteMods that don't refer to a prefix are forwarded immediately.
+    """
+    def __init__(self, forward, window=COALESCE_WINDOW,
+                 max_pending=MAX_PENDING, max_remembered=MAX_REMEMBERED):
+        self.forward = forward
+        self.window = window
+        self.max_pending = max_pending
+        self.max_remembered = max_remembered
+        self.counters = {
+            "received": 0,      # RouteMods submitted
+            "forwarded": 0,     # RouteMods forwarded
+            "coalesced": 0,     # RouteMods replaced by a later one
+            "unchanged": 0,     # Net changes equal to the last forwarded
+            "overflow": 0,      # Routes forwarded early with MAX_PENDING held
+        }
+        self._pending = OrderedDict()
+        self._remembered = OrderedDict()
+        self._condition = threading.Condition()
+        worker = threading.Thread(target=self._worker)
+        worker.daemon = True
+        worker.start()
+
+    def submit(self, rm):
+        key = route_key(rm)
+        overflow = None
+        with self._condition:
+            self.counters["received"] += 1
+            if key is None:
+                self.counters["forwarded"] += 1
+            elif key in self._pending:
+                deadline, _ = self._pending[key]
+                self._pending[key] = (deadline, rm)
+                self.counters["coalesced"] += 1
+                return
+            else:
+                if len(self._pending) >= self.max_pending:
+                    overflow = self._pending.popitem(last=False)
+                    self.counters["overflow"] += 1
+                self._pending[key] = (time.time() + self.window, rm)
+                self._condition.notify()
+        if key is None:
+            self.forward(rm)
+        elif overflow is not None:
+            self._forward(overflow[0], overflow[1][1])
+
+    def forget(self):
+        """Forget what was forwarded, e.g. after flow tables are cleared."""
+        with self._condition:
+            self._remembered.clear()
+
+    def _forward(self, key, rm):
+        sig = signature(rm)
+        with self._condition:
+            if self._remembered.get(key) == sig:
+                self.counters["unchanged"] += 1
+                return
+            self._remembered.pop(key, None)
+            self._remembered[key] = sig
+            if len(self._remembered) > self.max_remembered:
+                self._remembered.popitem(last=False)
+            self.counters["forwarded"] += 1
+        self.forward(rm)
+
+    def _worker(self):
+        last_report = time.time()
+        reported = None
+        while True:
+            due = []
+            with self._condition:
+                # Routes are held in arrival order, so deadlines are sorted
+                now = time.time()
+                while self._pending:
+                    key, (deadline, rm) = self._pending.iteritems().next()
+                    if deadline > now:
+                        break
+                    del self._pending[key]
+                    due.append((key, rm))
+                if not due:
+                    if self._pending:
+                        self._condition.wait(deadline - now)
+                    else:
+                        self._condition.wait(REPORT_INTERVAL)
+            for (key, rm) in due:
+                self._forward(key, rm)
+
+            if time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                counters = dict(self.counters)
+                if counters != reported:
+                    reported = counters
+                    log.info("RouteMod coalescing: %s" %
+                             ", ".join("%s=%d" % (k, v) for (k, v)
+                                       in sorted(counters.items())))
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+import Queue
+
+# Worker threads processing messages
+WORKERS = 8
+# Messages queued for each worker before senders are blocked
+QUEUE_SIZE = 1024
+# Seconds between queue statistics reports in the log
+REPORT_INTERVAL = 60
+
+log = logging.getLogger("rfserver")
+
+
+class ShardedDispatcher:
+    """Processes messages on a pool of workers, in order within each shard.
+
+    shard_key(msg) returns the shard a message belongs to, and every message
+    of a shard is handled by the same worker, in the order it was dispatched.
+    Messages from different shards are handled in parallel.
+
+    Each worker has a bounded queue: dispatch() blocks while the queue for a
+    message is full, which stops the IPC listener that called it from reading
+    more messages until the worker catches up.
+    """
+    def __init__(self, handler, shard_key, workers=WORKERS,
+                 queue_size=QUEUE_SIZE):
+        self.handler = handler
+        self.shard_key = shard_key
+        self._queues = [Queue.Queue(queue_size) for i in range(workers)]
+        self._lock = threading.Lock()
+        self.counters = {
+            "dispatched": 0,    # Messages dispatched
+            "blocked": 0,       # Dispatches that waited for a full queue
+            "max_depth": 0,     # Deepest any queue has been
+        }
+        for queue in self._queues:
+            worker = threading.Thread(target=self._worker, args=(queue,))
+            worker.daemon = True
+            worker.start()
+        reporter = threading.Thread(target=self._reporter)
+        reporter.daemon = True
+        reporter.start()
+
+    def dispatch(self, msg):
+        key = self.shard_key(msg)
+        queue = self._queues[hash(key) % len(self._queues)]
+        try:
+            queue.put_nowait(msg)
+        except Queue.Full:
+            with self._lock:
+                self.counters["blocked"] += 1
+            queue.put(msg)
+        depth = queue.qsize()
+        with self._lock:
+            self.counters["dispatched"] += 1
+            if depth > self.counters["max_depth"]:
+                self.counters["max_depth"] = depth
+
+    def run_exclusive(self, function):
+        """Call function() while no worker is handling a message.
+
+        Messages dispatched before are handled first, and messages dispatched
+        after wait until function() returns, which returns its result.
+        """
+        barrier = _Barrier(len(self._queues))
+        for queue in self._queues:
+            queue.put(barrier)
+        barrier.wait_parked()
+        try:
+            return function()
+        finally:
+            barrier.release()
+
+    def queue_depths(self):
+        """Return the number of messages waiting for each worker."""
+        return [queue.qsize() for queue in self._queues]
+
+    def _worker(self, queue):
+        while True:
+            msg = queue.get()
+            if isinstance(msg, _Barrier):
+                msg.park()
+                continue
+            try:
+                self.handler(msg)
+            except Exception:
+                log.exception("Error processing message")
+
+    def _reporter(self):
+        reported = None
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            with self._lock:
+                counters = dict(self.counters)
+            if counters != reported:
+                reported = counters
+                log.info("Dispatcher: dispatched=%d, blocked=%d, "
+                         "max_depth=%d, depths=%s" %
+                         (counters["dispatched"], counters["blocked"],
+                          counters["max_depth"], self.queue_depths()))
+
+
+class _Barrier:
+    """Holds every worker of a ShardedDispatcher until it is released."""
+    def __init__(self, workers):
+        self._cond = threading.Condition()
+        self._running = workers
+        self._released = False
+
+    def park(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+            while not self._released:
+                self._cond.wait()
+
+    def wait_parked(self):
+        with self._cond:
+            while self._running > 0:
+                self._cond.wait()
+
+    def release(self):
+        with self._cond:
+            self._released = True
+            self._cond.notify_all()
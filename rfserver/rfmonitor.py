@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
+import os
+import errno
 import logging
 import threading
 import time
 import socket
+import select
+import heapq
 import random
+import argparse
 
 import rflib.ipc.IPC as IPC
-import rflib.ipc.MongoIPC as MongoIPC
+from rflib.ipc.IPCServiceFactory import IPCServiceFactory
+from rflib.ipc.MongoClientFactory import MongoClientFactory
 from rflib.ipc.RFProtocol import *
 from rflib.ipc.RFProtocolFactory import RFProtocolFactory
 from rflib.defs import *
@@ -16,110 +22,191 @@ from rflib.types.Match import *
 from rflib.types.Action import *
 from rflib.types.Option import *
 
+# Seconds between probes of a controller
+PROBE_INTERVAL = 5
+# Fraction of PROBE_INTERVAL by which each probe is randomly moved, so that
+# probes of controllers registered together don't stay in step
+PROBE_JITTER = 0.1
+# Seconds a controller has to accept a probe connection
+PROBE_TIMEOUT = 1
+
+# Datapaths are split into shards (dp_id % shards) that can have different
+# masters
+SHARDS = 1
+# Minimum seconds between rebalances of shards across controllers
+REBALANCE_INTERVAL = 30
+# Weights of the load figures controllers report in ControllerRegister:
+# connected datapaths, pending IPC messages and packet-ins per second
+LOAD_DATAPATH = 10
+LOAD_BACKLOG = 1
+LOAD_PACKET_IN = 1
+
 
 class RFMonitor(RFProtocolFactory, IPC.IPCMessageProcessor):
     """Monitors all the controller instances for failiure
 
     Attributes-
     controllers: A dictionary mapping controller address and
-                 port to controller role and number of devices 
-                 it is connected to.
+                 port to controller role, number of devices 
+                 it is connected to, pending IPC messages and
+                 packet-in rate, as last reported by the controller.
     monitors: A dictionary mapping controllers to monitor objects
               responsible for scheduling tests.
-    eligible_masters: A dictionary mapping controllers to the maximum
-                      count of devices they are connected too.
+    masters: A dictionary mapping shards to their master controller.
+    schedule: A heap of (time, controller, monitor) tuples, ordered by the
+              time the next test of each controller is due.
+    detection: Failure detection statistics: the number of failures
+               detected, and the total and maximum time between the last
+               successful test of a failed controller and its detection.
 
     """
-    def __init__(self, *arg, **kwargs):
+    def __init__(self, interval=PROBE_INTERVAL, jitter=PROBE_JITTER,
+                 probe_timeout=PROBE_TIMEOUT, shards=SHARDS, ipc=None):
         self.controllers = dict()
         self.monitors = dict()
-        self.eligible_masters = dict()
+        self.masters = dict()
+        self.shards = shards
+        self.last_rebalance = time.time()
         self.controllerLock = threading.Lock()
-        self.ipc = MongoIPC.MongoIPCMessageService(MONGO_ADDRESS,
-                                                   MONGO_DB_NAME,
-                                                   RFMONITOR_ID,
-                                                   threading.Thread,
-                                                   time.sleep)
-        self.ipc.listen(RFMONITOR_RFPROXY_CHANNEL, self, self, False)
+        self.interval = interval
+        self.jitter = jitter
+        self.probe_timeout = probe_timeout
+        self.schedule = []
+        self.detection = {'count': 0, 'total': 0.0, 'max': 0.0}
+        # Written to when a test is scheduled, to wake up test_controllers
+        self.wakeup_in, self.wakeup_out = os.pipe()
         self.log = logging.getLogger("rfmonitor")
         self.log.setLevel(logging.INFO)
         ch = logging.StreamHandler()
         ch.setLevel(logging.INFO)
         ch.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
         self.log.addHandler(ch)
-        self.test_controllers()
+        if ipc is None:
+            ipc = IPCServiceFactory.make(RFMONITOR_ID, threading.Thread,
+                                         time.sleep)
+            MongoClientFactory.start_reporter(self.log)
+        self.ipc = ipc
+        self.ipc.listen(RFMONITOR_RFPROXY_CHANNEL, self, self, False)
 
     def process(self, _from, to, channel, msg):
         """Process messages sent by controllers.
 
         Types of messages being handled:
         CONTROLLER_REGISTER -- Register Controller details with RFMonitor.
+                               Controllers send it again periodically to
+                               report their load.
 
         """        
         type_ = msg.get_type()
+        if type_ != CONTROLLER_REGISTER:
+            return False
         address = msg.get_ct_addr()
         port = msg.get_ct_port()
         role = msg.get_ct_role()
-        if type_ == CONTROLLER_REGISTER:
-            self.controllerLock.acquire()
-            try:
-                if ((address + ':' + str(port)) not in 
-                    self.controllers):
-                    self.controllers[address + ':' + str(port)] = {
-                        'role': role,
-                        'count': 1
-                    }
-                    self.log.info("A %s controller at %s:%s is up",
-                                  role, address, port)
-                else:
-                    self.controllers[msg.get_ct_addr() + ':'
-                                     + str(msg.get_ct_port())]['count'] += 1
-                controller_count = self.controllers[address + ':' 
-                                                   + str(port)]['count']
-
-                if not self.eligible_masters:
-                    self.eligible_masters[address + ':' + str(port)] = \
-                        controller_count
-                else:
-                    maximum_controller_count = self.eligible_masters.values()[0]
-                    if maximum_controller_count < controller_count:
-                        self.eligible_masters = {}
-                        self.eligible_masters[address + ':' + str(port)] = \
-                            controller_count
-                    elif maximum_controller_count == controller_count:
-                        self.eligible_masters[address + ':' + str(port)] = \
-                            controller_count
+        controller = address + ':' + str(port)
+        self.controllerLock.acquire()
+        try:
+            new = controller not in self.controllers
+            if new:
+                self.controllers[controller] = {'role': "slave"}
+                self.schedule_test(controller,
+                                   Monitor(address, port, self.interval,
+                                           self.jitter))
+                self.log.info("A %s controller at %s:%s is up",
+                              role, address, port)
+            self.controllers[controller].update({
+                'count': msg.get_ct_datapaths(),
+                'backlog': msg.get_ct_backlog(),
+                'packet_in_rate': msg.get_ct_packet_in_rate(),
+                'proxy': _from
+            })
+            orphans = len(self.masters) < self.shards
+            rebalance = (time.time() - self.last_rebalance >=
+                         REBALANCE_INTERVAL)
+            if rebalance:
+                self.last_rebalance = time.time()
+        finally:
+            self.controllerLock.release()
 
-            finally:
-                self.controllerLock.release()
+        if new and orphans:
+            # A controller started as master takes any shard without one
+            if role == "master":
+                self.elect_new_master(controller)
+            else:
+                self.elect_new_master()
+        elif rebalance:
+            self.rebalance()
+        return True
+
+    def schedule_test(self, controller, monitor):
+        """Schedule the next test of a controller.
+
+        Must be called with controllerLock held.
+
+        """
+        self.monitors[controller] = monitor
+        heapq.heappush(self.schedule, (monitor.timeout, controller, monitor))
+        os.write(self.wakeup_out, "x")
 
     def test_controllers(self):
-        """Invoke test on all the controllers"""
+        """Invoke tests on controllers as they become due.
+
+        Tests are non-blocking connection attempts, so tests of different
+        controllers run concurrently and a dead controller never delays the
+        detection of another one.
+
+        """
+        probes = {}
         while True:
-            #Extract all the keys from self.controllers first so that 
-            #the main thread does not block the IPC thread
+            now = time.time()
+            due = []
             self.controllerLock.acquire()
             try:
-                controllers = self.controllers.keys()
+                while self.schedule and self.schedule[0][0] <= now:
+                    (_, controller, monitor) = heapq.heappop(self.schedule)
+                    # Skip tests of controllers that died or registered again
+                    if self.monitors.get(controller) is monitor:
+                        due.append(monitor)
+                next_test = self.schedule[0][0] if self.schedule else None
             finally:
                 self.controllerLock.release()
-            for controller in controllers:
-                host, port = controller.split(':')
-                port = int(port)
-                if controller in self.monitors:
-                    monitor = self.monitors[controller]
-                    #check if scheduled time has passed
-                    if monitor.timeout < time.time():
-                        self.test(host, port)
-                        monitor.schedule_test()
-                    else:
-                        continue
+
+            for monitor in due:
+                sock = self.test(monitor.host, monitor.port)
+                if sock is None:
+                    self.test_done(monitor, False)
+                else:
+                    probes[sock] = (monitor, now + self.probe_timeout)
+
+            deadlines = [deadline for (_, deadline) in probes.values()]
+            if next_test is not None:
+                deadlines.append(next_test)
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.time())
+            readable, writable, _ = select.select([self.wakeup_in],
+                                                  probes.keys(), [], timeout)
+            if readable:
+                os.read(self.wakeup_in, 4096)
+
+            now = time.time()
+            for sock in probes.keys():
+                monitor, deadline = probes[sock]
+                if sock in writable:
+                    alive = sock.getsockopt(SOL_SOCKET, SO_ERROR) == 0
+                elif deadline <= now:
+                    alive = False
                 else:
-                    monitor = Monitor(host, port, callback_time=5000)
-                    self.monitors[controller] = monitor
+                    continue
+                del probes[sock]
+                sock.close()
+                self.test_done(monitor, alive)
 
     def test(self, host, port):
-        """Test if a controller is up.
+        """Start testing if a controller is up.
+
+        Returns a socket that becomes writable once the test is over, or
+        None if the controller is known to be down already.
 
         Keyword Arguments:
         host -- host ip address at which controller is listening.
@@ -127,17 +214,42 @@ class RFMonitor(RFProtocolFactory, IPC.IPCMessageProcessor):
 
         """
         s = socket(AF_INET, SOCK_STREAM)
-        s.settimeout(1)
+        s.setblocking(0)
         result = s.connect_ex((host, port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            s.close()
+            return None
+        return s
+
+    def test_done(self, monitor, alive):
+        """Handle the result of a test, scheduling the next one"""
+        now = time.time()
+        controller = monitor.host + ':' + str(monitor.port)
+        if alive:
+            monitor.last_alive = now
+            monitor.schedule_test()
+            self.controllerLock.acquire()
+            try:
+                if self.monitors.get(controller) is monitor:
+                    self.schedule_test(controller, monitor)
+            finally:
+                self.controllerLock.release()
+            return
 
-        if result != 0:
-            self.log.info("Controller listening at %s:%s died", host, port)
-            self.handle_controller_death(host, port)
-        s.close()
+        latency = now - monitor.last_alive
+        self.detection['count'] += 1
+        self.detection['total'] += latency
+        self.detection['max'] = max(self.detection['max'], latency)
+        self.log.info("Controller listening at %s:%s died (detected %.2f s "
+                      "after it last answered, mean %.2f s, max %.2f s)",
+                      monitor.host, monitor.port, latency,
+                      self.detection['total'] / self.detection['count'],
+                      self.detection['max'])
+        self.handle_controller_death(monitor.host, monitor.port)
 
     def handle_controller_death(self, host, port):
         """Remove all entries coresponding to a controller and 
-        elect new master if master controller is dead
+        elect new masters for the shards it was master of
 
         Keyword Arguments:
         host -- host ip address at which controller was listening.
@@ -147,53 +259,179 @@ class RFMonitor(RFProtocolFactory, IPC.IPCMessageProcessor):
         master = False
         self.controllerLock.acquire()
         try:
-            if self.controllers[host + ':' + str(port)]['role'] == "master":
+            controller = host + ':' + str(port)
+            if self.controllers[controller]['role'] == "master":
                 master = True
-            self.controllers.pop(host + ':' + str(port), None)
-            self.monitors.pop(host + ':' + str(port), None)
-            self.eligible_masters.pop(host + ':' + str(port), None)
+            self.controllers.pop(controller, None)
+            self.monitors.pop(controller, None)
+            for (shard, master_) in self.masters.items():
+                if master_ == controller:
+                    del self.masters[shard]
         finally:
             self.controllerLock.release()
         if master:
             self.elect_new_master()
 
-    def elect_new_master(self):
-        """Elect new master controller and inform to rfproxy"""
-        master_key = random.randint(0, len(self.eligible_masters)-1)
-        new_master = self.eligible_masters.keys()[master_key]
-        self.log.info("The new master is %s", new_master)
-        host, port = new_master.split(":")
-        msg = ElectMaster(ct_addr=host, ct_port=port)
-        self.ipc.send(RFMONITOR_RFPROXY_CHANNEL, str(0), msg)
+    def load(self, controller):
+        """Return the load last reported by a controller.
+
+        Must be called with controllerLock held.
+
+        """
+        info = self.controllers[controller]
+        return (LOAD_DATAPATH * info['count'] +
+                LOAD_BACKLOG * info['backlog'] +
+                LOAD_PACKET_IN * info['packet_in_rate'])
+
+    def scores(self):
+        """Return the score of every controller and the cost of a shard.
+
+        The score of a controller is its load plus the cost of the shards it
+        is master of, where a shard costs an even part of the total load.
+        Controllers with lower scores are better masters.
+
+        Must be called with controllerLock held.
+
+        """
+        loads = dict((c, self.load(c)) for c in self.controllers)
+        cost = max(1.0, float(sum(loads.values())) / self.shards)
+        scores = dict((c, loads[c] +
+                       cost * self.masters.values().count(c))
+                      for c in loads)
+        return (scores, cost)
+
+    def elect_new_master(self, controller=None):
+        """Elect new master controllers for shards without one and inform
+        to rfproxy
+
+        Every shard goes to the controller with the lowest score, so the
+        same state always elects the same masters.
+
+        Keyword Arguments:
+        controller -- controller to elect for every shard instead.
+
+        """
+        self.controllerLock.acquire()
+        try:
+            if not self.controllers:
+                self.log.warning("No controller is eligible to be master")
+                return
+            (scores, cost) = self.scores()
+            elected = []
+            for shard in range(self.shards):
+                if shard in self.masters:
+                    continue
+                if controller is None:
+                    new_master = min(scores, key=lambda c: (scores[c], c))
+                else:
+                    new_master = controller
+                scores[new_master] += cost
+                self.masters[shard] = new_master
+                elected.append((shard, new_master))
+            self.update_roles()
+        finally:
+            self.controllerLock.release()
+        self.announce(elected)
+
+    def rebalance(self):
+        """Move shards from the busiest masters to the least busy
+        controllers, as long as that brings their scores closer"""
+        self.controllerLock.acquire()
+        try:
+            if not self.controllers:
+                return
+            (scores, cost) = self.scores()
+            moved = []
+            for i in range(self.shards):
+                order = sorted(scores, key=lambda c: (scores[c], c))
+                idle, busy = order[0], order[-1]
+                shards = sorted(s for (s, c) in self.masters.items()
+                                if c == busy)
+                if not shards or scores[busy] - scores[idle] <= cost:
+                    break
+                self.masters[shards[-1]] = idle
+                scores[busy] -= cost
+                scores[idle] += cost
+                moved.append((shards[-1], idle))
+            self.update_roles()
+        finally:
+            self.controllerLock.release()
+        self.announce(moved)
+
+    def update_roles(self):
+        """Must be called with controllerLock held."""
+        masters = set(self.masters.values())
+        for (controller, info) in self.controllers.items():
+            info['role'] = "master" if controller in masters else "slave"
+
+    def announce(self, elected):
+        """Inform every rfproxy of new (shard, master controller) pairs"""
+        self.controllerLock.acquire()
+        try:
+            proxies = sorted(set(info.get('proxy', proxy_id(0))
+                                 for info in self.controllers.values()))
+        finally:
+            self.controllerLock.release()
+        for (shard, new_master) in elected:
+            self.log.info("The new master of shard %d/%d is %s", shard,
+                          self.shards, new_master)
+            host, port = new_master.split(":")
+            msg = ElectMaster(ct_addr=host, ct_port=port, shard=shard,
+                              shards=self.shards)
+            self.ipc.send_many(RFMONITOR_RFPROXY_CHANNEL,
+                               [(to, msg) for to in proxies])
 
 
 class Monitor(object):
     """Monitors each controller individually"""
-    def __init__(self, host, port, callback_time=1000):
+    def __init__(self, host, port, interval=PROBE_INTERVAL,
+                 jitter=PROBE_JITTER):
         """Initialize Monitor
 
         Keyword Arguments:
         host -- host ip address at which controller is listening.
         port -- port at which the controller is listening at `host` address.
-        test -- callback function to be called periodically.
-        callback_time -- time interval (in milliseconds) at which `test` is run.
+        interval -- time interval (in seconds) at which tests are run.
+        jitter -- fraction of `interval` by which each test is randomly
+                  moved.
 
         """
         super(Monitor, self).__init__()
         self.host = host
         self.port = port
-        self.callback_time = callback_time
-        self.timeout = time.time()
+        self.interval = interval
+        self.jitter = jitter
+        self.last_alive = time.time()
+        self.timeout = self.last_alive
         self.schedule_test()
 
     def schedule_test(self):
         """Schedule the next test"""
-        current_time = time.time()
-        if self.timeout <= current_time:
-            self.timeout += self.callback_time/1000.00
+        self.timeout = time.time() + self.interval * \
+            (1 + random.uniform(-self.jitter, self.jitter))
 
 
 if __name__ == "__main__":
     description = 'RFMonitor monitors RFProxy instances for failiure'
     epilog = 'Report bugs to: https://github.com/routeflow/RouteFlow/issues'
-    RFMonitor()
+
+    parser = argparse.ArgumentParser(description=description, epilog=epilog)
+    parser.add_argument('-i', '--interval', type=float,
+                        default=PROBE_INTERVAL,
+                        help='seconds between tests of a controller '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--jitter', type=float, default=PROBE_JITTER,
+                        help='fraction of the interval by which tests are '
+                             'randomly moved (default: %(default)s)')
+    parser.add_argument('-t', '--timeout', type=float, default=PROBE_TIMEOUT,
+                        help='seconds a controller has to answer a test '
+                             '(default: %(default)s)')
+    parser.add_argument('-s', '--shards', type=int, default=SHARDS,
+                        help='number of datapath shards, each with its own '
+                             'master controller (default: %(default)s)')
+
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("there must be at least one shard")
+    RFMonitor(args.interval, args.jitter, args.timeout,
+              args.shards).test_controllers()
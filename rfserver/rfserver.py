@@ -7,11 +7,13 @@ import binascii
 import threading
 import time
 import argparse
+import signal
 
 from bson.binary import Binary
 
 import rflib.ipc.IPC as IPC
-import rflib.ipc.MongoIPC as MongoIPC
+from rflib.ipc.IPCServiceFactory import IPCServiceFactory
+from rflib.ipc.MongoClientFactory import MongoClientFactory
 from rflib.ipc.RFProtocol import *
 from rflib.ipc.RFProtocolFactory import RFProtocolFactory
 from rflib.defs import *
@@ -20,18 +22,58 @@ from rflib.types.Action import *
 from rflib.types.Option import *
 
 from rftable import *
+from coalescer import RouteModCoalescer, COALESCE_WINDOW
+from dispatcher import ShardedDispatcher, WORKERS
 
 # Register actions
 REGISTER_IDLE = 0
 REGISTER_ASSOCIATED = 1
 REGISTER_ISL = 2
 
+class DatapathFlowPlan:
+    """Precomputed RouteMod fan-out for a datapath.
+
+    ports and isl_ports hold a (to, dp_port, matches) tuple for every active
+    RFTable and ISL port of the datapath, where to is the RFProxy of the
+    datapath and matches select the traffic entering through that port.
+    remotes holds the active ISL entries of other datapaths that lead to this
+    one.
+    """
+    def __init__(self, to, entries, isl_entries, remote_entries):
+        self.ports = [self._ingress(to, e) for e in entries
+                      if e.get_status() == RFENTRY_ACTIVE]
+        self.isl_ports = [self._ingress(to, e) for e in isl_entries
+                          if e.get_status() == RFISL_ACTIVE]
+        self.remotes = [e for e in remote_entries
+                        if e.get_status() == RFISL_ACTIVE]
+
+    @staticmethod
+    def _ingress(to, entry):
+        return (to, entry.dp_port,
+                [Match.ETHERNET(entry.eth_addr).to_dict(),
+                 Match.IN_PORT(entry.dp_port).to_dict()])
+
 class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
-    def __init__(self, configfile, islconffile):
+    def __init__(self, configfile, islconffile,
+                 coalesce_window=COALESCE_WINDOW, workers=WORKERS, ipc=None):
         self.rftable = RFTable()
         self.isltable = RFISLTable()
+        self.configfile = configfile
+        self.islconffile = islconffile
         self.config = RFConfig(configfile)
         self.islconf = RFISLConf(islconffile)
+        # RouteMod fan-out per (ct_id, dp_id), rebuilt after port events
+        self.flow_plans = {}
+        self.plan_lock = threading.Lock()
+        # Serializes port associations: both ends of an ISL, or a VM and its
+        # datapath, may be registered on different dispatcher shards
+        self.association_lock = threading.Lock()
+        # Dispatcher shard of each VM, see shard_key()
+        self.vm_shards = {}
+        # IPC id of the RFProxy (shard) each (ct_id, dp_id) registered from
+        self.proxy_ids = {}
+        # Last flow installation report of each (ct_id, dp_id)
+        self.flow_status = {}
         # Logging
         self.log = logging.getLogger("rfserver")
         self.log.setLevel(logging.INFO)
@@ -39,22 +81,88 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
         ch.setLevel(logging.INFO)
         ch.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
         self.log.addHandler(ch)
-
-        self.ipc = MongoIPC.MongoIPCMessageService(MONGO_ADDRESS,
-                                                   MONGO_DB_NAME,
-                                                   RFSERVER_ID,
-                                                   threading.Thread,
-                                                   time.sleep)
+        MongoClientFactory.start_reporter(self.log)
+
+        self.dispatcher = ShardedDispatcher(self.handle, self.shard_key,
+                                            workers)
+        # Collapse route churn before it reaches the datapaths
+        self.coalescer = None
+        if coalesce_window > 0:
+            self.coalescer = RouteModCoalescer(self.dispatcher.dispatch,
+                                               coalesce_window)
+
+        if ipc is None:
+            ipc = IPCServiceFactory.make(RFSERVER_ID, threading.Thread,
+                                         time.sleep)
+        self.ipc = ipc
         self.ipc.listen(RFCLIENT_RFSERVER_CHANNEL, self, self, False)
-        self.ipc.listen(RFSERVER_RFPROXY_CHANNEL, self, self, True)
+        self.ipc.listen(RFSERVER_RFPROXY_CHANNEL, self, self, False)
 
     def process(self, from_, to, channel, msg):
         type_ = msg.get_type()
+        if type_ not in (PORT_REGISTER, ROUTE_MOD, DATAPATH_PORT_REGISTER,
+                         DATAPATH_DOWN, VIRTUAL_PLANE_MAP,
+                         DATAPATH_FLOW_STATUS):
+            return False
+        if type_ == DATAPATH_PORT_REGISTER:
+            self._learn_proxy(from_, msg.get_ct_id(), msg.get_dp_id())
+        if type_ == ROUTE_MOD and self.coalescer is not None:
+            self.coalescer.submit(msg)
+        else:
+            self.dispatcher.dispatch(msg)
+        return True
+
+    def _learn_proxy(self, from_, ct_id, dp_id):
+        # A controller split over several POX processes has an IPC id per
+        # shard, and only the shard a datapath is connected to handles it
+        key = (int(ct_id), int(dp_id))
+        if self.proxy_ids.get(key) != from_:
+            self.proxy_ids[key] = from_
+            self._invalidate_flow_plan(ct_id, dp_id)
+
+    def proxy_for(self, ct_id, dp_id):
+        """Return the IPC id of the RFProxy that handles a datapath."""
+        return self.proxy_ids.get((int(ct_id), int(dp_id)), proxy_id(ct_id))
+
+    def shard_key(self, msg):
+        type_ = msg.get_type()
+        if type_ in (DATAPATH_PORT_REGISTER, DATAPATH_DOWN,
+                     DATAPATH_FLOW_STATUS):
+            return (str(msg.get_ct_id()), str(msg.get_dp_id()))
+        elif type_ == ROUTE_MOD:
+            return self._vm_shard(msg.get_id())
+        else:
+            return self._vm_shard(msg.get_vm_id())
+
+    def _vm_shard(self, vm_id):
+        # Messages for a VM share the shard of the datapath it is configured
+        # for, so its routes are handled after its ports are registered
+        shard = self.vm_shards.get(vm_id)
+        if shard is None:
+            entries = self.config.get_entries(vm_id=vm_id)
+            if entries:
+                entry = min(entries, key=lambda e: (e.ct_id, e.dp_id))
+                shard = (str(entry.ct_id), str(entry.dp_id))
+            else:
+                shard = str(vm_id)
+            self.vm_shards[vm_id] = shard
+        return shard
+
+    # Called by the dispatcher workers
+    def handle(self, msg):
+        type_ = msg.get_type()
+        if type_ == ROUTE_MOD:
+            self.register_route_mod(msg)
+        elif type_ == DATAPATH_FLOW_STATUS:
+            self.update_flow_status(msg)
+        else:
+            with self.association_lock:
+                self._handle_association(type_, msg)
+
+    def _handle_association(self, type_, msg):
         if type_ == PORT_REGISTER:
             self.register_vm_port(msg.get_vm_id(), msg.get_vm_port(),
                                   msg.get_hwaddress())
-        elif type_ == ROUTE_MOD:
-            self.register_route_mod(msg)
         elif type_ == DATAPATH_PORT_REGISTER:
             self.register_dp_port(msg.get_ct_id(),
                                   msg.get_dp_id(),
@@ -64,9 +172,6 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
         elif type_ == VIRTUAL_PLANE_MAP:
             self.map_port(msg.get_vm_id(), msg.get_vm_port(),
                           msg.get_vs_id(), msg.get_vs_port())
-        else:
-            return False
-        return True
 
     # Port register methods
     def register_vm_port(self, vm_id, vm_port, eth_addr):
@@ -96,6 +201,7 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
         elif action == REGISTER_ASSOCIATED:
             entry.associate(vm_id, vm_port, eth_addr=eth_addr)
             self.rftable.set_entry(entry)
+            self._invalidate_flow_plan(entry.ct_id, entry.dp_id)
             self.config_vm_port(vm_id, vm_port)
             self.log.info("Registering client port and associating to "
                           "datapath port (vm_id=%s, vm_port=%i, "
@@ -145,46 +251,65 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
                     action_output.set_value(entry.dp_port)
                     rm.actions[i] = action_output.to_dict()
 
-                entries = self.rftable.get_entries(dp_id=entry.dp_id,
-                                                   ct_id=entry.ct_id)
-                entries.extend(self.isltable.get_entries(dp_id=entry.dp_id,
-                                                         ct_id=entry.ct_id))
                 rm.add_option(Option.CT_ID(entry.ct_id))
 
-                self._send_rm_with_matches(rm, entry.dp_port, entries)
-
-                remote_dps = self.isltable.get_entries(rem_ct=entry.ct_id,
-                                                       rem_id=entry.dp_id)
-                for r in remote_dps:
-                    if r.get_status() == RFISL_ACTIVE:
-                        rm.set_options(rm.get_options()[:-1])
-                        rm.add_option(Option.CT_ID(r.ct_id))
-                        rm.set_id(int(r.dp_id))
-                        rm.set_actions(None)
-                        rm.add_action(Action.SET_ETH_SRC(r.eth_addr))
-                        rm.add_action(Action.SET_ETH_DST(r.rem_eth_addr))
-                        rm.add_action(Action.OUTPUT(r.dp_port))
-                        entries = self.rftable.get_entries(dp_id=r.dp_id,
-                                                           ct_id=r.ct_id)
-                        self._send_rm_with_matches(rm, r.dp_port, entries)
-
+                plan = self._get_flow_plan(entry.ct_id, entry.dp_id)
+                messages = self._expand_route_mod(rm, entry.dp_port,
+                                                  plan.ports + plan.isl_ports)
+
+                for r in plan.remotes:
+                    remote_rm = RouteMod(rm.get_mod(), r.dp_id,
+                                         rm.get_matches(), None,
+                                         rm.get_options()[:-1])
+                    remote_rm.add_option(Option.CT_ID(r.ct_id))
+                    remote_rm.add_action(Action.SET_ETH_SRC(r.eth_addr))
+                    remote_rm.add_action(Action.SET_ETH_DST(r.rem_eth_addr))
+                    remote_rm.add_action(Action.OUTPUT(r.dp_port))
+                    remote_plan = self._get_flow_plan(r.ct_id, r.dp_id)
+                    messages.extend(self._expand_route_mod(remote_rm,
+                                                           r.dp_port,
+                                                           remote_plan.ports))
+
+                self.ipc.send_many(RFSERVER_RFPROXY_CHANNEL, messages)
                 return
 
         # If no output action is found, don't forward the routemod.
         self.log.info("Received RouteMod with no Output Port - Dropping "
                       "(vm_id=%s)" % (format_id(vm_id)))
 
-    def _send_rm_with_matches(self, rm, out_port, entries):
-        #send entries matching external ports
-        for entry in entries:
-            if out_port != entry.dp_port:
-                if entry.get_status() == RFENTRY_ACTIVE or \
-                   entry.get_status() == RFISL_ACTIVE:
-                    rm.add_match(Match.ETHERNET(entry.eth_addr))
-                    rm.add_match(Match.IN_PORT(entry.dp_port))
-                    self.ipc.send(RFSERVER_RFPROXY_CHANNEL,
-                                  str(entry.ct_id), rm)
-                    rm.set_matches(rm.get_matches()[:-2])
+    def _expand_route_mod(self, rm, out_port, ports):
+        # Make one copy of the RouteMod per ingress port, except the output
+        messages = []
+        for (to, dp_port, port_matches) in ports:
+            if out_port != dp_port:
+                messages.append((to, RouteMod(rm.get_mod(), rm.get_id(),
+                                              rm.get_matches() + port_matches,
+                                              rm.get_actions(),
+                                              rm.get_options())))
+        return messages
+
+    def _get_flow_plan(self, ct_id, dp_id):
+        with self.plan_lock:
+            plan = self.flow_plans.get((ct_id, dp_id))
+            if plan is None:
+                plan = DatapathFlowPlan(
+                    self.proxy_for(ct_id, dp_id),
+                    self.rftable.get_dp_entries(ct_id, dp_id),
+                    self.isltable.get_dp_entries(ct_id, dp_id),
+                    self.isltable.get_entries(rem_ct=ct_id, rem_id=dp_id))
+                self.flow_plans[(ct_id, dp_id)] = plan
+            return plan
+
+    def _invalidate_flow_plan(self, ct_id=None, dp_id=None):
+        # Without a datapath, invalidate all plans (ISLs span datapaths)
+        with self.plan_lock:
+            if ct_id is None or dp_id is None:
+                self.flow_plans.clear()
+            else:
+                self.flow_plans.pop((ct_id, dp_id), None)
+        # Flows may be gone or placed elsewhere, so forward every route again
+        if self.coalescer is not None:
+            self.coalescer.forget()
 
     # DatapathPortRegister methods
     def register_dp_port(self, ct_id, dp_id, dp_port):
@@ -217,11 +342,13 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
         if action == REGISTER_IDLE:
             self.rftable.set_entry(RFEntry(ct_id=ct_id, dp_id=dp_id,
                                            dp_port=dp_port))
+            self._invalidate_flow_plan(ct_id, dp_id)
             self.log.info("Registering datapath port as idle (dp_id=%s, "
                           "dp_port=%i)" % (format_id(dp_id), dp_port))
         elif action == REGISTER_ASSOCIATED:
             entry.associate(dp_id, dp_port, ct_id)
             self.rftable.set_entry(entry)
+            self._invalidate_flow_plan(ct_id, dp_id)
             self.config_vm_port(entry.vm_id, entry.vm_port)
             self.log.info("Registering datapath port and associating to "
                           "client port (dp_id=%s, dp_port=%i, vm_id=%s, "
@@ -230,6 +357,7 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
                                            entry.vm_port))
         elif action == REGISTER_ISL:
             self._register_islconf(islconfs, ct_id, dp_id, dp_port)
+            self._invalidate_flow_plan()
 
     def _register_islconf(self, c_entries, ct_id, dp_id, dp_port):
         for conf in c_entries:
@@ -331,7 +459,8 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
             rm.add_action(Action.CONTROLLER())
 
         rm.add_option(Option.CT_ID(ct_id))
-        self.ipc.send(RFSERVER_RFPROXY_CHANNEL, str(ct_id), rm)
+        self.ipc.send(RFSERVER_RFPROXY_CHANNEL, self.proxy_for(ct_id, dp_id),
+                      rm)
 
     def config_dp(self, ct_id, dp_id):
         if is_rfvs(dp_id):
@@ -369,8 +498,24 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
         for entry in self.isltable.get_entries(rem_ct=ct_id, rem_id=dp_id):
             entry.make_idle(RFISL_IDLE_DP_PORT)
             self.isltable.set_entry(entry)
+        self._invalidate_flow_plan()
+        self.flow_status.pop((ct_id, dp_id), None)
         self.log.info("Datapath down (dp_id=%s)" % format_id(dp_id))
 
+    def update_flow_status(self, msg):
+        ct_id, dp_id = msg.get_ct_id(), msg.get_dp_id()
+        self.flow_status[(ct_id, dp_id)] = {
+            "installed": msg.get_installed(),
+            "failed": msg.get_failed(),
+            "pending": msg.get_pending(),
+            "install_rate": msg.get_install_rate(),
+        }
+        log = self.log.warning if msg.get_failed() else self.log.info
+        log("Flows in datapath (dp_id=%s): installed=%d, failed=%d, "
+            "pending=%d, %d/s" % (format_id(dp_id), msg.get_installed(),
+                                  msg.get_failed(), msg.get_pending(),
+                                  msg.get_install_rate()))
+
     def set_dp_port_down(self, ct_id, dp_id, dp_port):
         entry = self.rftable.get_entry_by_dp_port(ct_id, dp_id, dp_port)
         if entry is not None:
@@ -379,6 +524,7 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
             vm_id, vm_port = entry.vm_id, entry.vm_port
             entry.make_idle(RFENTRY_IDLE_VM_PORT)
             self.rftable.set_entry(entry)
+            self._invalidate_flow_plan(ct_id, dp_id)
             if vm_id is not None:
                 self.reset_vm_port(vm_id, vm_port)
             self.log.debug("Datapath port down (dp_id=%s, dp_port=%i)" %
@@ -399,10 +545,15 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
             # If the association is valid, activate it
             entry.activate(vs_id, vs_port)
             self.rftable.set_entry(entry)
+            self._invalidate_flow_plan(entry.ct_id, entry.dp_id)
             msg = DataPlaneMap(ct_id=entry.ct_id,
                                dp_id=entry.dp_id, dp_port=entry.dp_port,
                                vs_id=vs_id, vs_port=vs_port)
-            self.ipc.send(RFSERVER_RFPROXY_CHANNEL, str(entry.ct_id), msg)
+            # Both the datapath and the RFVS relay packets with the mapping
+            proxies = set([self.proxy_for(entry.ct_id, entry.dp_id),
+                           self.proxy_for(entry.ct_id, vs_id)])
+            self.ipc.send_many(RFSERVER_RFPROXY_CHANNEL,
+                               [(to, msg) for to in sorted(proxies)])
             self.log.info("Mapping client-datapath association "
                           "(vm_id=%s, vm_port=%i, dp_id=%s, "
                           "dp_port=%i, vs_id=%s, vs_port=%i)" %
@@ -410,6 +561,70 @@ class RFServer(RFProtocolFactory, IPC.IPCMessageProcessor):
                            format_id(entry.dp_id), entry.dp_port,
                            format_id(entry.vs_id), entry.vs_port))
 
+    # Configuration reload methods
+    def reload_config(self):
+        # Associations change, so no message may be handled meanwhile
+        self.dispatcher.run_exclusive(self._reload_config)
+
+    def _reload_config(self):
+        try:
+            config = self.config.read(self.configfile)
+            islconf = self.islconf.read(self.islconffile)
+        except (IOError, ConfigError) as e:
+            self.log.error("Keeping current configuration: %s" % str(e))
+            return
+        (added, removed) = self.config.replace(config)
+        (isl_added, isl_removed) = self.islconf.replace(islconf)
+        self.vm_shards.clear()
+        for conf in removed:
+            self._unconfigure(conf)
+        for conf in added:
+            self._configure(conf)
+        # ISL changes apply when the datapath ports register again
+        self.log.info("Reloaded configuration (%d associations added, %d "
+                      "removed, %d ISL entries added, %d removed)" %
+                      (len(added), len(removed), len(isl_added),
+                       len(isl_removed)))
+
+    def _unconfigure(self, conf):
+        entry = self.rftable.get_entry_by_vm_port(conf.vm_id, conf.vm_port)
+        if entry is None or entry.get_status() not in (RFENTRY_ASSOCIATED,
+                                                       RFENTRY_ACTIVE):
+            return
+        if (entry.ct_id, entry.dp_id, entry.dp_port) != \
+           (conf.ct_id, conf.dp_id, conf.dp_port):
+            return
+        # Keep the datapath port, and have the client register its port again
+        entry.make_idle(RFENTRY_IDLE_DP_PORT)
+        self.rftable.set_entry(entry)
+        self._invalidate_flow_plan(conf.ct_id, conf.dp_id)
+        self.reset_vm_port(conf.vm_id, conf.vm_port)
+        self.log.info("Removing client-datapath association (vm_id=%s, "
+                      "vm_port=%i, dp_id=%s, dp_port=%i)" %
+                      (format_id(conf.vm_id), conf.vm_port,
+                       format_id(conf.dp_id), conf.dp_port))
+
+    def _configure(self, conf):
+        vm_entry = self.rftable.get_entry_by_vm_port(conf.vm_id, conf.vm_port)
+        dp_entry = self.rftable.get_entry_by_dp_port(conf.ct_id, conf.dp_id,
+                                                     conf.dp_port)
+        # Ports that haven't registered yet are associated when they do
+        if vm_entry is None or dp_entry is None:
+            return
+        if vm_entry.get_status() != RFENTRY_IDLE_VM_PORT or \
+           dp_entry.get_status() != RFENTRY_IDLE_DP_PORT:
+            return
+        dp_entry.associate(conf.vm_id, conf.vm_port,
+                           eth_addr=vm_entry.eth_addr)
+        self.rftable.remove_entry(vm_entry)
+        self.rftable.set_entry(dp_entry)
+        self._invalidate_flow_plan(conf.ct_id, conf.dp_id)
+        self.config_vm_port(conf.vm_id, conf.vm_port)
+        self.log.info("Adding client-datapath association (vm_id=%s, "
+                      "vm_port=%i, dp_id=%s, dp_port=%i)" %
+                      (format_id(conf.vm_id), conf.vm_port,
+                       format_id(conf.dp_id), conf.dp_port))
+
 if __name__ == "__main__":
     description='RFServer co-ordinates RFClient and RFProxy instances, ' \
                 'listens for route updates, and configures flow tables'
@@ -420,9 +635,29 @@ if __name__ == "__main__":
                         help='VM-VS-DP mapping configuration file')
     parser.add_argument('-i', '--islconfig',
                         help='ISL mapping configuration file')
+    parser.add_argument('-w', '--coalesce-window', type=float,
+                        default=COALESCE_WINDOW,
+                        help='seconds to hold route updates so that churn '
+                             'for the same route is coalesced, 0 to disable '
+                             '(default: %(default)s)')
+    parser.add_argument('-t', '--workers', type=int, default=WORKERS,
+                        help='worker threads processing messages, messages '
+                             'for the same datapath are always processed in '
+                             'order (default: %(default)s)')
 
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("there must be at least one worker")
     try:
-        RFServer(args.configfile, args.islconfig)
+        server = RFServer(args.configfile, args.islconfig,
+                          args.coalesce_window, args.workers)
     except IOError:
         sys.exit("Error opening file: {}".format(args.configfile))
+    except ConfigError as e:
+        sys.exit("Error in configuration: {}".format(e))
+
+    # SIGHUP reloads the configuration files
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: server.reload_config())
+    while True:
+        signal.pause()
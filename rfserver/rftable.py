@@ -1,8 +1,12 @@
 import pymongo as mongo
 import bson
+import copy
+import threading
+import atexit
+import logging
 
 from rflib.defs import *
-from rflib.ipc.MongoIPC import format_address
+from rflib.ipc.MongoClientFactory import MongoClientFactory, format_address
 
 RFENTRY_IDLE_VM_PORT = 1
 RFENTRY_IDLE_DP_PORT = 2
@@ -17,6 +21,13 @@ RFCONFIGENTRY = 1
 RFISLCONFENTRY = 2
 RFISLENTRY = 3
 
+log = logging.getLogger("rfserver")
+
+# Seconds between write-behind flushes of cached tables
+FLUSH_INTERVAL = 0.1
+# Number of pending writes that triggers an early flush
+FLUSH_BATCH_SIZE = 512
+
 class MongoTableEntryFactory:
     @staticmethod
     def make(type_):
@@ -32,7 +43,7 @@ class MongoTableEntryFactory:
 class MongoTable:
     def __init__(self, address, name, entry_type):
         self.address = format_address(address)
-        self.connection = mongo.Connection(*self.address)
+        self.connection = MongoClientFactory.get(address)
         self.data = self.connection[MONGO_DB_NAME][name]
         self.entry_type = entry_type
 
@@ -49,13 +60,17 @@ class MongoTable:
 
     def set_entry(self, entry):
         # TODO: enforce (*_id, *_port) uniqueness restriction
-        entry.id = self.data.save(entry.to_dict())
+        with MongoClientFactory.stats.timed("table_write"):
+            entry.id = self.data.save(entry.to_dict(),
+                                      **MONGO_TABLE_WRITE_CONCERN)
 
     def remove_entry(self, entry):
-        self.data.remove(entry.id)
+        with MongoClientFactory.stats.timed("table_write"):
+            self.data.remove(entry.id, **MONGO_TABLE_WRITE_CONCERN)
 
     def clear(self):
-        self.data.remove()
+        with MongoClientFactory.stats.timed("table_write"):
+            self.data.remove(**MONGO_TABLE_WRITE_CONCERN)
 
     def __str__(self):
         s = ""
@@ -64,9 +79,151 @@ class MongoTable:
         return s.strip("\n")
 
 
-class RFTable(MongoTable):
+def index_value(value):
+    # Index keys use the same representation as the documents stored in
+    # MongoDB, so lookups behave exactly like the equivalent find()
+    return "" if value is None else str(value)
+
+class CachedMongoTable(MongoTable):
+    """A MongoTable that serves every read from memory.
+
+    Entries are kept in process, with hash indexes on the given field
+    combinations. MongoDB remains the durable store: the table is warmed from
+    it on construction and changes are written back in batches by a
+    background flusher thread.
+    """
+    def __init__(self, address, name, entry_type, indexes):
+        MongoTable.__init__(self, address, name, entry_type)
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._indexes = {}
+        for fields in indexes:
+            self._indexes[tuple(sorted(fields))] = {}
+        self._ensure_indexes(indexes)
+        self._pending = {}
+        self._flush_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._load()
+        flusher = threading.Thread(target=self._flush_worker)
+        flusher.daemon = True
+        flusher.start()
+        atexit.register(self.flush)
+
+    def get_entries(self, **kwargs):
+        fields = tuple(sorted(kwargs.keys()))
+        key = tuple(index_value(kwargs[f]) for f in fields)
+        with self._lock:
+            if fields in self._indexes:
+                ids = sorted(self._indexes[fields].get(key, ()))
+            else:
+                ids = [id_ for id_ in sorted(self._entries)
+                       if self._key(self._entries[id_], fields) == key]
+            return [copy.copy(self._entries[id_]) for id_ in ids]
+
+    def set_entry(self, entry):
+        if entry.id is None:
+            entry.id = bson.ObjectId()
+        with self._lock:
+            self._unindex(entry.id)
+            self._index(copy.copy(entry))
+            self._queue(entry.id, entry.to_dict())
+
+    def remove_entry(self, entry):
+        with self._lock:
+            self._unindex(entry.id)
+            self._queue(entry.id, None)
+
+    def clear(self):
+        # A flush in progress must not write cleared entries back
+        with self._flush_lock:
+            with self._lock:
+                self._entries = {}
+                for index in self._indexes.values():
+                    index.clear()
+                self._pending = {}
+                with MongoClientFactory.stats.timed("table_write"):
+                    self.data.remove(**MONGO_TABLE_WRITE_CONCERN)
+
+    def flush(self):
+        """Write all pending changes to MongoDB."""
+        # Serialize flushes so an older batch never lands after a newer one
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return
+            bulk = self.data.initialize_unordered_bulk_op()
+            for (id_, doc) in pending.items():
+                if doc is None:
+                    bulk.find({"_id": id_}).remove_one()
+                else:
+                    bulk.find({"_id": id_}).upsert().replace_one(doc)
+            try:
+                with MongoClientFactory.stats.timed("table_flush"):
+                    bulk.execute(MONGO_TABLE_WRITE_CONCERN)
+            except:
+                # Keep the batch for the next flush, unless superseded
+                with self._lock:
+                    for (id_, doc) in pending.items():
+                        self._pending.setdefault(id_, doc)
+                raise
+
+    def _flush_worker(self):
+        while True:
+            self._flush_event.wait(FLUSH_INTERVAL)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.warning("Failed to flush %s to database: %s",
+                            self.data.name, str(e))
+
+    def _queue(self, id_, doc):
+        # Only the latest state of an entry needs to reach the database
+        self._pending[id_] = doc
+        if len(self._pending) >= FLUSH_BATCH_SIZE:
+            self._flush_event.set()
+
+    def _ensure_indexes(self, indexes):
+        # The same lookups are made directly on the collection by rfweb
+        MongoClientFactory.ensure_indexes(self.data, indexes, log)
+
+    def _load(self):
+        with MongoClientFactory.stats.timed("table_load"):
+            results = list(self.data.find(sort=[("_id", mongo.ASCENDING)]))
+        for result in results:
+            entry = MongoTableEntryFactory.make(self.entry_type)
+            entry.from_dict(result)
+            self._index(entry)
+
+    def _key(self, entry, fields):
+        return tuple(index_value(getattr(entry, f)) for f in fields)
+
+    def _index(self, entry):
+        self._entries[entry.id] = entry
+        for (fields, index) in self._indexes.items():
+            index.setdefault(self._key(entry, fields), set()).add(entry.id)
+
+    def _unindex(self, id_):
+        entry = self._entries.pop(id_, None)
+        if entry is None:
+            return
+        for (fields, index) in self._indexes.items():
+            key = self._key(entry, fields)
+            bucket = index[key]
+            bucket.discard(id_)
+            if not bucket:
+                del index[key]
+
+
+class RFTable(CachedMongoTable):
     def __init__(self, address=MONGO_ADDRESS):
-        MongoTable.__init__(self, address, RFTABLE_NAME, RFENTRY)
+        CachedMongoTable.__init__(self, address, RFTABLE_NAME, RFENTRY,
+                                  [("vm_id", "vm_port"),
+                                   ("ct_id", "dp_id", "dp_port"),
+                                   ("vs_id", "vs_port"),
+                                   ("ct_id", "dp_id")])
 
     def get_entry_by_vm_port(self, vm_id, vm_port):
         result = self.get_entries(vm_id=vm_id,
@@ -97,17 +254,121 @@ class RFTable(MongoTable):
         return bool(self.get_dp_entries(ct_id, dp_id))
 
 
-class RFConfig(MongoTable):
+class ConfigError(Exception):
+    pass
+
+class ConfigTable(CachedMongoTable):
+    """A CachedMongoTable holding the contents of a CSV configuration file.
+
+    A file is validated as a whole before anything is changed, and only the
+    difference from the current contents is written to MongoDB, in a single
+    bulk operation. Every field combination in `unique` is backed by a unique
+    index and may appear only once.
+    """
+    def __init__(self, address, name, entry_type, indexes, unique):
+        self.unique = unique
+        CachedMongoTable.__init__(self, address, name, entry_type,
+                                  indexes + unique)
+
+    def parse_line(self, fields):
+        """Return the entry for the fields of a line, or raise ValueError."""
+        raise NotImplementedError
+
+    def read(self, ifile):
+        """Return the validated entries of a CSV file."""
+        configfile = open(ifile)
+        lines = configfile.readlines()
+        configfile.close()
+        entries = []
+        seen = [{} for fields in self.unique]
+        # Skip the header line
+        for (n, line) in enumerate(lines[1:], 2):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = self.parse_line([f.strip() for f in line.split(",")])
+            except ValueError:
+                raise ConfigError("%s:%d: invalid entry \"%s\"" %
+                                  (ifile, n, line))
+            for (fields, keys) in zip(self.unique, seen):
+                key = self._key(entry, fields)
+                if key in keys:
+                    raise ConfigError("%s:%d: %s already configured on line "
+                                      "%d" % (ifile, n, ", ".join(fields),
+                                              keys[key]))
+                keys[key] = n
+            entries.append(entry)
+        return entries
+
+    def load(self, ifile):
+        return self.replace(self.read(ifile))
+
+    def replace(self, entries):
+        """Make entries the contents of the table.
+
+        Returns the lists of entries added and removed.
+        """
+        added = []
+        removed = []
+        with self._lock:
+            current = {}
+            for id_ in sorted(self._entries):
+                entry = self._entries[id_]
+                current.setdefault(self._content(entry), []).append(entry)
+            # Rows stored more than once by older versions are dropped
+            stale = []
+            for entry in entries:
+                existing = current.pop(self._content(entry), None)
+                if existing is None:
+                    entry.id = bson.ObjectId()
+                    added.append(entry)
+                else:
+                    stale.extend(existing[1:])
+            for existing in current.values():
+                removed.extend(existing)
+
+            if added or removed or stale:
+                # Removals go first so that unique indexes are never violated
+                bulk = self.data.initialize_ordered_bulk_op()
+                for entry in removed + stale:
+                    bulk.find({"_id": entry.id}).remove_one()
+                for entry in added:
+                    bulk.insert(entry.to_dict())
+                with MongoClientFactory.stats.timed("table_flush"):
+                    bulk.execute(MONGO_TABLE_WRITE_CONCERN)
+            MongoClientFactory.ensure_indexes(self.data, self.unique, log,
+                                              unique=True)
+
+            for entry in removed + stale:
+                self._unindex(entry.id)
+            for entry in added:
+                self._index(copy.copy(entry))
+        return (added, removed)
+
+    def _ensure_indexes(self, indexes):
+        # Unique indexes are created by replace(), once duplicates are gone
+        CachedMongoTable._ensure_indexes(self, [fields for fields in indexes
+                                                if fields not in self.unique])
+
+    def _content(self, entry):
+        data = entry.to_dict()
+        data.pop("_id", None)
+        return tuple(sorted(data.items()))
+
+
+class RFConfig(ConfigTable):
     def __init__(self, ifile, address=MONGO_ADDRESS):
-        MongoTable.__init__(self, address, RFCONFIG_NAME, RFCONFIGENTRY)
-        # TODO: perform validation of config
-        configfile = file(ifile)
-        lines = configfile.readlines()[1:]
-        entries = [line.strip("\n").split(",") for line in lines]
-        for (a, b, c, d, e) in entries:
-            self.set_entry(RFConfigEntry(vm_id=int(a, 16), vm_port=int(b),
-                                         ct_id=int(c), dp_id=int(d, 16),
-                                         dp_port=int(e)))
+        ConfigTable.__init__(self, address, RFCONFIG_NAME, RFCONFIGENTRY,
+                             [("vm_id",)],
+                             [("vm_id", "vm_port"),
+                              ("ct_id", "dp_id", "dp_port")])
+        self.load(ifile)
+
+    def parse_line(self, fields):
+        (a, b, c, d, e) = fields
+        return RFConfigEntry(vm_id=int(a, 16), vm_port=int(b),
+                             ct_id=int(c), dp_id=int(d, 16), dp_port=int(e))
 
     def get_config_for_vm_port(self, vm_id, vm_port):
         result = self.get_entries(vm_id=vm_id,
@@ -124,9 +385,14 @@ class RFConfig(MongoTable):
             return None
         return result[0]
 
-class RFISLTable(MongoTable):
+class RFISLTable(CachedMongoTable):
     def __init__(self, address=MONGO_ADDRESS):
-        MongoTable.__init__(self, address, RFISL_NAME, RFISLENTRY)
+        CachedMongoTable.__init__(self, address, RFISL_NAME, RFISLENTRY,
+                                  [("ct_id", "dp_id"),
+                                   ("ct_id", "dp_id", "dp_port", "eth_addr"),
+                                   ("rem_ct", "rem_id"),
+                                   ("rem_ct", "rem_id", "rem_port",
+                                    "rem_eth_addr")])
 
     def get_entry_by_addr(self, ct_id, dp_id, dp_port, eth_addr):
         result = self.get_entries(ct_id=ct_id, dp_id=dp_id, dp_port=dp_port,
@@ -148,23 +414,34 @@ class RFISLTable(MongoTable):
     def is_dp_registered(self, ct_id, dp_id):
         return bool(self.get_dp_entries(ct_id, dp_id))
 
-class RFISLConf(MongoTable):
+class RFISLConf(ConfigTable):
     def __init__(self, ifile, address=MONGO_ADDRESS):
-        MongoTable.__init__(self, address, RFISLCONF_NAME, RFISLCONFENTRY)
-        # TODO: perform validation of config
+        ConfigTable.__init__(self, address, RFISLCONF_NAME, RFISLCONFENTRY,
+                             [("ct_id", "dp_id", "dp_port"),
+                              ("rem_ct", "rem_id", "rem_port")],
+                             [("ct_id", "dp_id", "dp_port",
+                               "rem_ct", "rem_id", "rem_port")])
         try:
-            internalfile = file(ifile)
-        except:
+            self.load(ifile)
+        except IOError:
+            # Starting without the ISL config file is the same as an empty one
+            self.replace([])
+
+    def read(self, ifile):
+        if ifile is None:
             # Default to no ISL config
-            return
-        lines = internalfile.readlines()[1:]
-        entries = [line.strip("\n").split(",") for line in lines]
-        for (a, b, c, d, e, f, g, h, i) in entries:
-            self.set_entry(RFISLConfEntry(vm_id=int(a, 16), ct_id=int(b),
-                                          dp_id=int(c, 16), dp_port=int(d),
-                                          eth_addr=e, rem_ct=int(f),
-                                          rem_id=int(g, 16), rem_port=int(h),
-                                          rem_eth_addr=i))
+            return []
+        return ConfigTable.read(self, ifile)
+
+    def parse_line(self, fields):
+        (a, b, c, d, e, f, g, h, i) = fields
+        if not e or not i:
+            raise ValueError
+        return RFISLConfEntry(vm_id=int(a, 16), ct_id=int(b),
+                              dp_id=int(c, 16), dp_port=int(d),
+                              eth_addr=e, rem_ct=int(f),
+                              rem_id=int(g, 16), rem_port=int(h),
+                              rem_eth_addr=i)
 
     def get_entries_by_port(self, ct, id_, port):
         results = self.get_entries(ct_id=ct, dp_id=id_, dp_port=port)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Measures how many RouteMod messages per second each IPC codec can encode
+# into and decode from BSON envelopes.
+
+import time
+import argparse
+import bson
+
+from rflib.defs import *
+import rflib.ipc.MongoIPC as MongoIPC
+from rflib.ipc.RFProtocol import *
+from rflib.ipc.RFProtocolFactory import RFProtocolFactory
+from rflib.types.Match import *
+from rflib.types.Action import *
+from rflib.types.Option import *
+
+def make_route_mod(i):
+    rm = RouteMod(RMT_ADD, 0x99000000000000 + i)
+    rm.add_match(Match.IPV4("10.%d.%d.0" % (i >> 8 & 0xFF, i & 0xFF),
+                            "255.255.255.0"))
+    rm.add_match(Match.ETHERNET("12:34:56:78:9a:bc"))
+    rm.add_match(Match.IN_PORT(i % 48 + 1))
+    rm.add_action(Action.SET_ETH_SRC("12:34:56:78:9a:bc"))
+    rm.add_action(Action.SET_ETH_DST("cb:a9:87:65:43:21"))
+    rm.add_action(Action.OUTPUT(1))
+    rm.add_option(Option.PRIORITY(PRIORITY_HIGH))
+    rm.add_option(Option.CT_ID(0))
+    return rm
+
+def bench(name, compact, messages):
+    start = time.time()
+    encoded = [bson.BSON.encode(MongoIPC.put_in_envelope("rfserver", "0",
+                                                         rm, compact))
+               for rm in messages]
+    encode_time = time.time() - start
+
+    factory = RFProtocolFactory()
+    start = time.time()
+    for data in encoded:
+        MongoIPC.take_from_envelope(bson.BSON(data).decode(), factory)
+    decode_time = time.time() - start
+
+    print("%-8s encode %9.0f msgs/s  decode %9.0f msgs/s  %5d bytes/msg" %
+          (name, len(messages) / encode_time, len(messages) / decode_time,
+           sum(len(data) for data in encoded) / len(encoded)))
+
+if __name__ == "__main__":
+    description = 'Measure RouteMod encode/decode throughput of IPC codecs'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--count', type=int, default=50000,
+                        help='number of RouteMods to encode (default: 50000)')
+    args = parser.parse_args()
+
+    messages = [make_route_mod(i) for i in range(args.count)]
+    bench("string", False, messages)
+    bench("compact", True, messages)
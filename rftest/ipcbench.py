@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Compares the latency and throughput of the IPC backends by sending RouteMod
+# messages from one service to another over a scratch channel.
+
+import os
+import sys
+import time
+import threading
+import argparse
+import pymongo
+
+import rflib.defs as defs
+from rflib.defs import RMT_ADD
+from rflib.ipc.MongoIPC import format_address
+from rflib.ipc.IPCServiceFactory import IPCServiceFactory
+import rflib.ipc.SocketIPC as SocketIPC
+import rflib.ipc.IPC as IPC
+from rflib.ipc.RFProtocol import *
+from rflib.ipc.RFProtocolFactory import RFProtocolFactory
+from rflib.types.Match import *
+from rflib.types.Action import *
+
+BENCH_CHANNEL = "ipcbench"
+SENDER_ID = "ipcbench-sender"
+RECEIVER_ID = "ipcbench-receiver"
+
+class BenchProcessor(IPC.IPCMessageProcessor):
+    def __init__(self, count):
+        self.count = count
+        self.received = {}
+        self.done = threading.Event()
+
+    def process(self, from_, to, channel, msg):
+        self.received[msg.get_id()] = time.time()
+        if len(self.received) == self.count:
+            self.done.set()
+        return True
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def make_service(backend, id_, channel):
+    if backend == defs.IPC_SOCKET:
+        # Carry the scratch channel over sockets, without mirroring
+        return SocketIPC.SocketIPCMessageService(defs.SOCKET_IPC_ADDRESS,
+                                                 [channel], id_,
+                                                 threading.Thread, time.sleep)
+    return IPCServiceFactory.make(id_, threading.Thread, time.sleep, backend)
+
+def run(backend, count, rate):
+    # Listeners can't be stopped, so give each run its own channel
+    channel = BENCH_CHANNEL + "-" + backend
+    connection = pymongo.Connection(*format_address(defs.MONGO_ADDRESS))
+    connection[defs.MONGO_DB_NAME].drop_collection(channel)
+
+    processor = BenchProcessor(count)
+    receiver = make_service(backend, RECEIVER_ID, channel)
+    receiver.listen(channel, RFProtocolFactory(), processor, False)
+    sender = make_service(backend, SENDER_ID, channel)
+
+    sent = {}
+    start = time.time()
+    for i in range(count):
+        rm = RouteMod(RMT_ADD, i)
+        rm.add_match(Match.IPV4("10.%d.%d.0" % (i >> 8 & 0xFF, i & 0xFF),
+                                "255.255.255.0"))
+        rm.add_action(Action.OUTPUT(1))
+        sent[i] = time.time()
+        sender.send(channel, RECEIVER_ID, rm)
+        if rate:
+            time.sleep(1.0 / rate)
+    processor.done.wait(60)
+    elapsed = time.time() - start
+
+    latencies = [(processor.received[i] - sent[i]) * 1000
+                 for i in processor.received]
+    if not latencies:
+        print("%-12s no messages received" % backend)
+        return
+    print("%-12s %6d msgs %9.1f msgs/s  latency ms: p50 %7.2f  p90 %7.2f  "
+          "p99 %7.2f  max %7.2f" % (backend, len(latencies),
+                                    len(latencies) / elapsed,
+                                    percentile(latencies, 50),
+                                    percentile(latencies, 90),
+                                    percentile(latencies, 99),
+                                    max(latencies)))
+
+if __name__ == "__main__":
+    description = 'Compare latency and throughput of RouteFlow IPC backends'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help='number of messages to send (default: 5000)')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='messages per second to send (default: as fast '
+                             'as possible)')
+    parser.add_argument('-b', '--backend', action='append',
+                        help='backend to measure, may be repeated '
+                             '(default: all backends)')
+    args = parser.parse_args()
+
+    backends = [defs.IPC_MONGO_POLL, defs.IPC_MONGO_TAIL, defs.IPC_SOCKET]
+    for backend in args.backend or backends:
+        run(backend, args.count, args.rate)
+    # Listener threads never return
+    sys.stdout.flush()
+    os._exit(0)
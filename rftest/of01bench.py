@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Measures how many OpenFlow messages per second the POX of_01 I/O loop
+# handles, and their latency, for growing numbers of simulated switches.
+# Every switch keeps a window of echo requests outstanding; the controller
+# answers them in its message handlers. The switches run in a separate
+# process so they don't share the interpreter with the controller. With
+# --shards the controller is a front POX process handing the switches to
+# that many worker POX processes (see pox/openflow/shard.py).
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import argparse
+import subprocess
+import multiprocessing
+
+POX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pox")
+sys.path.insert(0, POX)
+
+OFP_VERSION = 0x01
+OFPT_HELLO = 0
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_FEATURES_REQUEST = 5
+OFPT_FEATURES_REPLY = 6
+OFPT_BARRIER_REQUEST = 18
+OFPT_BARRIER_REPLY = 19
+
+header = struct.Struct("!BBHL")
+# Header, datapath_id, n_buffers, n_tables, capabilities and actions of a
+# features reply without ports
+features_reply = struct.Struct("!BBHLQLB3xLL")
+
+
+class Switch:
+    """A switch that sends echo requests and times the replies."""
+    def __init__(self, port, dpid):
+        self.dpid = dpid
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.buf = ""
+        self.xid = 0
+        self.sent = {}
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def hello(self):
+        self.sock.sendall(header.pack(OFP_VERSION, OFPT_HELLO, 8, 0))
+
+    def echo(self):
+        self.xid += 1
+        self.sent[self.xid] = time.time()
+        self.sock.sendall(header.pack(OFP_VERSION, OFPT_ECHO_REQUEST, 8,
+                                      self.xid))
+
+    def read(self, latencies):
+        """Time the echo replies received and send a request for each."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return 0
+            raise
+        now = time.time()
+        self.buf += data
+        offset = 0
+        replies = 0
+        while len(self.buf) - offset >= 8:
+            (_, ofp_type, length, xid) = header.unpack_from(self.buf, offset)
+            if len(self.buf) - offset < length:
+                break
+            offset += length
+            if ofp_type == OFPT_ECHO_REPLY and xid in self.sent:
+                latencies.append(now - self.sent.pop(xid))
+                replies += 1
+            elif ofp_type == OFPT_FEATURES_REQUEST:
+                self.sock.sendall(features_reply.pack(
+                    OFP_VERSION, OFPT_FEATURES_REPLY, features_reply.size,
+                    xid, self.dpid, 0, 1, 0, 0))
+            elif ofp_type == OFPT_BARRIER_REQUEST:
+                self.sock.sendall(header.pack(OFP_VERSION,
+                                              OFPT_BARRIER_REPLY, 8, xid))
+        self.buf = self.buf[offset:]
+        for i in range(replies):
+            self.echo()
+        return replies
+
+    def close(self):
+        self.sock.close()
+
+
+def run_switches(port, n, window, duration, results):
+    switches = [Switch(port, i + 1) for i in range(n)]
+    for switch in switches:
+        switch.hello()
+    poller = select.epoll()
+    by_fd = {}
+    for switch in switches:
+        poller.register(switch.fileno(), select.EPOLLIN)
+        by_fd[switch.fileno()] = switch
+
+    # Let the controller finish its side of the handshakes
+    start = time.time()
+    while time.time() - start < 1 + n / 500.0:
+        for (fd, event) in poller.poll(0.1):
+            by_fd[fd].read([])
+    for switch in switches:
+        for i in range(window):
+            switch.echo()
+
+    latencies = []
+    messages = 0
+    start = time.time()
+    while time.time() - start < duration:
+        for (fd, event) in poller.poll(0.1):
+            messages += by_fd[fd].read(latencies)
+    elapsed = time.time() - start
+
+    for switch in switches:
+        switch.close()
+    results.put((messages, elapsed, latencies))
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench(port, n, args, send_counters=None):
+    if send_counters is not None:
+        before = dict(send_counters)
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_switches,
+                                      args=(port, n, args.window,
+                                            args.duration, results))
+    process.start()
+    (messages, elapsed, latencies) = results.get()
+    process.join()
+    if not latencies:
+        print("%5d switches: no replies" % n)
+        return
+    latencies.sort()
+    print("%5d switches  %9.0f msgs/s  latency ms: mean %7.3f  "
+          "p50 %7.3f  p99 %7.3f" %
+          (n, messages / elapsed, sum(latencies) / len(latencies) * 1000,
+           percentile(latencies, 0.5) * 1000,
+           percentile(latencies, 0.99) * 1000))
+    if send_counters is not None:
+        calls = send_counters["calls"] - before["calls"]
+        if calls:
+            print("%5s controller sends: %.2f msgs/call  %.0f bytes/call" %
+                  ("", (send_counters["messages"] - before["messages"]) /
+                   float(calls),
+                   (send_counters["bytes"] - before["bytes"]) /
+                   float(calls)))
+    # Give the controller time to drop the connections
+    time.sleep(0.5)
+
+if __name__ == "__main__":
+    description = 'Measure echo throughput and latency of the POX of_01 ' \
+                  'I/O loop for growing numbers of simulated switches'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-s', '--switches', default="1,10,100,1000",
+                        help='comma-separated numbers of switches '
+                             '(default: %(default)s)')
+    parser.add_argument('-w', '--window', type=int, default=4,
+                        help='echo requests each switch keeps outstanding '
+                             '(default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float, default=5,
+                        help='seconds each run lasts (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=6653,
+                        help='port the controller listens on '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-epoll', action='store_true',
+                        help='use the select() loop instead of epoll; it '
+                             'can\'t take more than about 500 switches')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='number of worker POX processes, or 0 to run '
+                             'of_01 in this process (default: %(default)s)')
+    args = parser.parse_args()
+
+    processes = []
+    send_counters = None
+    if args.shards:
+        options = ["--port=%d" % args.port, "--address=127.0.0.1",
+                   "--shards=%d" % args.shards,
+                   "--shard_socket=/tmp/of01bench-%d.sock" % os.getpid()]
+        if args.no_epoll:
+            options.append("--no_epoll")
+        command = [sys.executable, os.path.join(POX, "pox.py"),
+                   "log.level", "--WARNING", "openflow.of_01"] + options
+        processes.append(subprocess.Popen(command))
+        for shard in range(args.shards):
+            processes.append(subprocess.Popen(command +
+                                              ["--shard=%d" % shard]))
+        time.sleep(2)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+        from pox.core import core
+        import pox.openflow
+        import pox.openflow.of_01 as of_01
+        pox.openflow.launch()
+        task = of_01.OpenFlow_01_Task(args.port, "127.0.0.1",
+                                      use_epoll=not args.no_epoll)
+        task.start()
+        send_counters = of_01.send_counters
+        time.sleep(0.5)
+
+    print("of_01 with %s, %s" %
+          ("select" if args.no_epoll else "epoll",
+           "%d shards" % args.shards if args.shards else "in process"))
+    try:
+        for n in [int(n) for n in args.switches.split(",")]:
+            bench(args.port, n, args, send_counters)
+    finally:
+        for process in processes:
+            process.terminate()
+    sys.stdout.flush()
+    os._exit(0)
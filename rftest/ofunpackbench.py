@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Compares eager unpacking of OpenFlow messages by libopenflow_01 with the
+# lazy views, for each message type that has a view. Every message is
+# unpacked and then used in one of three ways: not at all (like a message
+# that is dropped), by reading a few scalar fields, or by reading all of it.
+
+import os
+import sys
+import time
+import argparse
+
+POX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pox")
+sys.path.insert(0, POX)
+
+import pox.openflow.libopenflow_01 as of
+from pox.lib.addresses import EthAddr
+
+
+def flow_stats(i):
+    match = of.ofp_match(dl_type=0x800, nw_dst="10.%d.%d.0/24" %
+                         (i / 256 % 256, i % 256))
+    return of.ofp_flow_stats(match=match, priority=i, packet_count=i,
+                             byte_count=i * 100,
+                             actions=[of.ofp_action_dl_addr.set_dst(
+                                          EthAddr("00:00:00:00:00:01")),
+                                      of.ofp_action_output(port=i % 48)])
+
+def use_fields(msg):
+    msg.xid
+    if isinstance(msg, of.ofp_stats_reply):
+        for stats in msg.body:
+            stats.packet_count
+            stats.byte_count
+    else:
+        msg.reason
+
+def use_all(msg):
+    msg.pack()
+
+# Name and message of each benchmark
+MESSAGES = [
+    ("packet_in 64B", of.ofp_packet_in(in_port=1, data="x" * 64)),
+    ("packet_in 1500B", of.ofp_packet_in(in_port=1, data="x" * 1500)),
+    ("flow_removed", of.ofp_flow_removed(match=of.ofp_match(in_port=1),
+                                         cookie=1, byte_count=100)),
+    ("port_status", of.ofp_port_status(desc=of.ofp_phy_port(
+        port_no=1, name="eth1", hw_addr=EthAddr("00:00:00:00:00:01")))),
+    ("flow stats x10", of.ofp_stats_reply(
+        type=of.OFPST_FLOW, body=[flow_stats(i) for i in range(10)])),
+    ("flow stats x200", of.ofp_stats_reply(
+        type=of.OFPST_FLOW, body=[flow_stats(i) for i in range(200)])),
+]
+
+# How each message is used after it is unpacked
+USES = [
+    ("none", None),
+    ("fields", use_fields),
+    ("all", use_all),
+]
+
+
+def bench(cls, raw, use, duration):
+    """Return the number of messages unpacked (and used) per second."""
+    unpack = cls.unpack_new
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        for i in xrange(100):
+            msg = unpack(raw, 0)[1]
+            if use is not None:
+                use(msg)
+        count += 100
+        elapsed = time.time() - start
+    return count / elapsed
+
+if __name__ == "__main__":
+    description = 'Compare eager and lazy unpacking of OpenFlow messages'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--duration', type=float, default=1,
+                        help='seconds each measurement lasts '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    print("%-16s %-7s %12s %12s %8s" %
+          ("message", "use", "eager msg/s", "lazy msg/s", "speedup"))
+    for (name, msg) in MESSAGES:
+        raw = msg.pack()
+        cls = type(msg)
+        for (use_name, use) in USES:
+            eager = bench(cls, raw, use, args.duration)
+            lazy = bench(of.view_class(cls), raw, use, args.duration)
+            print("%-16s %-7s %12.0f %12.0f %7.2fx" %
+                  (name, use_name, eager, lazy, lazy / eager))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Simulates a cluster of controllers reporting their load to RFMonitor and
+# kills masters one at a time. For every death it checks that the shards of
+# the dead master went to the controllers a fresh election over the same
+# state picks (elections are deterministic), and measures the recovery time:
+# from the death until every shard has a live master again.
+
+import os
+import sys
+import copy
+import time
+import random
+import socket
+import logging
+import threading
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "rfserver"))
+
+from rflib.defs import *
+import rflib.ipc.IPC as IPC
+from rflib.ipc.RFProtocol import *
+
+import rfmonitor
+from rfmonitor import RFMonitor
+
+
+class RecordingIPC(IPC.IPCMessageService):
+    """Keeps the messages RFMonitor sends instead of delivering them."""
+    def __init__(self):
+        self.sent = []
+
+    def listen(self, channel_id, factory, processor, block=True):
+        pass
+
+    def send(self, channel_id, to, msg):
+        self.sent.append((time.time(), msg))
+        return True
+
+
+class Controller:
+    """A controller that accepts test connections and sends heartbeats."""
+    def __init__(self, monitor, role, rng, heartbeat):
+        self.monitor = monitor
+        self.role = role
+        self.heartbeat = heartbeat
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.address, self.port = self.listener.getsockname()
+        self.key = "%s:%d" % (self.address, self.port)
+        self.datapaths = rng.randint(1, 64)
+        self.backlog = rng.randint(0, 100)
+        self.packet_in_rate = rng.randint(0, 1000)
+        self.alive = True
+
+    def start(self):
+        self.send_heartbeat()
+        worker = threading.Thread(target=self._heartbeat_worker)
+        worker.daemon = True
+        worker.start()
+
+    def kill(self):
+        self.alive = False
+        self.listener.close()
+
+    def send_heartbeat(self):
+        msg = ControllerRegister(ct_addr=self.address, ct_port=self.port,
+                                 ct_role=self.role,
+                                 ct_datapaths=self.datapaths,
+                                 ct_backlog=self.backlog,
+                                 ct_packet_in_rate=self.packet_in_rate)
+        self.monitor.process(self.key, RFMONITOR_ID,
+                             RFMONITOR_RFPROXY_CHANNEL, msg)
+
+    def _heartbeat_worker(self):
+        while True:
+            time.sleep(self.heartbeat)
+            if not self.alive:
+                return
+            self.send_heartbeat()
+
+
+def expected_masters(scratch, monitor, dead):
+    """Return the masters a fresh election picks once `dead` is gone."""
+    monitor.controllerLock.acquire()
+    try:
+        scratch.controllers = copy.deepcopy(monitor.controllers)
+        scratch.masters = dict(monitor.masters)
+    finally:
+        monitor.controllerLock.release()
+    scratch.controllers.pop(dead, None)
+    for (shard, master) in scratch.masters.items():
+        if master == dead:
+            del scratch.masters[shard]
+    scratch.elect_new_master()
+    return scratch.masters
+
+def format_masters(masters):
+    return ", ".join("%d=%s" % item for item in sorted(masters.items()))
+
+def run(args):
+    rng = random.Random(args.seed)
+    # Rebalancing would move shards while deaths are being measured
+    rfmonitor.REBALANCE_INTERVAL = float("inf")
+    monitor = RFMonitor(args.interval, args.jitter, args.timeout,
+                        args.shards, RecordingIPC())
+    scratch = RFMonitor(args.interval, args.jitter, args.timeout,
+                        args.shards, RecordingIPC())
+    # Both instances share the "rfmonitor" logger
+    monitor.log.removeHandler(monitor.log.handlers[-1])
+    if not args.verbose:
+        monitor.log.setLevel(logging.WARNING)
+    tester = threading.Thread(target=monitor.test_controllers)
+    tester.daemon = True
+    tester.start()
+
+    controllers = [Controller(monitor, "master" if i == 0 else "slave", rng,
+                              args.heartbeat)
+                   for i in range(args.controllers)]
+    for controller in controllers:
+        controller.start()
+    monitor.rebalance()
+    print("%d controllers, %d shards, masters: %s" %
+          (len(controllers), args.shards, format_masters(monitor.masters)))
+
+    recoveries = []
+    failures = 0
+    for i in range(min(args.deaths, len(controllers) - 1)):
+        key = rng.choice(sorted(set(monitor.masters.values())))
+        victim = [c for c in controllers if c.key == key][0]
+        expected = expected_masters(scratch, monitor, victim.key)
+
+        killed = time.time()
+        victim.kill()
+        controllers.remove(victim)
+        deadline = killed + args.interval * (1 + args.jitter) + \
+                   args.timeout + 5
+        while monitor.masters != expected and time.time() < deadline:
+            time.sleep(0.001)
+        recovery = time.time() - killed
+
+        if monitor.masters != expected:
+            failures += 1
+            print("death %d: %s, masters %s instead of %s" %
+                  (i + 1, victim.key, monitor.masters, expected))
+            continue
+        recoveries.append(recovery)
+        print("death %d: %s, recovered in %.3f s, masters: %s" %
+              (i + 1, victim.key, recovery, format_masters(expected)))
+
+    if recoveries:
+        print("recovery s: mean %.3f  max %.3f  (test interval %.2f s, "
+              "jitter %.2f, timeout %.2f s)" %
+              (sum(recoveries) / len(recoveries), max(recoveries),
+               args.interval, args.jitter, args.timeout))
+    return failures == 0
+
+if __name__ == "__main__":
+    description = 'Simulate controller deaths and measure RFMonitor ' \
+                  'master election and recovery time'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-c', '--controllers', type=int, default=8,
+                        help='number of controllers (default: %(default)s)')
+    parser.add_argument('-s', '--shards', type=int, default=16,
+                        help='number of datapath shards '
+                             '(default: %(default)s)')
+    parser.add_argument('-d', '--deaths', type=int, default=5,
+                        help='number of masters to kill '
+                             '(default: %(default)s)')
+    parser.add_argument('-i', '--interval', type=float, default=0.5,
+                        help='seconds between tests of a controller '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--jitter', type=float,
+                        default=rfmonitor.PROBE_JITTER,
+                        help='fraction of the interval by which tests are '
+                             'randomly moved (default: %(default)s)')
+    parser.add_argument('-t', '--timeout', type=float, default=0.5,
+                        help='seconds a controller has to answer a test '
+                             '(default: %(default)s)')
+    parser.add_argument('--heartbeat', type=float, default=0.2,
+                        help='seconds between controller heartbeats '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show RFMonitor log messages')
+    args = parser.parse_args()
+
+    ok = run(args)
+    # Tester and heartbeat threads never return
+    sys.stdout.flush()
+    os._exit(0 if ok else 1)
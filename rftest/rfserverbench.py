@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+# Measures how many RouteMods per second RFServer turns into flow RouteMods
+# for the datapaths. A fleet of datapaths and client VMs is simulated: their
+# ports are registered and mapped as RFProxy and RFClient would, and then a
+# stream of routes is replayed. The RouteFlow tables and IPC channels of the
+# database it uses (by default a scratch one, see --db) are cleared.
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import logging
+import argparse
+import Queue
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "rfserver"))
+
+import rflib.defs as defs
+import dispatcher
+
+IPC_MEMORY = "memory"
+# Database the benchmark uses unless told otherwise
+SCRATCH_DB_NAME = "rfserverbench"
+
+
+def host_port(address):
+    if ":" not in address:
+        address += ":27017"
+    return address
+
+def parse_args():
+    description = 'Measure RouteMod throughput and latency of RFServer ' \
+                  'with a simulated datapath fleet'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-d', '--datapaths', type=int, default=16,
+                        help='number of datapaths (default: %(default)s)')
+    parser.add_argument('-p', '--ports', type=int, default=8,
+                        help='ports per datapath (default: %(default)s)')
+    parser.add_argument('-n', '--routes', type=int, default=100000,
+                        help='number of routes to replay '
+                             '(default: %(default)s)')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='routes per second to send (default: as fast '
+                             'as possible)')
+    parser.add_argument('-b', '--backend', default=IPC_MEMORY,
+                        choices=[IPC_MEMORY, defs.IPC_MONGO_POLL,
+                                 defs.IPC_MONGO_TAIL, defs.IPC_SOCKET],
+                        help='IPC backend, "memory" measures RFServer alone '
+                             '(default: %(default)s)')
+    parser.add_argument('-t', '--workers', type=int,
+                        default=dispatcher.WORKERS,
+                        help='RFServer worker threads (default: %(default)s)')
+    parser.add_argument('-w', '--coalesce-window', type=float, default=0,
+                        help='RFServer route coalescing window in seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='seconds to wait for each phase '
+                             '(default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show RFServer log messages')
+    parser.add_argument('--mongo', default=defs.MONGO_ADDRESS,
+                        help='MongoDB address (default: %(default)s)')
+    parser.add_argument('--db', default=SCRATCH_DB_NAME,
+                        help='MongoDB database, whose RouteFlow tables and '
+                             'IPC channels are dropped (default: '
+                             '%(default)s)')
+    parser.add_argument('--drop-production', action='store_true',
+                        help='allow --mongo and --db to be the configured '
+                             'RouteFlow database')
+    args = parser.parse_args()
+    if (host_port(args.mongo) == host_port(defs.MONGO_ADDRESS) and
+            args.db == defs.MONGO_DB_NAME and not args.drop_production):
+        parser.error("%s is the RouteFlow database at %s; pass "
+                     "--drop-production to clear it" %
+                     (args.db, args.mongo))
+    return args
+
+# RouteFlow modules copy the MongoDB settings when they're imported, so
+# they are pointed at the benchmark's database first
+if __name__ == "__main__":
+    args = parse_args()
+    defs.MONGO_ADDRESS = args.mongo
+    defs.MONGO_DB_NAME = args.db
+
+from rflib.defs import *
+from rflib.ipc.MongoIPC import format_address
+from rflib.ipc.IPCServiceFactory import IPCServiceFactory
+import rflib.ipc.IPC as IPC
+from rflib.ipc.RFProtocol import *
+from rflib.ipc.RFProtocolFactory import RFProtocolFactory
+from rflib.types.Match import *
+from rflib.types.Action import *
+from rflib.types.Option import *
+
+from rfserver import RFServer
+
+
+CT_ID = 0
+FIRST_DP_ID = 0x99000000000001
+FIRST_VM_ID = 0x12A0A0A00001
+VS_ID = 0x7266767300000001
+
+
+class MemoryIPCHub:
+    """Delivers messages between MemoryIPCMessageServices in one process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def queue(self, channel_id, id_):
+        with self._lock:
+            return self._queues.setdefault((channel_id, id_), Queue.Queue())
+
+
+class MemoryIPCMessageService(IPC.IPCMessageService):
+    """An IPCMessageService that hands message objects over in memory.
+
+    It stands in for a real backend so that only RFServer itself is measured.
+    Messages are not encoded: see codecbench.py and ipcbench.py for that.
+    """
+    def __init__(self, hub, id_):
+        self._hub = hub
+        self.set_id(id_)
+
+    def listen(self, channel_id, factory, processor, block=True):
+        worker = threading.Thread(target=self._listen_worker,
+                                  args=(channel_id, processor))
+        worker.daemon = True
+        worker.start()
+        if block:
+            worker.join()
+
+    def send(self, channel_id, to, msg):
+        return self.send_many(channel_id, [(to, msg)])
+
+    def send_many(self, channel_id, messages):
+        batches = {}
+        for (to, msg) in messages:
+            batches.setdefault(to, []).append(msg)
+        for (to, batch) in batches.items():
+            self._hub.queue(channel_id, to).put((self.get_id(), batch))
+        return True
+
+    def _listen_worker(self, channel_id, processor):
+        queue = self._hub.queue(channel_id, self.get_id())
+        while True:
+            (from_, batch) = queue.get()
+            for msg in batch:
+                processor.process(from_, self.get_id(), channel_id, msg)
+
+
+class FleetProxy(IPC.IPCMessageProcessor):
+    """Plays RFProxy for every datapath, recording installed routes.
+
+    routes holds the IPv4 match value of every route that will be replayed.
+    """
+    def __init__(self, ports, routes):
+        self.ports = ports
+        self.routes = routes
+        self.mapped = 0
+        self.flow_mods = 0
+        self.installed = {}
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def process(self, from_, to, channel, msg):
+        type_ = msg.get_type()
+        with self._lock:
+            if type_ == DATA_PLANE_MAP:
+                self.mapped += 1
+                if self.mapped == self.ports:
+                    self.ready.set()
+            elif type_ == ROUTE_MOD:
+                for match in msg.get_matches():
+                    key = str(match["value"])
+                    # Datapath configuration flows aren't routes
+                    if match["type"] != RFMT_IPV4 or key not in self.routes:
+                        continue
+                    self.flow_mods += 1
+                    if key not in self.installed:
+                        self.installed[key] = time.time()
+                        if len(self.installed) == len(self.routes):
+                            self.done.set()
+        return True
+
+
+class FleetClient(IPC.IPCMessageProcessor):
+    """Plays RFClient for a VM, answering mapping requests as its ports would.
+
+    The mapping packet a port sends travels through the virtual switch, so
+    the VirtualPlaneMap is sent on behalf of RFProxy.
+    """
+    def __init__(self, proxy_ipc, vs_ports):
+        self.proxy_ipc = proxy_ipc
+        self.vs_ports = vs_ports
+
+    def process(self, from_, to, channel, msg):
+        if msg.get_type() == PORT_CONFIG and msg.get_operation_id() == 0:
+            vs_port = self.vs_ports[(msg.get_vm_id(), msg.get_vm_port())]
+            self.proxy_ipc.send(RFSERVER_RFPROXY_CHANNEL, RFSERVER_ID,
+                                VirtualPlaneMap(vm_id=msg.get_vm_id(),
+                                                vm_port=msg.get_vm_port(),
+                                                vs_id=VS_ID,
+                                                vs_port=vs_port))
+        return True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def prefix(i):
+    return "%d.%d.%d.0" % (1 + (i >> 16) % 223, i >> 8 & 0xFF, i & 0xFF)
+
+def hwaddress(vm, port):
+    return "12:a0:%02x:%02x:%02x:%02x" % (vm >> 8 & 0xFF, vm & 0xFF,
+                                          port >> 8 & 0xFF, port & 0xFF)
+
+def reset_database(backend):
+    connection = pymongo.Connection(*format_address(MONGO_ADDRESS))
+    db = connection[MONGO_DB_NAME]
+    names = [RFTABLE_NAME, RFCONFIG_NAME, RFISL_NAME, RFISLCONF_NAME]
+    if backend != IPC_MEMORY:
+        names += [RFCLIENT_RFSERVER_CHANNEL, RFSERVER_RFPROXY_CHANNEL]
+    for name in names:
+        db.drop_collection(name)
+
+def write_config(datapaths, ports):
+    (fd, path) = tempfile.mkstemp(prefix="rfserverbench-", suffix=".csv")
+    configfile = os.fdopen(fd, "w")
+    configfile.write("vm_id,vm_port,ct_id,dp_id,dp_port\n")
+    for i in range(datapaths):
+        for port in range(1, ports + 1):
+            configfile.write("%X,%d,%d,%X,%d\n" % (FIRST_VM_ID + i, port,
+                                                   CT_ID, FIRST_DP_ID + i,
+                                                   port))
+    configfile.close()
+    return path
+
+def run(args):
+    hub = MemoryIPCHub()
+    def make_service(id_):
+        if args.backend == IPC_MEMORY:
+            return MemoryIPCMessageService(hub, id_)
+        return IPCServiceFactory.make(id_, threading.Thread, time.sleep,
+                                      args.backend)
+
+    reset_database(args.backend)
+    configfile = write_config(args.datapaths, args.ports)
+    try:
+        server = RFServer(configfile, None, args.coalesce_window,
+                          args.workers, make_service(RFSERVER_ID))
+    finally:
+        os.unlink(configfile)
+    if not args.verbose:
+        server.log.setLevel(logging.WARNING)
+
+    routes = []
+    for i in range(args.routes):
+        rm = RouteMod(RMT_ADD, FIRST_VM_ID + i % args.datapaths)
+        rm.add_match(Match.IPV4(prefix(i), "255.255.255.0"))
+        rm.add_action(Action.OUTPUT(1 + i / args.datapaths % args.ports))
+        rm.add_option(Option.PRIORITY(PRIORITY_HIGH))
+        key = str(Match.IPV4(prefix(i), "255.255.255.0").to_dict()["value"])
+        routes.append((key, rm))
+
+    n_ports = args.datapaths * args.ports
+    proxy = FleetProxy(n_ports, set(key for (key, rm) in routes))
+    proxy_ipc = make_service(str(CT_ID))
+    proxy_ipc.listen(RFSERVER_RFPROXY_CHANNEL, RFProtocolFactory(), proxy,
+                     False)
+    vs_ports = {}
+    clients = []
+    for i in range(args.datapaths):
+        vm_id = FIRST_VM_ID + i
+        for port in range(1, args.ports + 1):
+            vs_ports[(vm_id, port)] = len(vs_ports) + 1
+        client_ipc = make_service(str(vm_id))
+        client_ipc.listen(RFCLIENT_RFSERVER_CHANNEL, RFProtocolFactory(),
+                          FleetClient(proxy_ipc, vs_ports), False)
+        clients.append(client_ipc)
+
+    # Bring the fleet up
+    start = time.time()
+    for i in range(args.datapaths):
+        for port in range(1, args.ports + 1):
+            proxy_ipc.send(RFSERVER_RFPROXY_CHANNEL, RFSERVER_ID,
+                           DatapathPortRegister(ct_id=CT_ID,
+                                                dp_id=FIRST_DP_ID + i,
+                                                dp_port=port))
+            clients[i].send(RFCLIENT_RFSERVER_CHANNEL, RFSERVER_ID,
+                            PortRegister(vm_id=FIRST_VM_ID + i, vm_port=port,
+                                         hwaddress=hwaddress(i, port)))
+    if not proxy.ready.wait(args.timeout):
+        print("Only %d of %d ports were mapped" % (proxy.mapped, n_ports))
+        return
+    print("Mapped %d datapaths with %d ports each in %.2f s" %
+          (args.datapaths, args.ports, time.time() - start))
+
+    # Replay the routes
+    sent = {}
+    start = time.time()
+    for (i, (key, rm)) in enumerate(routes):
+        sent[key] = time.time()
+        clients[i % args.datapaths].send(RFCLIENT_RFSERVER_CHANNEL,
+                                         RFSERVER_ID, rm)
+        if args.rate:
+            time.sleep(1.0 / args.rate)
+    proxy.done.wait(args.timeout)
+    elapsed = max(proxy.installed.values() or [start]) - start
+
+    latencies = [(proxy.installed[key] - sent[key]) * 1000
+                 for key in proxy.installed]
+    if not latencies:
+        print("No routes were installed")
+        return
+    print("%d of %d routes installed with %d flow RouteMods in %.2f s" %
+          (len(latencies), args.routes, proxy.flow_mods, elapsed))
+    print("%.1f routes/s, %.1f flow RouteMods/s" %
+          (len(latencies) / elapsed, proxy.flow_mods / elapsed))
+    print("latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" %
+          (percentile(latencies, 50), percentile(latencies, 90),
+           percentile(latencies, 99), max(latencies)))
+
+if __name__ == "__main__":
+    run(args)
+    # Listener threads never return
+    sys.stdout.flush()
+    os._exit(0)
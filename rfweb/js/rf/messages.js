@@ -37,6 +37,9 @@ rowtemplate += "</td>"
 rowtemplate += "</tr>"
 rowtemplate += "</tr>"
 
+var feed = undefined; // Live messages from /events
+var live_count = 0; // Messages received from feed
+
 cbtemplate = "<input type=\"checkbox\" name=\"{type}\" {checked} value=\"{value}\">{name}<br />"
 
 function process_message(i, channel, msg) {
@@ -79,6 +82,30 @@ function update_table(channel) {
     });
 }
 
+function show_live_message(msg) {
+    for (var i in channels) {
+        var channel = channels[i];
+        if (channel.name != msg.channel || !(msg.type in channel.messages))
+            continue;
+        var checkbox = $('input[name=' + channel.html_id + '_type][value=' + msg.type + ']');
+        if (!checkbox.is(':checked'))
+            return;
+        var table = $("#" + channel.html_id);
+        process_message("live_" + live_count, channel, msg);
+        msg.style = live_count % 2;
+        live_count++;
+        table.html(apply_template(rowtemplate, msg) + table.html());
+    }
+}
+
+function open_feed() {
+    var source = new EventSource("/events?views=messages");
+    source.addEventListener("message", function(e) {
+        show_live_message(JSON.parse(e.data));
+    }, false);
+    return source;
+}
+
 function update() {
     for (var i in channels)
         update_table(channels[i]);
@@ -123,7 +150,13 @@ function start() {
 function messages_init() {
 	start();
 	update();
+    if (window.EventSource)
+        feed = open_feed();
 }
 
 function messages_stop() {
+    if (feed != undefined) {
+        feed.close();
+        feed = undefined;
+    }
 }
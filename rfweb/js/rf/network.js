@@ -18,6 +18,10 @@ var rgraph = undefined; // Network graph
 var previous_pos = {}; // Keep the positions when updating
 var selected_node = undefined; // Selected node id
 var interval_id; // Update timer
+var feed = undefined; // Live topology updates from /events
+var topology_nodes = {}; // Topology elements by id, kept up to date by feed
+var updates_paused = false; // Set while the graph is being moved
+var redraw_timeout = undefined; // Pending redraw after topology updates
 
 // From: http://thejit.org/static/v20/Jit/Examples/RGraph/example1.js
 (function() {
@@ -175,68 +179,39 @@ function prettify_match(match) {
 }
 
 function prettify_actions(actions) {
-    function get_params_list(params) {
-        var params_list = [];
-        var elements = params.split(", ");
-        for (var i in elements)
-            params_list.push(elements[i].split(": "));
-        return params_list;
-    }
-
     var string = "";
-    var re = /(\w*)\[([^\]]*)\]/;
     for (var i in actions) {
-        var result = actions[i].match(re);
-        if (result == null || result == undefined || result.length < 3) {
-            string += actions[i] + ", ";
-            continue;
-        }
-
-        var action = result[1];
-        var params = result[2];
+        var action = actions[i];
+        var name = action.action.replace("ofp_action_", "");
+        var params = "";
 
         // ofp_action_output
-        if (action == "ofp_action_output") {
-            action = "OUTPUT";
-            var params_list = get_params_list(params);
-            params = ""
-            for (var i in params_list) {
-                var param = params_list[i][0];
-                var value = params_list[i][1];
-                // port
-                if (param == "port") {
-                    if (parseInt(value) == 0xfffd)
-                        port = "CONTROLLER";
-                    params += "port: " + value + ", ";
-                }
-            }
+        if (action.action == "ofp_action_output") {
+            name = "OUTPUT";
+            if (action.port == 0xfffd)
+                params = "port: CONTROLLER";
+            else
+                params = "port: " + action.port;
         }
 
         // ofp_action_dl_addr
-        else if (action == "ofp_action_dl_addr") {
-            action = "";
-            var params_list = get_params_list(params);
-            params = ""
-            for (var i in params_list) {
-                var param = params_list[i][0];
-                var value = params_list[i][1];
-                // type
-                if (param == "type") {
-                    type = parseInt(value);
-                    if (type == 4)
-                        action = "SET_DL_SRC";
-                    else if (type == 5)
-                        action = "SET_DL_DST";
-                }
-                // dl_addr
-                else if (param == "dl_addr") {
-                    params += param + ": " + value + ", ";
-                }
+        else if (action.action == "ofp_action_dl_addr") {
+            if (action.type == 4)
+                name = "SET_DL_SRC";
+            else if (action.type == 5)
+                name = "SET_DL_DST";
+            params = "dl_addr: " + action.dl_addr;
+        }
+
+        else {
+            for (var param in action) {
+                if (param != "action")
+                    params += param + ": " + action[param] + ", ";
             }
         }
 
         // append action
-        string += action.toUpperCase() + "(" + rstrip(params, ", ") + ")" + ", ";
+        string += name.toUpperCase() + "(" + rstrip(params, ", ") + ")" + ", ";
     }
     if (string == "")
         string = "DROP";
@@ -244,13 +219,57 @@ function prettify_actions(actions) {
 }
 
 function network_start_updating() {
-    interval_id = setInterval("network_update()", 5000);
+    updates_paused = false;
+    clearInterval(interval_id);
+    if (window.EventSource) {
+        // Topology changes are pushed, only switch stats are polled
+        if (feed == undefined)
+            feed = network_open_feed();
+        else
+            network_schedule_redraw();
+        interval_id = setInterval("network_update_selected()", 5000);
+    }
+    else {
+        interval_id = setInterval("network_update()", 5000);
+    }
 }
 
 function network_stop_updating() {
+    updates_paused = true;
     clearInterval(interval_id);
 }
 
+function network_open_feed() {
+    var source = new EventSource("/events?views=topology");
+    source.addEventListener("topology", function(e) {
+        var update = JSON.parse(e.data);
+        if (update.op == "reset") {
+            topology_nodes = {};
+            for (var i in update.items)
+                topology_nodes[update.items[i].id] = update.items[i];
+        }
+        else if (update.op == "set")
+            topology_nodes[update.item.id] = update.item;
+        else if (update.op == "remove")
+            delete topology_nodes[update.item.id];
+        network_schedule_redraw();
+    }, false);
+    return source;
+}
+
+function network_schedule_redraw() {
+    // Draw once for a burst of updates
+    if (updates_paused || redraw_timeout != undefined)
+        return;
+    redraw_timeout = setTimeout(function() {
+        redraw_timeout = undefined;
+        var data = [];
+        for (var id in topology_nodes)
+            data.push($.extend(true, {}, topology_nodes[id]));
+        network_draw(data);
+    }, 100);
+}
+
 function build() {
     rgraph = new $jit.RGraph({
       'injectInto': 'infovis',
@@ -345,77 +364,88 @@ function node_update(id) {
         });
 }
 
+function network_update_selected() {
+    if (selected_node != undefined) {
+        node_update(selected_node);
+    }
+}
+
 function network_update() {
     $.getJSON("/topology",
         function (data) {
             if (data == null || data == undefined)
                 return;
+            network_draw(data);
+            network_update_selected();
+    });
+}
 
-            // Pre-process data
-            nodes = [];
-            var center = 0;
-            for (var i in data) {
-                var node = data[i]
-                node["name"] = node["id"];
-                // Mark rfproxy as the central node (used when creating the graph)
-                if (node["name"] == "rfproxy")
-                    center = i;
-
-                if (node["type"] == "rfserver")
-                    node.name = "RFServer"
-                else if (node["type"] == "rfproxy")
-                    node.name = "RFProxy"
-                else if (is_rfvs(node.id))
-                    node.name = "RouteFlow virtual switch"
-
-                node["data"] = {};
-                if (node["type"] == "switch")
-                    node["data"]["$height"] = ICON_SIZE/5 + SPACING + LABEL_SIZE;
-                node["data"]["$type"] = node["type"];
-                delete node["type"];
-                node["adjacencies"] = node["links"];
-                delete node["links"];
-                nodes.push(node);
-            }
-
-            // If the graph hasn't been built yet, build it
-            if (rgraph == undefined) {
-                build();
-                rgraph.loadJSON(nodes, center);
-                rgraph.plot();
-                rgraph.refresh();
-                rgraph.canvas.scale(0.7, 0.7);
-                return;
-            }
+function network_draw(data) {
+    // Pre-process data
+    nodes = [];
+    var center = 0;
+    for (var i in data) {
+        var node = data[i]
+        node["name"] = node["id"];
+        // Mark rfproxy as the central node (used when creating the graph)
+        if (node["name"] == "rfproxy")
+            center = i;
+
+        if (node["type"] == "rfserver")
+            node.name = "RFServer"
+        else if (node["type"] == "rfproxy")
+            node.name = "RFProxy"
+        else if (is_rfvs(node.id))
+            node.name = "RouteFlow virtual switch"
+
+        node["data"] = {};
+        if (node["type"] == "switch")
+            node["data"]["$height"] = ICON_SIZE/5 + SPACING + LABEL_SIZE;
+        node["data"]["$type"] = node["type"];
+        delete node["type"];
+        node["adjacencies"] = node["links"];
+        delete node["links"];
+        nodes.push(node);
+    }
 
-            // Save old node positions
-            rgraph.graph.eachNode(function(node) {
-                previous_pos[node.id] = node.getPos();
-            });
+    // If the graph hasn't been built yet, build it
+    if (rgraph == undefined) {
+        build();
+        rgraph.loadJSON(nodes, center);
+        rgraph.plot();
+        rgraph.refresh();
+        rgraph.canvas.scale(0.7, 0.7);
+        return;
+    }
 
-            // Update
-            rgraph.loadJSON(nodes);
-            rgraph.refresh();
+    // Save old node positions
+    rgraph.graph.eachNode(function(node) {
+        previous_pos[node.id] = node.getPos();
+    });
 
-            // Restore old positions
-            rgraph.graph.eachNode(function(node) {
-                if (node.id in previous_pos) {
-                    node.setPos(previous_pos[node.id]);
-                }
-            });
-            rgraph.plot();
+    // Update
+    rgraph.loadJSON(nodes);
+    rgraph.refresh();
 
-            if (selected_node != undefined) {
-                node_update(selected_node);
-            }
+    // Restore old positions
+    rgraph.graph.eachNode(function(node) {
+        if (node.id in previous_pos) {
+            node.setPos(previous_pos[node.id]);
+        }
     });
+    rgraph.plot();
 }
 
 function network_init() {
-    network_update();
+    if (!window.EventSource)
+        network_update();
     network_start_updating();
 }
 
 function network_stop() {
 	network_stop_updating();
+    if (feed != undefined) {
+        feed.close();
+        feed = undefined;
+    }
 }
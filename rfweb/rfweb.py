@@ -13,8 +13,14 @@ import urlparse
 from wsgiref.util import shift_path_info
 import pymongo
 import bson.json_util
+from bson.objectid import ObjectId
 import os
 import os.path
+import time
+import datetime
+import threading
+import zlib
+import Queue
 
 import sys
 sys.path.append("../")
@@ -22,6 +28,7 @@ sys.path.append("../")
 import rflib.defs as defs
 import rflib.ipc.MongoIPC as MongoIPC
 from rflib.ipc.RFProtocolFactory import RFProtocolFactory
+from rflib.ipc.MongoClientFactory import MongoClientFactory
 
  
 def usage():
@@ -37,6 +44,7 @@ JS = 4
 GIF = 5
 PNG = 6
 JPEG = 7
+EVENTS = 8
 
 CONTENT_TYPES = {
 PLAIN: "text/plain",
@@ -47,6 +55,7 @@ JS: "text/javascript",
 GIF: "image/gif",
 PNG: "image/png",
 JPEG: "image/jpeg",
+EVENTS: "text/event-stream",
 }
 
 exts = {
@@ -76,7 +85,7 @@ def format_id(value):
 # An alternative would be changing the auto-generated IPC message code to 
 # generate prettier messages itself, but it's a longer task.
 factory = RFProtocolFactory()
-def prettify_message(envelope):
+def prettify_message(envelope, msg=None):
     result = {}
 
     result[MongoIPC.FROM_FIELD] = format_id(envelope[MongoIPC.FROM_FIELD])    
@@ -84,67 +93,262 @@ def prettify_message(envelope):
     result[MongoIPC.READ_FIELD] = envelope[MongoIPC.READ_FIELD]
     result[MongoIPC.TYPE_FIELD] = envelope[MongoIPC.TYPE_FIELD]
     
-    msg = MongoIPC.take_from_envelope(envelope, factory)
+    if msg is None:
+        msg = MongoIPC.take_from_envelope(envelope, factory)
     result[MongoIPC.CONTENT_FIELD] = str(msg)
 
     return result
     
+# Views of the collections the dashboard polls are cached in memory and
+# refreshed at most every CACHE_TTL seconds, however many clients poll them.
+# Every change found in a refresh bumps the version of the view, which is
+# part of its ETag, so clients that already have it get a 304 instead.
+CACHE_TTL = 1
+# Document views re-read their whole collection, since its documents are
+# updated in place and have no version to fetch changes from, so they are
+# refreshed less often
+DOCUMENTS_CACHE_TTL = 5
+# Messages kept in the view of each channel
+MAX_CACHED_MESSAGES = 1000
+# Messages are fetched from an _id high-water mark moved back by this many
+# seconds, since _ids made by other processes aren't inserted in order
+HIGH_WATER_MARGIN = 2
+
+# Identifies this process in ETags, since versions restart at 0
+START_TOKEN = "%x" % int(time.time())
+
+class CachedView:
+    """A view of a collection kept in memory.
+
+    items is a list of (cursor, item) in the order they are served, and
+    version is incremented when refresh() finds the collection changed.
+    """
+    ttl = CACHE_TTL
+
+    def __init__(self):
+        self.items = []
+        self.index = {}
+        self.version = 0
+        self.refreshed = 0
+        self.lock = threading.Lock()
+
+    def get(self, conn):
+        with self.lock:
+            if time.time() - self.refreshed >= self.ttl:
+                self.refreshed = time.time()
+                items = self.refresh(conn)
+                if items is not None:
+                    self.items = items
+                    self.index = dict((cursor, i) for (i, (cursor, item))
+                                      in enumerate(items))
+                    self.version += 1
+            return self
+
+    def refresh(self, conn):
+        """Return the new items, or None if they haven't changed."""
+        raise NotImplementedError
+
+    def etag(self, env):
+        query = zlib.crc32(env["QUERY_STRING"]) & 0xffffffff
+        return '"%s-%d-%08x"' % (START_TOKEN, self.version, query)
+
+    def page(self, cursor=None, limit=None, accept=None):
+        """Return the items after `cursor` (None if it isn't known) and the
+        cursor of the next page (None if this is the last one)."""
+        start = 0
+        if cursor is not None:
+            if cursor not in self.index:
+                return (None, None)
+            start = self.index[cursor] + 1
+        result = []
+        last = cursor
+        for (item_cursor, item) in self.items[start:]:
+            if accept is not None and not accept(item):
+                continue
+            if limit is not None and len(result) >= limit:
+                return (result, last)
+            result.append(item)
+            last = item_cursor
+        return (result, None)
+
+class MessagesView(CachedView):
+    def __init__(self, channel):
+        CachedView.__init__(self)
+        self.channel = channel
+        self.messages = {}
+        # Datapath each message refers to, for Feed filters
+        self.dp_ids = {}
+        # Newest message dropped from the cache, older ones are not shown
+        self.low_water = None
+
+    def refresh(self, conn):
+        table = conn.db[self.channel]
+        changed = False
+
+        query = {}
+        if self.messages:
+            high_water = max(self.messages)
+            since = high_water.generation_time - \
+                    datetime.timedelta(seconds=HIGH_WATER_MARGIN)
+            query["_id"] = {"$gt": ObjectId.from_datetime(since)}
+        for envelope in table.find(query):
+            if self.low_water is not None and \
+               envelope["_id"] <= self.low_water:
+                continue
+            if envelope["_id"] not in self.messages:
+                msg = MongoIPC.take_from_envelope(envelope, factory)
+                self.messages[envelope["_id"]] = prettify_message(envelope, msg)
+                if hasattr(msg, "get_dp_id"):
+                    self.dp_ids[envelope["_id"]] = msg.get_dp_id()
+                changed = True
+
+        # Envelopes are marked as read after they are inserted
+        unread = [id_ for (id_, msg) in self.messages.items()
+                  if not msg[MongoIPC.READ_FIELD]]
+        if unread:
+            query = {"_id": {"$in": unread}, MongoIPC.READ_FIELD: True}
+            for envelope in table.find(query, fields=["_id"]):
+                self.messages[envelope["_id"]][MongoIPC.READ_FIELD] = True
+                changed = True
+
+        if not changed:
+            return None
+        ids = sorted(self.messages, reverse=True)
+        for id_ in ids[MAX_CACHED_MESSAGES:]:
+            del self.messages[id_]
+            self.dp_ids.pop(id_, None)
+        if len(ids) > MAX_CACHED_MESSAGES:
+            self.low_water = ids[MAX_CACHED_MESSAGES]
+        return [(str(id_), self.messages[id_])
+                for id_ in ids[:MAX_CACHED_MESSAGES]]
+
+class DocumentsView(CachedView):
+    """A view of a whole collection, rebuilt when any document changes."""
+    ttl = DOCUMENTS_CACHE_TTL
+
+    def __init__(self, name, convert, sort_key, fields=None):
+        CachedView.__init__(self)
+        self.name = name
+        self.convert = convert
+        self.sort_key = sort_key
+        self.fields = fields
+
+    def refresh(self, conn):
+        items = [self.convert(doc) for doc in conn.db[self.name].find(fields=self.fields)]
+        items.sort(key=self.sort_key)
+        items = [(self.cursor(item), item) for item in items]
+        if items == self.items:
+            return None
+        return items
+
+    def cursor(self, item):
+        return ":".join(str(value) for value in self.sort_key(item))
+
+message_views = {}
+
+def not_modified(env, etag):
+    return env.get("HTTP_IF_NONE_MATCH") == etag
+
+def serve_view(env, view, limit=None, accept=None):
+    etag = view.etag(env)
+    if not_modified(env, etag):
+        return (304, "", JSON, etag, None)
+
+    request = parse_qs(env["QUERY_STRING"])
+    if "limit" in request:
+        try:
+            limit = int(request["limit"][0])
+        except ValueError:
+            return (404, "Invalid limit", JSON, None, None)
+    cursor = request.get("cursor", [None])[0]
+    items, next_cursor = view.page(cursor, limit, accept)
+    if items is None:
+        return (404, "Invalid cursor", JSON, None, None)
+    return (200, json.dumps(items, default=bson.json_util.default), JSON, etag, next_cursor)
+
 def messages(env, conn):
     channel = shift_path_info(env)
     if channel != None and channel != "":
-        # TODO: escape parameters
-        messages = []
-        try:
-            table = getattr(conn.db, channel);
-        except:
-            return (404, "Invalid channel", JSON)
+        if channel not in message_views:
+            if channel not in conn.db.collection_names():
+                return (404, "Invalid channel", JSON, None, None)
+            message_views.setdefault(channel, MessagesView(channel))
+        view = message_views[channel].get(conn)
 
         request = parse_qs(env["QUERY_STRING"])
-        limit = 50
-        query = {}
-        if "limit" in request:
-            limit = request["limit"][0]
-            
+        accept = None
         if "types" in request:
             types = request["types"][0]
             if types == "":
-                return (200, json.dumps({}, default=bson.json_util.default), JSON)
-            query["$or"] = []
+                return (200, json.dumps({}, default=bson.json_util.default), JSON, None, None)
+            values = set()
             for type_ in types.split(","):
                 try:
-                    value = int(type_)
+                    values.add(int(type_))
                 except:
                     continue
-                query["$or"].append({"type": value})
+            accept = lambda msg: msg[MongoIPC.TYPE_FIELD] in values
 
-        for envelope in table.find(query, limit=limit, sort=[("$natural", pymongo.DESCENDING)]):
-            messages.append(prettify_message(envelope))
+        return serve_view(env, view, 50, accept)
 
-        return (200, json.dumps(messages, default=bson.json_util.default), JSON)
+    else:
+        return (404, "Channel not specified", JSON, None, None)
 
 
-    else:
-        return (404, "Channel not specified", JSON)
+# Rates are written by rfstats (see pox/ext/rfcounters.py) to a collection
+# with documents per switch, resolution and write, each holding the
+# [time, rate...] points of some of the flows and ports since the previous
+# write
+def switch_rates(conn, id_, resolution, since):
+    result = {"columns": {}}
+    query = {"dp_id": id_, "resolution": resolution, "time": {"$gt": since}}
+    for doc in conn.db.rfcounters.find(query, sort=[("time", pymongo.ASCENDING)]):
+        for (kind, columns) in doc["columns"].items():
+            result["columns"][kind] = columns
+            series = result.setdefault(kind, {})
+            for (key, points) in doc[kind].items():
+                series.setdefault(key, []).extend(p for p in points if p[0] > since)
+    return result
 
+def last_rates(conn, id_):
+    result = {}
+    query = {"dp_id": id_, "resolution": 0}
+    for last in conn.db.rfcounters.find(query, limit=1, sort=[("time", pymongo.DESCENDING)]):
+        query["time"] = last["time"]
+        for doc in conn.db.rfcounters.find(query):
+            for (kind, columns) in doc["columns"].items():
+                rates = result.setdefault(kind, {})
+                for (key, points) in doc[kind].items():
+                    rates[key] = dict(zip(columns, points[-1]))
+    return result
 
 def switch(env, conn):
     id_ = shift_path_info(env)
     if id_ != None and id_ != "":
+        request = parse_qs(env["QUERY_STRING"])
+        if "window" in request:
+            try:
+                window = float(request["window"][0])
+                resolution = int(request.get("resolution", [0])[0])
+            except ValueError:
+                return (404, "Invalid window or resolution", JSON)
+            rates = switch_rates(conn, id_, resolution, time.time() - window)
+            return (200, json.dumps(rates, default=bson.json_util.default), JSON)
+
         switch = conn.db.rfstats.find_one(id_)
-        return (200, json.dumps(switch["data"], default=bson.json_util.default), JSON)
+        if switch is None:
+            return (404, "Switch not found", JSON)
+        data = switch["data"]
+        data["rates"] = last_rates(conn, id_)
+        return (200, json.dumps(data, default=bson.json_util.default), JSON)
     else:
         return (404, "Switch not specified", JSON)
 
-def topology(env, conn):
-    elements_list = []
-    elements = conn.db.rfstats.find()
-    for element in elements:
-        element["id"] = element["_id"]
-        del element["_id"]
-        del element["data"]
-        elements_list.append(element)
-    return (200, json.dumps(elements_list, default=bson.json_util.default), JSON)
-    
+def prettify_topology_element(element):
+    element["id"] = element["_id"]
+    del element["_id"]
+    return element
+
 def pretiffy_rftable_entry(entry):
     result = {}
         
@@ -158,12 +362,194 @@ def pretiffy_rftable_entry(entry):
     result["ct_id"] = format_id(entry["ct_id"])
     
     return result
+
+topology_view = DocumentsView("rfstats", prettify_topology_element,
+                              lambda element: (element["id"],),
+                              fields={"data": False})
+rftable_view = DocumentsView("rftable", pretiffy_rftable_entry,
+                             lambda entry: (entry["vm_id"], entry["vm_port"]))
+
+# Live updates are streamed as server-sent events. A single reader thread
+# refreshes the cached views every FEED_INTERVAL seconds and publishes what
+# changed to every subscriber whose filters accept it.
+FEED_INTERVAL = 0.5
+# Events buffered for each subscriber. A subscriber that falls this far
+# behind is dropped, and its browser reconnects.
+MAX_SUBSCRIBER_EVENTS = 1000
+# Seconds between comments sent to keep idle streams open
+KEEPALIVE_INTERVAL = 15
+FEED_CHANNELS = [defs.RFCLIENT_RFSERVER_CHANNEL, defs.RFSERVER_RFPROXY_CHANNEL,
+                 defs.RFMONITOR_RFPROXY_CHANNEL]
+# Field of the items of each document view holding the datapath they refer to
+DP_ID_FIELDS = {"rftable": "dp_id", "topology": "id"}
+
+def parse_id(value):
+    try:
+        return int(str(value), 0)
+    except ValueError:
+        return None
+
+def format_event(name, data):
+    return "event: {0}\ndata: {1}\n\n".format(name, json.dumps(data, default=bson.json_util.default))
+
+class Subscriber:
+    def __init__(self, views, channels=None, types=None, dp_id=None):
+        self.views = views
+        self.channels = channels
+        self.types = types
+        self.dp_id = dp_id
+        self.events = Queue.Queue(MAX_SUBSCRIBER_EVENTS)
+        self.dropped = False
+
+    def accepts(self, view, channel, type_, dp_id):
+        if view not in self.views:
+            return False
+        if self.channels is not None and channel is not None and \
+           channel not in self.channels:
+            return False
+        if self.types is not None and type_ is not None and \
+           type_ not in self.types:
+            return False
+        if self.dp_id is not None and dp_id != self.dp_id:
+            return False
+        return True
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except Queue.Full:
+            self.dropped = True
+
+class Feed:
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.reader = None
+        # Last published state of each view
+        self.seen = {}
+        self.documents = {"rftable": {}, "topology": {}}
+
+    def subscribe(self, subscriber, conn):
+        with self.lock:
+            if self.reader is None:
+                self.publish(conn)
+                self.reader = threading.Thread(target=self._read, args=(conn,))
+                self.reader.daemon = True
+                self.reader.start()
+            # Start with a snapshot, so the deltas that follow apply to it
+            for (view, documents) in self.documents.items():
+                field = DP_ID_FIELDS[view]
+                items = [item for item in documents.values()
+                         if subscriber.accepts(view, None, None,
+                                               parse_id(item[field]))]
+                if view in subscriber.views:
+                    subscriber.put(format_event(view, {"op": "reset",
+                                                       "items": items}))
+            self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _read(self, conn):
+        while True:
+            time.sleep(FEED_INTERVAL)
+            with self.lock:
+                # Stop with the last subscriber, the next one starts a reader
+                if not self.subscribers:
+                    self.reader = None
+                    return
+                try:
+                    self.publish(conn)
+                except Exception:
+                    # The database may be unavailable, try again later
+                    pass
+
+    def publish(self, conn):
+        events = []
+        for channel in FEED_CHANNELS:
+            if channel not in message_views:
+                if channel not in conn.db.collection_names():
+                    continue
+                message_views.setdefault(channel, MessagesView(channel))
+            view = message_views[channel].get(conn)
+            seen = self.seen.get(channel)
+            self.seen[channel] = set(view.index)
+            # Nothing is published for the messages found before the first
+            # subscriber
+            if seen is None:
+                continue
+            for (cursor, msg) in reversed(view.items):
+                if cursor not in seen:
+                    data = dict(msg, channel=channel)
+                    events.append(("messages", channel, msg[MongoIPC.TYPE_FIELD],
+                                   view.dp_ids.get(ObjectId(cursor)),
+                                   format_event("message", data)))
+
+        for (name, view) in (("rftable", rftable_view),
+                             ("topology", topology_view)):
+            id_field = DP_ID_FIELDS[name]
+            view.get(conn)
+            old = self.documents[name]
+            new = dict(view.items)
+            self.documents[name] = new
+            for (cursor, item) in new.items():
+                if old.get(cursor) != item:
+                    events.append((name, None, None, parse_id(item[id_field]),
+                                   format_event(name, {"op": "set", "item": item})))
+            for (cursor, item) in old.items():
+                if cursor not in new:
+                    events.append((name, None, None, parse_id(item[id_field]),
+                                   format_event(name, {"op": "remove", "item": item})))
+
+        for subscriber in list(self.subscribers):
+            for (view, channel, type_, dp_id, event) in events:
+                if subscriber.accepts(view, channel, type_, dp_id):
+                    subscriber.put(event)
+            if subscriber.dropped:
+                self.subscribers.discard(subscriber)
+
+feed = Feed()
+
+def events(env, conn):
+    request = parse_qs(env["QUERY_STRING"])
+    def values(name, convert=str):
+        if name not in request:
+            return None
+        result = set()
+        for value in request[name][0].split(","):
+            try:
+                result.add(convert(value))
+            except ValueError:
+                continue
+        return result
+
+    views = values("views") or set(["messages", "rftable", "topology"])
+    dp_id = None
+    if "dp_id" in request:
+        dp_id = parse_id(request["dp_id"][0])
+    subscriber = Subscriber(views, values("channels"), values("types", int),
+                            dp_id)
+    feed.subscribe(subscriber, conn)
+
+    def stream():
+        try:
+            # Browsers reconnect after this many milliseconds
+            yield "retry: 5000\n\n"
+            while not subscriber.dropped:
+                try:
+                    yield subscriber.events.get(timeout=KEEPALIVE_INTERVAL)
+                except Queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            feed.unsubscribe(subscriber)
+    return stream()
+
+def topology(env, conn):
+    return serve_view(env, topology_view.get(conn))
     
 def rftable(env, conn):
-    entries = []
-    for doc in conn.db.rftable.find():
-        entries.append(pretiffy_rftable_entry(doc))
-    return (200, json.dumps(entries, default=bson.json_util.default), JSON)
+    return serve_view(env, rftable_view.get(conn))
 
 
 def application(env, start_response):
@@ -178,22 +564,27 @@ def application(env, start_response):
     if db_conn is None:
         try:
             # TODO: use defs.py
-            db_conn = pymongo.Connection("localhost", 27017)
+            db_conn = MongoClientFactory.get("localhost:27017")
         except:
             db_conn = None
     
     status = 404
     rbody = ""
     ctype = PLAIN
+    result = None
 
     if (path == "rftable"):
-        status, rbody, ctype = rftable(env, db_conn)
+        result = rftable(env, db_conn)
     elif (path == "topology"):
-        status, rbody, ctype = topology(env, db_conn)        
+        result = topology(env, db_conn)
     elif (path == "switch"):
         status, rbody, ctype = switch(env, db_conn)
     elif (path == "messages"):
-        status, rbody, ctype = messages(env, db_conn)
+        result = messages(env, db_conn)
+    elif (path == "events"):
+        start_response("200 OK", [("Content-Type", CONTENT_TYPES[EVENTS]),
+                                  ("Cache-Control", "no-cache")])
+        return events(env, db_conn)
     else:
         path = os.path.join(os.getcwd(), path + env["PATH_INFO"])
         if os.path.exists(path) and os.path.isfile(path):
@@ -207,19 +598,38 @@ def application(env, start_response):
             rbody = "JSON requests:\n" \
                     "GET /rftable: RouteFlow table\n" \
                     "GET /topology: network topology\n" \
-                    "GET /switch/[id]: stats and flows for switch [id]\n" \
+                    "GET /switch/[id]: stats, flows and last rates for switch [id]\n" \
+                    "GET /switch/[id]?window=[s]&resolution=[s]: flow and port rates for switch [id]\n" \
                     "GET /messages/[channel]: messages in channel [channel]\n" \
+                    "GET /events?views=[messages,rftable,topology]&channels=[c,...]&types=[t,...]&dp_id=[id]:\n" \
+                    "    live updates as server-sent events\n" \
+                    "\n" \
+                    "/rftable, /topology and /messages accept limit=[n] and\n" \
+                    "cursor=[X-Next-Cursor of the previous page], and answer\n" \
+                    "If-None-Match with 304 Not Modified.\n" \
                     "\n" \
                     "Pages:\n" \
                     "GET /index.html: main page\n"
 
-    if ctype == JSON and callback is not None:
+    headers = []
+    if result is not None:
+        status, rbody, ctype, etag, next_cursor = result
+        if etag is not None:
+            # Clients revalidate instead of using a stale copy
+            headers.append(("ETag", etag))
+            headers.append(("Cache-Control", "no-cache"))
+        if next_cursor is not None:
+            headers.append(("X-Next-Cursor", next_cursor))
+
+    if ctype == JSON and callback is not None and status == 200:
         rbody = "{0}({1})".format(callback, rbody)
 
     if (status == 404):
         start_response("404 Not Found", [("Content-Type", CONTENT_TYPES[ctype])])
+    elif (status == 304):
+        start_response("304 Not Modified", headers)
     elif (status == 200):
         start_response("200 OK", [("Content-Type", CONTENT_TYPES[ctype]),
-                                  ("Content-Length", str(len(rbody)))])
+                                  ("Content-Length", str(len(rbody)))] + headers)
 
     return [rbody]
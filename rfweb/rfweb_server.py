@@ -1,6 +1,11 @@
-from wsgiref.simple_server import make_server
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
 import rfweb
 
-httpd = make_server("", 8080, rfweb.application)
+# /events streams are kept open, so each request gets its own thread
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+httpd = make_server("", 8080, rfweb.application, ThreadingWSGIServer)
 print "Serving on 0.0.0.0:8080"
 httpd.serve_forever()